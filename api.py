@@ -0,0 +1,211 @@
+"""JSON API, version 1, mounted at /api/v1.
+
+Serves the same data as the HTML routes without the markup, for the
+mobile client and internal jobs. It uses the same session cookie as the
+site.
+
+- Message lists are cursor-paged like the HTML pages. Pass the response's
+  "next" back as ?before=. "limit" caps the page size (default 20, max 100).
+- Follower/following lists are streamed: the body is written as the rows
+  are read, in keyset batches, so even a very large list is never held in
+  memory. They take an ?after= user-id cursor and an optional limit.
+
+Errors come back as {"error": "..."} with the HTTP status.
+"""
+
+import json
+
+from flask import Blueprint, Response, abort, g, jsonify, request, stream_with_context
+from sqlalchemy import select
+from werkzeug.exceptions import HTTPException
+
+from models import db, User, Message, Follows, Timeline
+from pagination import paginate
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# Rows read per query while streaming a follow list
+STREAM_BATCH = 500
+
+USER_SUMMARY_COLUMNS = (User.id, User.username, User.image_url)
+
+
+##############################################################################
+# Serializers
+
+
+def isoformat(timestamp):
+    """Timestamps are stored as naive UTC."""
+
+    return timestamp.isoformat() + 'Z'
+
+
+def user_summary(user):
+    """The few fields needed to show a user next to a message or in a list."""
+
+    return {'id': user.id, 'username': user.username, 'image_url': user.image_url}
+
+
+def user_json(user):
+    return {
+        **user_summary(user),
+        'header_image_url': user.header_image_url,
+        'bio': user.bio,
+        'location': user.location,
+        'messages_count': user.messages_count,
+        'following_count': user.following_count,
+        'followers_count': user.followers_count,
+        'likes_count': user.likes_count,
+    }
+
+
+def message_json(message):
+    return {
+        'id': message.id,
+        'text': message.text,
+        'timestamp': isoformat(message.timestamp),
+        'likes_count': message.likes_count,
+        'user': user_summary(message.user),
+    }
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+##############################################################################
+# Helpers
+
+
+@api.errorhandler(HTTPException)
+def json_error(error):
+    return jsonify(error=error.description), error.code
+
+
+def require_login():
+    if not g.user:
+        abort(401, "Log in to use this endpoint.")
+
+
+def int_arg(name, default=None, minimum=0):
+    """Integer querystring argument `name`; 400 if it's malformed or too small."""
+
+    if name not in request.args:
+        return default
+    try:
+        value = int(request.args[name])
+    except ValueError:
+        value = None
+    if value is None or value < minimum:
+        abort(400, f"{name} must be an integer of at least {minimum}.")
+    return value
+
+
+def get_limit():
+    return min(int_arg('limit', DEFAULT_LIMIT, minimum=1), MAX_LIMIT)
+
+
+def message_page(query, **kwargs):
+    """Page of `query` from the ?before= cursor, as a JSON response."""
+
+    try:
+        messages, next_cursor = paginate(query, request.args.get('before'),
+                                         per_page=get_limit(), **kwargs)
+    except ValueError:
+        abort(400, "Malformed cursor.")
+
+    return jsonify(messages=[message_json(m) for m in messages], next=next_cursor)
+
+
+def stream_users(query):
+    """Stream {"users": [...], "next": ...} for a select of USER_SUMMARY_COLUMNS.
+
+    Rows come in id order, read a batch at a time. "next" is set when a
+    ?limit= cut the list short.
+    """
+
+    after = int_arg('after', 0)
+    limit = int_arg('limit', minimum=1)
+
+    def generate():
+        last_id = after
+        sent = 0
+        yield '{"users":['
+
+        while limit is None or sent < limit:
+            size = STREAM_BATCH if limit is None else min(STREAM_BATCH, limit - sent)
+            rows = db.session.execute(
+                query.where(User.id > last_id).order_by(User.id).limit(size)).all()
+
+            for row in rows:
+                yield (',' if sent else '') + dumps(user_summary(row))
+                sent += 1
+
+            if len(rows) < size:
+                # list exhausted
+                yield '],"next":null}'
+                return
+
+            last_id = rows[-1].id
+
+        yield f'],"next":{dumps(str(last_id))}}}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+##############################################################################
+# Endpoints
+
+
+@api.route('/users/<int:user_id>')
+def user_detail(user_id):
+    return jsonify(user=user_json(User.active().filter_by(id=user_id).first_or_404()))
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    User.active().filter_by(id=user_id).first_or_404()
+    return message_page(Message.with_authors().filter(Message.user_id == user_id))
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    require_login()
+    User.active().filter_by(id=user_id).first_or_404()
+    return stream_users(
+        select(*USER_SUMMARY_COLUMNS)
+        .join(Follows, Follows.user_following_id == User.id)
+        .where(Follows.user_being_followed_id == user_id, User.deleted.is_(False)))
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    require_login()
+    User.active().filter_by(id=user_id).first_or_404()
+    return stream_users(
+        select(*USER_SUMMARY_COLUMNS)
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .where(Follows.user_following_id == user_id, User.deleted.is_(False)))
+
+
+@api.route('/messages/<int:message_id>')
+def message_detail(message_id):
+    message = Message.with_active_authors().filter(Message.id == message_id).first_or_404()
+    return jsonify(message=message_json(message))
+
+
+@api.route('/timeline')
+def timeline():
+    """The logged-in user's home timeline."""
+
+    require_login()
+    return message_page(
+        Message
+        .with_authors()
+        .join(Timeline, Timeline.message_id == Message.id)
+        .filter(Timeline.user_id == g.user.id,
+                Timeline.author_id.not_in(User.select_deleted_ids())),
+        key=(Timeline.timestamp, Timeline.message_id))
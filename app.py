@@ -1,13 +1,33 @@
 import os
 
+import click
 from flask import Flask, render_template, request, flash, redirect, session, g, url_for, abort
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 
+from api import api
+from assets import Assets
+from caching import init_caching, cache_policy, conditional, PRIVATE_REVALIDATE
+from fragments import FragmentCache
 from forms import UserAddForm, LoginForm, MessageForm, EditUserForm
-from models import db, connect_db, User, Message
+from instrumentation import Instrumentation
+from jobs import enqueue
+from models import (db, connect_db, insert_or_ignore, User, Message, Likes, Follows, Timeline,
+                    Recommendation)
+from pagination import paginate
+from replicas import ReplicaRouter
+from search import UserSearch, MessageSearch
+from socialgraph import SocialGraph
+from trending import Trending, WINDOWS, DEFAULT_WINDOW, LIKES, FOLLOWS, POSTS
+from usercache import UserCache
 
 CURR_USER_KEY = "curr_user"
+USERS_PER_PAGE = 24
+SUGGESTIONS_SHOWN = 5
+TRENDING_SHOWN = 10
+# read-only pages whose queries may go to a read replica
+REPLICA_ENDPOINTS = ('homepage', 'users_show', 'list_users', 'messages_show')
 
 app = Flask(__name__)
 
@@ -20,10 +40,54 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 30))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+app.config['SOCIAL_GRAPH_SIZE'] = int(os.environ.get('SOCIAL_GRAPH_SIZE', 10000))
+app.config['SOCIAL_GRAPH_TTL'] = float(os.environ.get('SOCIAL_GRAPH_TTL', 300))
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 4096))
+app.config['SQL_STATEMENT_WARN_THRESHOLD'] = int(
+    os.environ.get('SQL_STATEMENT_WARN_THRESHOLD', 25))
+app.config['JOBS_ALWAYS_EAGER'] = bool(int(os.environ.get('JOBS_ALWAYS_EAGER', 0)))
+
+# Connection pools, for the primary and each replica alike
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    'pool_pre_ping': bool(int(os.environ.get('DB_POOL_PRE_PING', 0))),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', -1)),
+}
+# Comma-separated; the pages in REPLICA_ENDPOINTS read from these
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri]
+app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
+# registered first so its timer also covers the other before_request hooks
+instrumentation = Instrumentation(app)
+replica_router = ReplicaRouter(app, endpoints=REPLICA_ENDPOINTS)
+instrumentation.watch_pools(lambda: {'primary': db.engine.pool, **replica_router.pools()})
+init_caching(app)
+assets = Assets(app)
+
+social_graph = SocialGraph(max_size=app.config['SOCIAL_GRAPH_SIZE'],
+                           ttl=app.config['SOCIAL_GRAPH_TTL'])
+user_cache = UserCache(max_size=app.config['USER_CACHE_SIZE'],
+                       ttl=app.config['USER_CACHE_TTL'],
+                       graph=social_graph)
+user_search = UserSearch()
+fragment_cache = FragmentCache(max_size=app.config['FRAGMENT_CACHE_SIZE'])
+fragment_cache.init_app(app)
+message_search = MessageSearch()
+trending = Trending()
+
+app.register_blueprint(api)
+
 
 ##############################################################################
 # User signup/login/logout
@@ -31,10 +95,14 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a cached CurrentUser snapshot; use g.user.model to get the
+    full User row when the route is going to change it.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = user_cache.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -43,9 +111,30 @@ def add_user_to_g():
 def do_login(user):
     """Log in user."""
 
+    user_cache.invalidate(user.id)
     session[CURR_USER_KEY] = user.id
 
 
+def viewer_version():
+    """(id, updated_at) of the logged-in user, for pages that depend on them."""
+
+    if g.user:
+        return g.user.id, g.user.updated_at
+    return None, None
+
+
+def get_page(query, **kwargs):
+    """Paginate `query` using the `before` cursor from the querystring.
+
+    Returns (items, next_cursor); responds 400 to a malformed cursor.
+    """
+
+    try:
+        return paginate(query, request.args.get('before'), **kwargs)
+    except ValueError:
+        abort(400)
+
+
 def do_logout():
     """Logout user."""
 
@@ -76,6 +165,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            user_search.index_user(user)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -100,6 +190,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # authenticate may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -123,34 +215,63 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, best
+    matches first; with 'all' set, bio and location are searched too.
+    Results come a page at a time ('page' param).
     """
 
     search = request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400)
 
     if not search:
-        users = User.query.all()
+        users = (User.active()
+                 .order_by(User.id)
+                 .offset((page - 1) * USERS_PER_PAGE)
+                 .limit(USERS_PER_PAGE + 1)
+                 .all())
+        has_more = len(users) > USERS_PER_PAGE
+        users = users[:USERS_PER_PAGE]
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, has_more = user_search.search(search, all_fields='all' in request.args,
+                                             page=page, per_page=USERS_PER_PAGE)
+
+    following_ids = g.user.following_status(u.id for u in users) if g.user else set()
+    return render_template('users/index.html', users=users, following_ids=following_ids,
+                           page=page, has_more=has_more)
+
+
+def user_page_version(user_id):
+    """Validators for a profile page: the user's row plus the viewer's."""
 
-    return render_template('users/index.html', users=users)
+    updated_at = db.session.scalar(
+        select(User.updated_at).where(User.id == user_id, User.deleted.is_(False)))
+    if updated_at is None:
+        return None
+
+    return user_page_validators(user_id, updated_at)
+
+
+def user_page_validators(user_id, updated_at):
+    viewer_id, viewer_updated_at = viewer_version()
+    return ((user_id, updated_at, viewer_id, viewer_updated_at),
+            max(updated_at, viewer_updated_at or updated_at))
 
 
 @app.route('/users/<int:user_id>')
+@cache_policy(PRIVATE_REVALIDATE, vary=['Cookie'])
+@conditional(user_page_version)
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.active().filter_by(id=user_id).first_or_404()
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages, next_cursor = get_page(Message.with_authors().filter(Message.user_id == user_id))
+    return render_template('users/show.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -161,8 +282,14 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    following = (User.active()
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id)
+                 .all())
+    following_ids = g.user.following_status(u.id for u in following)
+    return render_template('users/following.html', user=user, following=following,
+                           following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -173,8 +300,14 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    followers = (User.active()
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id)
+                 .all())
+    following_ids = g.user.following_status(u.id for u in followers)
+    return render_template('users/followers.html', user=user, followers=followers,
+                           following_ids=following_ids)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -185,10 +318,22 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = User.active().filter_by(id=follow_id).first_or_404()
+    # the database decides; the cached graph may be stale either way
+    followed = db.session.execute(
+        insert_or_ignore(Follows).values(user_being_followed_id=followed_user.id,
+                                         user_following_id=g.user.id)).rowcount
+    if followed:
+        Timeline.backfill(g.user.id, followed_user.id)
+        User.adjust_counts(g.user.id, following_count=1)
+        User.adjust_counts(followed_user.id, followers_count=1)
     db.session.commit()
 
+    social_graph.follow(g.user.id, followed_user.id)
+    if followed:
+        trending.record_follow(followed_user.id)
+        user_cache.invalidate(g.user.id, followed_user.id)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
@@ -200,9 +345,16 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    removed = (Follows.query
+               .filter_by(user_being_followed_id=follow_id, user_following_id=g.user.id)
+               .delete(synchronize_session=False))
+    if removed:
+        Timeline.prune(g.user.id, follow_id)
+        User.adjust_counts(g.user.id, following_count=-1)
+        User.adjust_counts(follow_id, followers_count=-1)
+        db.session.commit()
+        social_graph.unfollow(g.user.id, follow_id)
+        user_cache.invalidate(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -215,17 +367,20 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    user = g.user
+    user = g.user.model
     form = EditUserForm(obj=user)
     
     if form.validate_on_submit():
-        if User.authenticate(user.username, form.password.data):
+        if user.check_password(form.password.data):
             user.username = form.username.data
             user.email = form.email.data
             user.image_url = form.image_url.data or "/static/images/default-pic.png"
             user.header_image_url = form.header_image_url.data or "/static/images/warbler-hero.jpg"
             user.bio = form.bio.data
             db.session.commit()
+            user_cache.invalidate(user.id)
+            fragment_cache.invalidate('user', user.id)
+            user_search.index_user(user)
             return redirect(url_for('users_show', user_id=user.id))
         
         flash('Invalid password', 'danger')
@@ -243,18 +398,28 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # gone from logins, user lists and timelines now; large accounts take a
+    # while to actually delete, so a worker does that
+    User.query.filter_by(id=g.user.id).update({User.deleted: True})
+    enqueue('delete_user', user_id=g.user.id)
     db.session.commit()
+    user_cache.invalidate(g.user.id)
+    social_graph.remove_user(g.user.id)
+    fragment_cache.invalidate('user', g.user.id)
+    user_search.remove_user(g.user.id)
 
     return redirect("/signup")
 
-def toggle_like(message, user_likes):
-    if message in user_likes:
-        user_likes.remove(message)
-    else:
-        user_likes.append(message)
-        
+def toggle_like(message, user):
+    """Like `message` as `user`, or unlike it if already liked."""
+
+    delta = Likes.toggle(user.id, message.id)
+    User.adjust_counts(user.id, likes_count=delta)
+    Message.adjust_likes_count(message.id, delta)
     db.session.commit()
+    user_cache.invalidate(user.id)
+    if delta > 0:
+        trending.record_like(message.id)
 
 @app.route('/users/add_like/<msg_id>', methods=["POST"])
 def add_like(msg_id):
@@ -266,8 +431,7 @@ def add_like(msg_id):
     if message.user_id == g.user.id:
         return abort(400)
 
-    user_likes = g.user.likes
-    toggle_like(message, user_likes)
+    toggle_like(message, g.user)
     
     return redirect(url_for('homepage'))
 
@@ -277,9 +441,15 @@ def show_user_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    user = User.query.get_or_404(user_id)
+    user = User.active().filter_by(id=user_id).first_or_404()
     is_current_user = g.user.id == user_id
-    return render_template('/users/likes.html', user=user, user_likes=user.likes, is_current_user=is_current_user)
+    user_likes, next_cursor = get_page(
+        Message
+        .with_active_authors()
+        .join(Likes, Likes.message_id == Message.id)
+        .filter(Likes.user_id == user_id))
+    return render_template('/users/likes.html', user=user, user_likes=user_likes,
+                           is_current_user=is_current_user, next_cursor=next_cursor)
 
 @app.route('/likes/<int:message_id>', methods=["POST"])
 def toggle_likes_on_user_likes_page(message_id):
@@ -290,8 +460,7 @@ def toggle_likes_on_user_likes_page(message_id):
     
     message = Message.query.get_or_404(message_id)
    
-    user_likes = g.user.likes
-    toggle_like(message, user_likes)
+    toggle_like(message, g.user)
     
     return redirect(url_for("show_user_likes", user_id=g.user.id))
 
@@ -312,20 +481,102 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        User.adjust_counts(g.user.id, messages_count=1)
+        # the author sees it at once; followers get it from the worker
+        Timeline.add_own(msg)
+        enqueue('fan_out', message_id=msg.id)
         db.session.commit()
+        user_cache.invalidate(g.user.id)
+        message_search.index_message(msg)
+        trending.record_post(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Full-text search over messages, best matches first.
+
+    Takes the search in the 'q' param and a 'before' cursor for later pages.
+    """
+
+    query = request.args.get('q', '').strip()
+    messages, next_cursor = [], None
+
+    if query:
+        try:
+            messages, next_cursor = message_search.search(query, request.args.get('before'))
+        except ValueError:
+            abort(400)
+
+    return render_template('messages/search.html', query=query, messages=messages,
+                           next_cursor=next_cursor)
+
+
+def in_rank_order(query, model, ranked):
+    """[(row, count)] for the [(id, count)] pairs of `ranked`, fetched with `query`.
+
+    Ids whose rows have been deleted since they were counted are skipped.
+    """
+
+    if not ranked:
+        return []
+
+    by_id = {row.id: row for row in query.filter(model.id.in_([key for key, _ in ranked]))}
+    return [(by_id[key], count) for key, count in ranked if key in by_id]
+
+
+@app.route('/trending')
+def show_trending():
+    """Most-liked messages and fastest-growing accounts over a recent window.
+
+    Takes a 'window' param in querystring: 1h, 24h (the default) or 7d.
+    """
+
+    window = request.args.get('window', DEFAULT_WINDOW)
+    if window not in WINDOWS:
+        abort(400)
+
+    messages = in_rank_order(Message.with_active_authors(), Message,
+                             trending.top(LIKES, window, TRENDING_SHOWN))
+    rising = in_rank_order(User.active(), User, trending.top(FOLLOWS, window, TRENDING_SHOWN))
+    active = in_rank_order(User.active(), User, trending.top(POSTS, window, TRENDING_SHOWN))
+
+    return render_template('trending.html', window=window, windows=list(WINDOWS),
+                           messages=messages, rising=rising, active=active)
+
+
+def message_page_version(message_id):
+    """Validators for a message page: the message, its author and the viewer."""
+
+    row = db.session.execute(
+        select(Message.timestamp, User.updated_at)
+        .join(User, Message.user_id == User.id)
+        .where(Message.id == message_id, User.deleted.is_(False))).first()
+    if row is None:
+        return None
+
+    return message_page_validators(message_id, *row)
+
+
+def message_page_validators(message_id, timestamp, author_updated_at):
+    viewer_id, viewer_updated_at = viewer_version()
+    return ((message_id, author_updated_at, viewer_id, viewer_updated_at),
+            max(timestamp, author_updated_at, viewer_updated_at or timestamp))
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@cache_policy(PRIVATE_REVALIDATE, vary=['Cookie'])
+@conditional(message_page_version)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.with_active_authors().filter(Message.id == message_id).first_or_404()
     return render_template('messages/show.html', message=msg)
 
 
@@ -338,8 +589,15 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    author_id = msg.user_id
+    User.adjust_counts(author_id, messages_count=-1)
+    User.adjust_counts(select(Likes.user_id).where(Likes.message_id == msg.id),
+                       likes_count=-1)
     db.session.delete(msg)
     db.session.commit()
+    user_cache.invalidate(author_id)
+    fragment_cache.invalidate('message', message_id)
+    message_search.remove_message(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -348,44 +606,62 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
+def who_to_follow(candidates):
+    """The first few of `candidates` (precomputed suggestions) g.user doesn't follow yet.
+
+    Suggestions are refreshed in batch, so some may have been followed since.
+    """
+
+    following = g.user.following_ids()
+    return [user for user in candidates if user.id not in following][:SUGGESTIONS_SHOWN]
+
+
 @app.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time,
+      read from the user's precomputed timeline
     """
 
     if g.user:
-        following_ids = [follower.id for follower in g.user.following] + [g.user.id]
-        
-        messages = (Message
-                    .query
-                    .filter()
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        liked_msg_ids = [msg.id for msg in g.user.likes]
-        return render_template('home.html', messages=messages, likes = liked_msg_ids, current_user_id=g.user.id)
+        messages, next_cursor = get_page(
+            Message
+            .with_authors()
+            .join(Timeline, Timeline.message_id == Message.id)
+            .filter(Timeline.user_id == g.user.id,
+                    Timeline.author_id.not_in(User.select_deleted_ids())),
+            key=(Timeline.timestamp, Timeline.message_id))
+
+        liked_msg_ids = Likes.liked_by(g.user.id, (msg.id for msg in messages))
+        suggestions = who_to_follow(
+            db.session.scalars(Recommendation.select_for(g.user.id)))
+        return render_template('home.html', messages=messages, likes = liked_msg_ids,
+                               current_user_id=g.user.id, next_cursor=next_cursor,
+                               suggestions=suggestions)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Maintenance commands
+
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts_command():
+    """Repair drift in the denormalized follower/message/like counters."""
+
+    drifted = User.reconcile_counts()
+    db.session.commit()
+    print(f"Reconciled counters; {drifted} user(s) had drifted.")
+
+
+@app.cli.command('rebuild-timelines')
+@click.option('--batch-size', default=1000, show_default=True, help="Users per transaction.")
+def rebuild_timelines_command(batch_size):
+    """Recompute every home timeline from follows and messages, without downtime."""
+
+    rebuilt = Timeline.rebuild_in_batches(batch_size)
+    print(f"Rebuilt timelines for {rebuilt} user(s).")
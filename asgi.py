@@ -0,0 +1,407 @@
+"""ASGI entry point: the busiest read pages served by async views.
+
+Run it with an ASGI server, e.g.
+
+    uvicorn asgi:application --workers 4
+
+The home page, profile page, message page and user list are handled by
+async views that query through SQLAlchemy's asyncio extension on the
+asyncpg driver. A worker waiting on Postgres for one of these pages can
+keep serving others instead of holding a thread. Everything else (forms,
+POSTs, the API, static files, user search) goes to the regular Flask app
+through asgiref's WSGI adapter, so there is one codebase, one set of models
+and templates, and the WSGI deployment keeps working unchanged. Those
+requests run on the event loop's thread pool, side by side, as they would
+on a threaded WSGI server.
+
+The async views run inside a normal Flask request context, so sessions,
+flash messages, `g.user`, the caching policies and the instrumentation
+hooks behave the same as under WSGI.
+
+ASYNC_DATABASE_URL overrides the database the async views use; by default
+it is DATABASE_URL with the asyncpg driver. Likewise ASYNC_REPLICA_URLS
+(comma-separated) for the read replicas, which the async views use under
+the same rules as the WSGI ones (see replicas.py).
+"""
+
+import os
+from contextvars import Context
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from flask import abort, g, make_response, render_template, request, session, Response
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException
+
+from app import (app, instrumentation, replica_router, social_graph, user_cache, CURR_USER_KEY,
+                 USERS_PER_PAGE, user_page_validators, message_page_validators,
+                 who_to_follow)
+from caching import add_validators, can_revalidate, check_validators
+from models import User, Message, Likes, Recommendation, Timeline
+from pagination import page_query, page_result
+from socialgraph import FOLLOWING, select_neighbours
+from usercache import select_cached_columns
+
+
+def asyncpg_url(url):
+    return make_url(url).set(drivername='postgresql+asyncpg')
+
+
+app.config['ASYNC_DATABASE_URL'] = os.environ.get(
+    'ASYNC_DATABASE_URL', asyncpg_url(app.config['SQLALCHEMY_DATABASE_URI']))
+app.config['ASYNC_REPLICA_URLS'] = [
+    url for url in os.environ.get('ASYNC_REPLICA_URLS', '').split(',') if url]
+
+# database URL -> (async engine, session factory)
+_engines = {}
+
+
+def replica_urls():
+    """ASYNC_REPLICA_URLS, or else the WSGI app's replicas with the asyncpg driver."""
+
+    return (app.config['ASYNC_REPLICA_URLS']
+            or [asyncpg_url(uri) for uri in app.config['SQLALCHEMY_REPLICA_URIS']])
+
+
+def get_sessionmaker(url=None):
+    """Session factory for the async views on `url` (default: the primary).
+
+    Each database's engine is made on first use.
+    """
+
+    url = str(url or app.config['ASYNC_DATABASE_URL'])
+    if url not in _engines:
+        engine = create_async_engine(url, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        _engines[url] = (engine, async_sessionmaker(engine, expire_on_commit=False))
+    return _engines[url][1]
+
+
+def pools():
+    """{name: Pool} of the async engines made so far."""
+
+    replicas = [str(url) for url in replica_urls()]
+    return {(f'async-replica-{replicas.index(url)}' if url in replicas else 'async-primary'):
+            engine.pool for url, (engine, _) in _engines.items()}
+
+
+async def dispose_engine():
+    """Close the async engines' connections (on shutdown, or between event loops)."""
+
+    for engine, _ in list(_engines.values()):
+        await engine.dispose()
+    _engines.clear()
+
+
+instrumentation.watch_pools(pools)
+
+
+##############################################################################
+# Helpers
+
+
+async def load_user():
+    """Async twin of app.add_user_to_g.
+
+    Like the caches' own loads, a miss is read from the primary, whichever
+    database serves the rest of the request.
+    """
+
+    g.user = None
+    user_id = session.get(CURR_USER_KEY)
+    if user_id is None:
+        return
+
+    g.user = user_cache.peek(user_id)
+    if g.user is None:
+        async with get_sessionmaker()() as primary:
+            row = (await primary.execute(select_cached_columns(user_id))).mappings().first()
+        if row is not None:
+            g.user = user_cache.put(user_id, dict(row))
+
+
+async def load_following():
+    """Make sure the social graph has g.user's following list, read from the primary.
+
+    The follow checks templates make through g.user would otherwise load it
+    with a blocking query.
+    """
+
+    if g.user and social_graph.peek(FOLLOWING, g.user.id) is None:
+        async with get_sessionmaker()() as primary:
+            following = (await primary.scalars(select_neighbours(FOLLOWING, g.user.id))).all()
+        social_graph.put(FOLLOWING, g.user.id, following)
+
+
+async def get_page(db_session, query, **kwargs):
+    """Async twin of app.get_page, for a select."""
+
+    try:
+        query = page_query(query, request.args.get('before'), **kwargs)
+    except ValueError:
+        abort(400)
+
+    return page_result((await db_session.scalars(query)).all())
+
+
+def with_authors():
+    return select(Message).options(joinedload(Message.user))
+
+
+async def revalidate(validators, render):
+    """Answer 304 if the client is current, else the response from `render()`."""
+
+    if not can_revalidate():
+        return await render()
+
+    parts, last_modified = validators
+    etag, fresh = check_validators(parts, last_modified)
+    response = Response(status=304) if fresh else make_response(await render())
+    return add_validators(response, etag, last_modified)
+
+
+##############################################################################
+# Views
+
+
+async def homepage(db_session):
+    if not g.user:
+        return render_template('home-anon.html')
+
+    messages, next_cursor = await get_page(
+        db_session,
+        with_authors()
+        .join(Timeline, Timeline.message_id == Message.id)
+        .where(Timeline.user_id == g.user.id,
+               Timeline.author_id.not_in(User.select_deleted_ids())),
+        key=(Timeline.timestamp, Timeline.message_id))
+
+    liked_msg_ids = set()
+    if messages:
+        liked_msg_ids = set(await db_session.scalars(
+            Likes.select_liked_by(g.user.id, [msg.id for msg in messages])))
+    await load_following()
+    suggestions = who_to_follow(
+        await db_session.scalars(Recommendation.select_for(g.user.id)))
+    return render_template('home.html', messages=messages, likes=liked_msg_ids,
+                           current_user_id=g.user.id, next_cursor=next_cursor,
+                           suggestions=suggestions)
+
+
+async def list_users(db_session):
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400)
+
+    users = (await db_session.scalars(
+        select(User)
+        .where(User.deleted.is_(False))
+        .order_by(User.id)
+        .offset((page - 1) * USERS_PER_PAGE)
+        .limit(USERS_PER_PAGE + 1))).all()
+    has_more = len(users) > USERS_PER_PAGE
+    users = users[:USERS_PER_PAGE]
+
+    following_ids = set()
+    if g.user:
+        await load_following()
+        following_ids = g.user.following_status(u.id for u in users)
+
+    return render_template('users/index.html', users=users, following_ids=following_ids,
+                           page=page, has_more=has_more)
+
+
+async def users_show(db_session, user_id):
+    user = await db_session.get(User, user_id)
+    if user is None or user.deleted:
+        abort(404)
+
+    async def render():
+        messages, next_cursor = await get_page(
+            db_session, with_authors().where(Message.user_id == user_id))
+        await load_following()
+        return render_template('users/show.html', user=user, messages=messages,
+                               next_cursor=next_cursor)
+
+    return await revalidate(user_page_validators(user_id, user.updated_at), render)
+
+
+async def messages_show(db_session, message_id):
+    message = await db_session.scalar(
+        with_authors().where(Message.id == message_id,
+                             Message.user_id.not_in(User.select_deleted_ids())))
+    if message is None:
+        abort(404)
+
+    async def render():
+        await load_following()
+        return render_template('messages/show.html', message=message)
+
+    return await revalidate(
+        message_page_validators(message_id, message.timestamp, message.user.updated_at),
+        render)
+
+
+# endpoint -> async view; other endpoints are served by the WSGI app
+ASYNC_VIEWS = {
+    'homepage': homepage,
+    'list_users': list_users,
+    'users_show': users_show,
+    'messages_show': messages_show,
+}
+
+
+##############################################################################
+# ASGI plumbing
+
+
+def build_environ(scope):
+    """WSGI environ for a body-less ASGI request, enough for a request context."""
+
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': BytesIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+
+    return environ
+
+
+def match_async_view(environ):
+    """(view, url kwargs) if an async view handles this request, else None."""
+
+    if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+        return None
+
+    try:
+        endpoint, kwargs = app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        # 404s, redirects etc. come from Flask
+        return None
+
+    view = ASYNC_VIEWS.get(endpoint)
+    # user search is not async yet
+    if view is None or (endpoint == 'list_users' and parse_qs(environ['QUERY_STRING']).get('q')):
+        return None
+
+    return view, kwargs
+
+
+async def run_async_view(environ, view, kwargs):
+    """Run `view` in a Flask request context; returns the finished Response."""
+
+    # a fresh app context, so concurrent requests don't share g with the one
+    # connect_db pushes at import
+    app_ctx = app.app_context()
+    app_ctx.push()
+    ctx = app.request_context(environ)
+    ctx.push()
+    error = None
+    try:
+        instrumentation.start_request()
+        urls = replica_urls()
+        url = replica_router.pick(urls) if urls and replica_router.wants_replica() else None
+        try:
+            async with get_sessionmaker(url)() as db_session:
+                await load_user()
+                response = app.finalize_request(await view(db_session, **kwargs))
+        except HTTPException as e:
+            response = app.finalize_request(app.handle_http_exception(e))
+        except Exception as e:
+            error = e
+            response = app.handle_exception(e)
+        return response
+    finally:
+        ctx.pop(error)
+        app_ctx.pop(error)
+
+
+async def send_response(response, send, head=False):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                    for name, value in response.headers.items()],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': b'' if head else response.get_data(),
+    })
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await dispose_engine()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def isolated_app(environ, start_response):
+    """The Flask app, run in an empty contextvars context.
+
+    asgiref copies the event loop's context into the thread running the
+    request, and that context holds the app context connect_db pushes at
+    import; without this, concurrent WSGI requests would share its `g`.
+    """
+
+    return Context().run(app, environ, start_response)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """asgiref's WSGI adapter, with each request on a thread of its own.
+
+    asgiref runs thread-sensitive code, which includes the WSGI app, on one
+    shared thread, so one slow page would hold up all the other fallback
+    requests. A ThreadSensitiveContext per request gives it its own.
+    """
+
+    async def __call__(self, scope, receive, send):
+        async with ThreadSensitiveContext():
+            await super().__call__(scope, receive, send)
+
+
+wsgi_application = ThreadedWsgiToAsgi(isolated_app)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http':
+        environ = build_environ(scope)
+        match = match_async_view(environ)
+        if match is not None:
+            response = await run_async_view(environ, *match)
+            return await send_response(response, send, head=scope['method'] == 'HEAD')
+
+    return await wsgi_application(scope, receive, send)
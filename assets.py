@@ -0,0 +1,226 @@
+"""Fingerprinted, precompressed static assets.
+
+The build step copies every file under static/ into static/dist/ with a
+content hash in its name, e.g. stylesheets/style.css becomes
+stylesheets/style.1a2b3c4d5e6f.css. Text assets also get .gz copies, and
+.br copies when the brotli package is installed. url("/static/...")
+references inside stylesheets are rewritten to the hashed names.
+static/dist/manifest.json maps each source name to its built name.
+
+    python assets.py                      # build static/ into static/dist/
+    python assets.py --source s --dest d
+
+Templates call asset_url('stylesheets/style.css') where they would have
+used url_for('static', ...). It also accepts a full '/static/...' path, as
+stored in users.image_url. It returns the fingerprinted URL when the
+manifest has one, and otherwise the plain URL: before the first build, or
+for an external image. caching.py serves fingerprinted files as
+immutable. The static view sends the precompressed copy when the client's
+Accept-Encoding allows it.
+
+Earlier builds are left in place, so pages rendered before a deploy can
+still fetch the assets they reference.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import current_app, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip variants are built
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# URL segment under /static that built assets are served from
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+HASH_LENGTH = 12
+
+# Worth compressing; images are already compressed
+COMPRESSIBLE = {'.css', '.js', '.json', '.svg', '.ico', '.txt', '.html', '.map'}
+
+CSS_URL = re.compile(r"""url\((['"]?)/static/([^'")?#]+)\1\)""")
+
+
+def _compressors():
+    """[(Content-Encoding, file suffix, compress function)], best first."""
+
+    compressors = []
+    if brotli is not None:
+        compressors.append(('br', '.br', lambda data: brotli.compress(data, quality=11)))
+    compressors.append(('gzip', '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0)))
+    return compressors
+
+
+ENCODINGS = _compressors()
+
+
+def fingerprint(name, data):
+    """`name` with a hash of `data` before its extension."""
+
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+
+
+def source_files(source, dest):
+    """Relative paths of the files to build, stylesheets last.
+
+    Stylesheets go last so the files they reference are already in the
+    manifest when their url()s are rewritten.
+    """
+
+    names = []
+    for directory, subdirs, files in os.walk(source):
+        # never build the output into itself
+        subdirs[:] = [d for d in subdirs
+                      if os.path.abspath(os.path.join(directory, d)) != os.path.abspath(dest)]
+        for filename in files:
+            names.append(os.path.relpath(os.path.join(directory, filename), source)
+                         .replace(os.sep, '/'))
+
+    return sorted(names, key=lambda name: (name.endswith('.css'), name))
+
+
+def rewrite_css(data, manifest):
+    def replace(match):
+        built = manifest.get(match.group(2))
+        if built is None:
+            return match.group(0)
+        return f'url("/static/{DIST}/{built}")'
+
+    return CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as out:
+        out.write(data)
+
+
+def build(source, dest):
+    """Build every file under `source` into `dest`; returns the manifest."""
+
+    manifest = {}
+
+    for name in source_files(source, dest):
+        with open(os.path.join(source, name), 'rb') as file:
+            data = file.read()
+
+        if name.endswith('.css'):
+            data = rewrite_css(data, manifest)
+
+        built = fingerprint(name, data)
+        manifest[name] = built
+        path = os.path.join(dest, built)
+        write_file(path, data)
+
+        if os.path.splitext(name)[1] in COMPRESSIBLE:
+            for _, suffix, compress in ENCODINGS:
+                compressed = compress(data)
+                if len(compressed) < len(data):
+                    write_file(path + suffix, compressed)
+
+    with open(os.path.join(dest, MANIFEST), 'w') as out:
+        json.dump(manifest, out, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class Assets:
+    """Flask extension: asset_url() for templates and precompressed static serving."""
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSETS_DIST', os.path.join(app.static_folder, DIST))
+        self.load_manifest(app.config['ASSETS_DIST'])
+
+        app.jinja_env.globals['asset_url'] = self.url
+        app.view_functions['static'] = self.send_static
+
+    def load_manifest(self, directory):
+        """(Re)read the manifest written by the last build, if there is one."""
+
+        try:
+            with open(os.path.join(directory, MANIFEST)) as file:
+                self.manifest = json.load(file)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def url(self, path):
+        """URL of a static file, fingerprinted when it has been built.
+
+        `path` is relative to static/ ('images/default-pic.png'), a
+        '/static/...' URL, or any other URL, which is returned as is.
+        """
+
+        if not path:
+            return path
+
+        prefix = current_app.static_url_path + '/'
+        if path.startswith(prefix):
+            name = path[len(prefix):]
+        elif path.startswith('/') or '://' in path:
+            return path
+        else:
+            name = path
+
+        built = self.manifest.get(name)
+        if built is None:
+            return url_for('static', filename=name)
+        return url_for('static', filename=f"{DIST}/{built}")
+
+    def send_static(self, filename):
+        """The static view, sending built files precompressed when accepted."""
+
+        if not filename.startswith(DIST + '/'):
+            return current_app.send_static_file(filename)
+
+        directory = current_app.config['ASSETS_DIST']
+        name = filename[len(DIST) + 1:]
+        mimetype = mimetypes.guess_type(name)[0]
+
+        variants = [(encoding, name + suffix) for encoding, suffix, _ in ENCODINGS
+                    if os.path.isfile(safe_join(directory, name + suffix) or '')]
+
+        for encoding, variant in variants:
+            if request.accept_encodings[encoding]:
+                response = send_from_directory(directory, variant, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(directory, name, mimetype=mimetype)
+
+        if variants:
+            response.vary.add('Accept-Encoding')
+        return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fingerprint and precompress static assets.")
+    parser.add_argument('--source', default=os.path.join(ROOT, 'static'),
+                        help="directory of source assets (default: static)")
+    parser.add_argument('--dest', default=os.path.join(ROOT, 'static', DIST),
+                        help="output directory (default: static/dist)")
+    args = parser.parse_args(argv)
+
+    manifest = build(args.source, args.dest)
+    print(f"Built {len(manifest)} assets into {args.dest}"
+          f"{'' if brotli else ' (install brotli for .br variants)'}")
+
+
+if __name__ == '__main__':
+    main()
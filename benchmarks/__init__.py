@@ -0,0 +1,7 @@
+"""Load-test and benchmark suite for the Warbler routes.
+
+Seeds a dataset of configurable size, drives the hot routes through the
+Flask test client and through a real threaded WSGI server, and records
+latency percentiles, throughput and SQL statements per request as JSON.
+See benchmarks/__main__.py for the command line.
+"""
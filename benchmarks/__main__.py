@@ -0,0 +1,97 @@
+"""Command line for the benchmark suite.
+
+Run it against a scratch database -- seeding drops and recreates the tables:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks --scale 10
+    python -m benchmarks --no-seed --routes homepage users_show --requests 500
+    python -m benchmarks --compare baseline.json    # exit 1 on a regression
+
+DATABASE_URL defaults to postgresql:///warbler-bench, never the dev database.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler-bench')
+
+# must import after setting database
+from benchmarks import dataset, runner
+
+MODES = ('test_client', 'live_server')
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Warbler routes.")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="dataset size, as a multiple of the generator's base size")
+    parser.add_argument('--no-seed', action='store_true',
+                        help="reuse the data already in the database")
+    parser.add_argument('--routes', nargs='+', choices=sorted(runner.SCENARIOS),
+                        default=list(runner.SCENARIOS))
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per route and mode")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="concurrent clients against the live server")
+    parser.add_argument('--out', default='bench_output.json',
+                        help="where to write the results")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="allowed growth before a metric counts as a regression")
+    args = parser.parse_args(argv)
+
+    from app import app
+
+    with app.app_context():
+        loaded = None if args.no_seed else dataset.seed(args.scale)
+        results = runner.run(args.routes, args.requests, args.concurrency, args.modes)
+
+    report = dict(
+        meta=dict(
+            created=datetime.now(timezone.utc).isoformat(),
+            revision=git_revision(),
+            python=platform.python_version(),
+            database=app.config['SQLALCHEMY_DATABASE_URI'].split('@')[-1],
+            scale=args.scale,
+            loaded=loaded,
+            requests=args.requests,
+            concurrency=args.concurrency,
+        ),
+        results=results,
+    )
+
+    with open(args.out, 'w') as out:
+        json.dump(report, out, indent=2)
+
+    for result in results:
+        print(f"{result['route']:16} {result['mode']:12} p50 {result['p50_ms']:>9} ms  "
+              f"p95 {result['p95_ms']:>9} ms  p99 {result['p99_ms']:>9} ms  "
+              f"{result['throughput_rps']:>9} req/s  "
+              f"{result['statements_per_request']:>6} SQL/req  {result['errors']} errors")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = runner.compare(json.load(baseline_file), report, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""Benchmark datasets: generated users/messages/follows plus some likes."""
+
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stderr
+from io import StringIO
+
+from sqlalchemy import select
+
+import loader
+from models import db, User, Message, Likes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Share of messages given a like when seeding
+LIKED_FRACTION = 0.3
+
+
+def seed(scale=1.0, seed='bench', power_law=1.1, workers=1):
+    """Recreate the tables and fill them with a generated dataset.
+
+    Returns {table name: rows loaded}.
+    """
+
+    with tempfile.TemporaryDirectory() as out:
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+             '--out', out, '--scale', str(scale), '--seed', seed,
+             '--power-law', str(power_law), '--workers', str(workers),
+             '--until', '2024-01-01'],
+            check=True)
+
+        with redirect_stderr(StringIO()):
+            loaded = loader.load(out)
+
+    loaded['likes'] = add_likes(random.Random(f"{seed}:likes"))
+    return loaded
+
+
+def add_likes(rng):
+    """Like a share of the messages, each by a random non-author."""
+
+    user_ids = db.session.scalars(select(User.id)).all()
+    likes = []
+
+    for message_id, author_id in db.session.execute(select(Message.id, Message.user_id)):
+        if rng.random() < LIKED_FRACTION:
+            liker = rng.choice(user_ids)
+            if liker != author_id:
+                likes.append(dict(user_id=liker, message_id=message_id))
+
+    if likes:
+        db.session.execute(Likes.__table__.insert(), likes)
+    User.reconcile_counts()
+    db.session.commit()
+
+    return len(likes)
@@ -0,0 +1,271 @@
+"""Drive routes through the test client or a live WSGI server and measure them."""
+
+import http.client
+import math
+import random
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count, permutations
+from threading import Thread
+from time import perf_counter
+from urllib.parse import urlencode
+
+from sqlalchemy import event, func, select
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import app, CURR_USER_KEY
+from models import db, User, Follows, Likes
+
+# Metrics compared against a baseline run; higher is worse for each.
+COMPARED_METRICS = ('p95_ms', 'statements_per_request')
+
+# Follow pairs drawn whenever the pool runs dry
+FOLLOW_REFILL = 500
+
+# build(rng, sample) -> (path, logged-in user id, form data or None)
+Scenario = namedtuple('Scenario', ['name', 'method', 'build'])
+
+
+class Sample:
+    """Ids and names drawn from the dataset for building requests.
+
+    `follows` is how many follow pairs to draw up front; the pool is topped
+    up if a run takes more.
+    """
+
+    def __init__(self, rng, size=500, follows=0):
+        self.user_ids = db.session.scalars(
+            select(User.id).order_by(func.random()).limit(size)).all()
+        self.usernames = db.session.scalars(
+            select(User.username).order_by(func.random()).limit(size)).all()
+        self.likers = db.session.scalars(
+            select(Likes.user_id).distinct().limit(size)).all() or self.user_ids
+        self.handed_out = set()
+        self.follow_pairs = self._unfollowed_pairs(rng, follows)
+
+    def _unfollowed_pairs(self, rng, wanted):
+        """Distinct (follower, followed) pairs that aren't follows yet or handed out."""
+
+        taken = set(db.session.execute(
+            select(Follows.user_following_id, Follows.user_being_followed_id)
+            .where(Follows.user_following_id.in_(self.user_ids)))) | self.handed_out
+
+        pairs = set()
+        for _ in range(wanted * 2):
+            pair = tuple(rng.sample(self.user_ids, 2))
+            if pair not in taken:
+                pairs.add(pair)
+            if len(pairs) >= wanted:
+                break
+
+        if wanted and not pairs:
+            # few left: look through every pair rather than keep guessing
+            left = sorted(pair for pair in permutations(self.user_ids, 2) if pair not in taken)
+            pairs = rng.sample(left, min(wanted, len(left)))
+        return list(pairs)
+
+    def follow_pair(self, rng):
+        """A (follower, followed) pair to follow, never the same one twice."""
+
+        if not self.follow_pairs:
+            self.follow_pairs = self._unfollowed_pairs(rng, FOLLOW_REFILL)
+            if not self.follow_pairs:
+                raise RuntimeError("every sampled user already follows every other")
+
+        pair = self.follow_pairs.pop()
+        self.handed_out.add(pair)
+        return pair
+
+
+def _follow(rng, sample):
+    follower, followed = sample.follow_pair(rng)
+    return f"/users/follow/{followed}", follower, None
+
+
+SCENARIOS = {scenario.name: scenario for scenario in [
+    Scenario('homepage', 'GET',
+             lambda rng, s: ("/", rng.choice(s.user_ids), None)),
+    Scenario('users_show', 'GET',
+             lambda rng, s: (f"/users/{rng.choice(s.user_ids)}", rng.choice(s.user_ids), None)),
+    Scenario('list_users', 'GET',
+             lambda rng, s: ("/users?" + urlencode({'q': rng.choice(s.usernames)[:4]}),
+                             rng.choice(s.user_ids), None)),
+    Scenario('show_user_likes', 'GET',
+             lambda rng, s: (f"/users/{rng.choice(s.likers)}/likes", rng.choice(s.user_ids), None)),
+    Scenario('add_follow', 'POST', _follow),
+    Scenario('messages_add', 'POST',
+             lambda rng, s: ("/messages/new", rng.choice(s.user_ids),
+                             {'text': f"benchmark warble {rng.random()}"})),
+]}
+
+
+class StatementCounter:
+    """Counts SQL statements sent to the database, from any thread."""
+
+    def __init__(self):
+        self._counter = count()
+        self.total = 0
+
+    def _count(self, *args):
+        next(self._counter)
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+        # count() has been advanced once per statement
+        self.total = next(self._counter)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(name, mode, latencies, elapsed, statements, errors, concurrency):
+    latencies = sorted(latencies)
+    ms = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+    return dict(
+        route=name,
+        mode=mode,
+        requests=len(latencies),
+        concurrency=concurrency,
+        errors=errors,
+        p50_ms=ms(percentile(latencies, 50)),
+        p95_ms=ms(percentile(latencies, 95)),
+        p99_ms=ms(percentile(latencies, 99)),
+        mean_ms=ms(sum(latencies) / len(latencies)) if latencies else None,
+        throughput_rps=round(len(latencies) / elapsed, 2) if elapsed else None,
+        statements_per_request=round(statements / len(latencies), 2) if latencies else None,
+    )
+
+
+def run_test_client(scenario, sample, requests, rng):
+    """Issue `requests` requests one after another through the test client."""
+
+    client = app.test_client()
+    latencies = []
+    errors = 0
+
+    with StatementCounter() as statements:
+        for _ in range(requests):
+            path, user_id, data = scenario.build(rng, sample)
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            started = perf_counter()
+            resp = client.open(path, method=scenario.method, data=data)
+            latencies.append(perf_counter() - started)
+            errors += resp.status_code >= 400
+
+    return summarize(scenario.name, 'test_client', latencies, sum(latencies),
+                     statements.total, errors, 1)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class LiveServer:
+    """The app on a threaded werkzeug server on a free local port."""
+
+    def __enter__(self):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=QuietRequestHandler)
+        self.port = self.server.server_port
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.thread.join()
+
+
+def session_cookie(user_id):
+    """A signed session cookie logging in `user_id`."""
+
+    value = app.session_interface.get_signing_serializer(app).dumps({CURR_USER_KEY: user_id})
+    return f"{app.config['SESSION_COOKIE_NAME']}={value}"
+
+
+def run_live_server(scenario, sample, requests, rng, concurrency):
+    """Issue `requests` requests from `concurrency` threads against a live server."""
+
+    # build every request up front so the clients only time the HTTP round trip
+    planned = [scenario.build(rng, sample) for _ in range(requests)]
+
+    def fetch(port, request):
+        path, user_id, data = request
+        headers = {'Cookie': session_cookie(user_id)}
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        started = perf_counter()
+        conn.request(scenario.method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        latency = perf_counter() - started
+        conn.close()
+        return latency, resp.status
+
+    with LiveServer() as server, StatementCounter() as statements:
+        started = perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(lambda request: fetch(server.port, request), planned))
+        elapsed = perf_counter() - started
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(status >= 400 for _, status in results)
+    return summarize(scenario.name, 'live_server', latencies, elapsed,
+                     statements.total, errors, concurrency)
+
+
+def run(routes, requests, concurrency, modes, seed='bench'):
+    """Benchmark each of `routes` in each of `modes`; returns a list of results."""
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    rng = random.Random(seed)
+    # every add_follow request needs a pair of its own
+    sample = Sample(rng, follows=requests * len(modes) if 'add_follow' in routes else 0)
+
+    results = []
+    for name in routes:
+        scenario = SCENARIOS[name]
+        if 'test_client' in modes:
+            results.append(run_test_client(scenario, sample, requests, rng))
+        if 'live_server' in modes:
+            results.append(run_live_server(scenario, sample, requests, rng, concurrency))
+    return results
+
+
+def compare(baseline, current, threshold):
+    """Regressions in `current` vs `baseline`, as readable strings.
+
+    A metric regresses when it grows by more than `threshold` (0.2 = 20%).
+    """
+
+    before = {(r['route'], r['mode']): r for r in baseline['results']}
+    regressions = []
+
+    for result in current['results']:
+        old = before.get((result['route'], result['mode']))
+        if not old:
+            continue
+        for metric in COMPARED_METRICS:
+            if old[metric] and result[metric] and result[metric] > old[metric] * (1 + threshold):
+                regressions.append(
+                    f"{result['route']} ({result['mode']}): {metric} "
+                    f"{old[metric]} -> {result[metric]}")
+
+    return regressions
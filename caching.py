@@ -0,0 +1,136 @@
+"""HTTP caching policy.
+
+Each route can declare its Cache-Control with @cache_policy; routes that
+don't declare one are sent `no-store`, which is what every response used to
+get. Static files are revalidated against the ETag/Last-Modified that
+Flask's send_file already sets, unless their name carries a content
+fingerprint (style.3f2a9c1d.css). Those never change, so browsers and CDNs
+may keep them for a year.
+
+Pages that are cheap to version but costly to render can also use
+@conditional. It answers If-None-Match / If-Modified-Since with a 304
+before the view runs.
+"""
+
+import hashlib
+import re
+from functools import wraps
+
+from flask import Response, current_app, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+NO_STORE = 'no-store'
+# may be stored, but must be revalidated before every use
+REVALIDATE = 'public, no-cache'
+PRIVATE_REVALIDATE = 'private, no-cache'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+DEFAULT_POLICY = NO_STORE
+
+# name.<hex digest>.ext, as written by the asset build
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{8,}\.[^./]+$')
+
+
+def cache_policy(cache_control, vary=None):
+    """Declare the Cache-Control (and extra Vary headers) a view's responses get.
+
+    Goes directly below @app.route:
+
+        @app.route('/users/<int:user_id>')
+        @cache_policy(PRIVATE_REVALIDATE, vary=['Cookie'])
+        def users_show(user_id): ...
+    """
+
+    def decorator(view):
+        view.cache_control = cache_control
+        view.vary = tuple(vary or ())
+        return view
+
+    return decorator
+
+
+def static_policy(filename):
+    return IMMUTABLE if FINGERPRINTED.search(filename) else REVALIDATE
+
+
+def make_etag(parts):
+    """Short opaque ETag from the values a response depends on."""
+
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:24]
+
+
+def check_validators(parts, last_modified):
+    """Return (etag, current): the ETag for `parts`, and whether the client has it.
+
+    The query string is part of the ETag, so each page of a paged view
+    gets its own.
+    """
+
+    etag = make_etag((*parts, request.query_string))
+    return etag, not is_resource_modified(request.environ, etag=etag,
+                                          last_modified=last_modified)
+
+
+def add_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    return response
+
+
+def can_revalidate():
+    """False while a flash message is waiting; it isn't part of any version."""
+
+    return not session.get('_flashes')
+
+
+def conditional(validators):
+    """Send 304 Not Modified instead of running the view when the client is current.
+
+    `validators(**view_args)` returns (parts, last_modified): a tuple of the
+    values the page depends on, hashed into a weak ETag along with the query
+    string, and a naive UTC datetime. It returns None when the view should
+    just run, e.g. because the row doesn't exist.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            current = validators(**kwargs) if can_revalidate() else None
+            if current is None:
+                return view(**kwargs)
+
+            parts, last_modified = current
+            etag, fresh = check_validators(parts, last_modified)
+
+            if fresh:
+                response = Response(status=304)
+            else:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+
+            return add_validators(response, etag, last_modified)
+
+        return wrapper
+
+    return decorator
+
+
+def apply_cache_policy(response):
+    """after_request hook setting Cache-Control/Vary from the matched route."""
+
+    if request.endpoint == 'static':
+        response.headers['Cache-Control'] = static_policy(request.view_args['filename'])
+        return response
+
+    view = current_app.view_functions.get(request.endpoint)
+
+    response.headers['Cache-Control'] = getattr(view, 'cache_control', DEFAULT_POLICY)
+    for header in getattr(view, 'vary', ()):
+        response.vary.add(header)
+
+    return response
+
+
+def init_caching(app):
+    app.after_request(apply_cache_policy)
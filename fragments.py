@@ -0,0 +1,128 @@
+"""Cache of rendered template fragments.
+
+Message cards and user cards are the bulk of most pages, and their markup
+only changes when the message or user does. Wrap such markup in a cache
+tag naming the fragment, the id of the object it shows, and the values
+that version it:
+
+    {% cache 'message.card', msg.id, msg.user.updated_at %}
+      ...
+    {% endcache %}
+
+Later renders with the same version reuse the stored HTML. A changed
+version re-renders the fragment and replaces the entry. Keep anything that
+depends on the viewer (follow/like buttons) outside the tag.
+
+The part of the name before the first dot is the kind of object. Routes
+call invalidate(kind, id) when such an object is edited or deleted, which
+drops every fragment of that object. Entries live in a backend with
+get/set/delete/clear -- by default an in-process LRU.
+"""
+
+from collections import OrderedDict, defaultdict
+from threading import Lock
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+
+class LRUBackend:
+    """In-process LRU mapping of key -> value, holding at most `max_size` entries."""
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FragmentCache:
+    """Rendered fragments keyed by (name, object id), each stored with its version."""
+
+    def __init__(self, backend=None, max_size=4096):
+        self.backend = backend if backend is not None else LRUBackend(max_size)
+        # kind -> fragment names seen, so invalidate() knows which keys to drop
+        self._names = defaultdict(set)
+
+    def init_app(self, app):
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.fragment_cache = self
+
+    def fetch(self, name, obj_id, version, render):
+        """Stored HTML for this fragment at `version`, or render() it and store it."""
+
+        key = (name, obj_id)
+        entry = self.backend.get(key)
+        if entry is not None and entry[0] == version:
+            return Markup(entry[1])
+
+        html = render()
+        self._names[name.split('.')[0]].add(name)
+        self.backend.set(key, (version, str(html)))
+        return Markup(html)
+
+    def invalidate(self, kind, *obj_ids):
+        """Drop every cached fragment of the `kind` objects with these ids."""
+
+        for name in list(self._names[kind]):
+            for obj_id in obj_ids:
+                self.backend.delete((name, obj_id))
+
+    def clear(self):
+        self.backend.clear()
+
+
+class FragmentCacheExtension(Extension):
+    """The {% cache name, id, version... %} ... {% endcache %} tag."""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        if len(args) < 2:
+            parser.fail("cache needs a fragment name and an object id", lineno)
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(args)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _render(self, args, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+
+        name, obj_id, *version = args
+        return cache.fetch(name, obj_id, tuple(version), caller)
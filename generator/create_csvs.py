@@ -2,76 +2,303 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows -- e.g. load-testing
+datasets:
+
+    python generator/create_csvs.py                        # the default 300 users
+    python generator/create_csvs.py --scale 3333 --workers 8 --shards 8 --power-law 1.1
+
+Output is deterministic for a given --seed, --until and --shards, whatever
+the number of workers; a table's shards are written in parallel, so give
+--shards as well as --workers to spread the work. Each table is written as TABLE.csv, or as TABLE.000.csv,
+TABLE.001.csv, ... when split into several shards; loader.py loads either
+layout. Nothing here touches the network.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+from datetime import datetime
+from glob import glob
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import HEADER_IMAGE_URLS, get_random_datetime
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
+# Row counts at --scale 1
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# Popularity weights are integers, rank ** -alpha scaled by this
+WEIGHT_SCALE = 2 ** 32
 
-# Generate random profile image URLs to use for users
+# Every generated user's password is "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def shard_ranges(total, shards):
+    """Split range(total) into `shards` contiguous (start, stop) pieces."""
+
+    bounds = [total * i // shards for i in range(shards + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def shard_path(out_dir, table, shard, shards):
+    if shards == 1:
+        return os.path.join(out_dir, f"{table}.csv")
+    return os.path.join(out_dir, f"{table}.{shard:03d}.csv")
+
+
+def shard_rng(seed, table, shard):
+    """Random generator for one shard, independent of how work is scheduled."""
+
+    return random.Random(f"{seed}:{table}:{shard}")
+
+
+def shard_faker(rng):
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(64))
+    return fake
+
+
+def write_users(path, start, stop, rng):
+    fake = shard_faker(rng)
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+        users_writer.writeheader()
+
+        for i in range(start, stop):
+            user_id = i + 1
+            local, domain = fake.email().split('@')
+            # suffix the id so usernames/emails stay unique at any scale
+            users_writer.writerow(dict(
+                id=user_id,
+                email=f"{local}{user_id}@{domain}",
+                username=f"{fake.user_name()}{user_id}",
+                image_url=rng.choice(IMAGE_URLS),
+                password=PASSWORD_HASH,
+                bio=fake.sentence(),
+                header_image_url=rng.choice(HEADER_IMAGE_URLS),
+                location=fake.city()
+            ))
+
+
+def write_messages(path, start, stop, rng, num_users, until):
+    fake = shard_faker(rng)
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
+        messages_writer.writeheader()
+
+        for _ in range(start, stop):
+            messages_writer.writerow(dict(
+                text=fake.paragraph()[:MAX_WARBLER_LENGTH],
+                timestamp=get_random_datetime(rng=rng, now=until),
+                user_id=rng.randint(1, num_users)
+            ))
+
+
+def popularity_weights(num_users, alpha, seed):
+    """Integer follow-target weights: Zipf(alpha) over a shuffled ranking.
+
+    With alpha 0 every user is equally likely to be followed. Every weight
+    is at least 1, so anyone can be followed however steep the curve.
+    """
+
+    ranking = list(range(1, num_users + 1))
+    random.Random(f"{seed}:popularity").shuffle(ranking)
+
+    weights = [0] * num_users
+    for rank, user_id in enumerate(ranking, start=1):
+        weights[user_id - 1] = max(1, round(WEIGHT_SCALE * rank ** -alpha))
+
+    return weights
+
+
+class WeightTree:
+    """Fenwick tree over integer weights, for weighted draws without replacement."""
+
+    def __init__(self, weights):
+        self.weights = list(weights)
+        self.size = len(self.weights)
+        self.total = sum(self.weights)
+        self.tree = [0] + self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+    def add(self, index, delta):
+        self.total += delta
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, target):
+        """Index whose share of the running total holds `target` (0 <= target < total)."""
+
+        pos = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            if pos + step <= self.size and self.tree[pos + step] <= target:
+                pos += step
+                target -= self.tree[pos]
+            step >>= 1
+        return pos
+
+    def sample(self, rng, k, exclude):
+        """`k` distinct indexes other than `exclude`, drawn in proportion to weight."""
+
+        taken = [exclude]
+        self.add(exclude, -self.weights[exclude])
+        for _ in range(k):
+            index = self.find(rng.randrange(self.total))
+            self.add(index, -self.weights[index])
+            taken.append(index)
+
+        for index in taken:
+            self.add(index, self.weights[index])
+        return taken[1:]
+
+
+def follows_per_user(rng, users, wanted, limit):
+    """Spread `wanted` follows uniformly over `users` followers, at most `limit` each."""
+
+    counts = [0] * users
+    for _ in range(wanted):
+        counts[rng.randrange(users)] += 1
+
+    # hand anyone's excess to the first followers with room
+    spill = 0
+    for i, count in enumerate(counts):
+        if count > limit:
+            spill += count - limit
+            counts[i] = limit
+    for i, count in enumerate(counts):
+        if not spill:
+            break
+        extra = min(spill, limit - count)
+        counts[i] += extra
+        spill -= extra
+
+    return counts
+
+
+def write_follows(path, start, stop, rng, num_follows, num_users, alpha, seed):
+    """Write follows whose follower id falls in (start, stop].
+
+    Each follower gets a share of the shard's follows, then draws that many
+    distinct users to follow without replacement, so no draw is ever wasted
+    on a pair already taken, even at full density or with a steep power law.
+    Memory is O(users), never O(users^2). Partitioning by follower keeps
+    shards from producing the same pair.
+    """
+
+    targets = WeightTree(popularity_weights(num_users, alpha, seed))
+
+    # each follower can follow at most everyone else
+    wanted = min(num_follows, (stop - start) * (num_users - 1))
+    counts = follows_per_user(rng, stop - start, wanted, num_users - 1)
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
+        follows_writer.writeheader()
+
+        for follower, count in enumerate(counts, start=start + 1):
+            for index in targets.sample(rng, count, exclude=follower - 1):
+                follows_writer.writerow(dict(user_being_followed_id=index + 1,
+                                             user_following_id=follower))
+
+
+def remove_old_output(out_dir, table):
+    for path in glob(os.path.join(out_dir, f"{table}.csv")) + \
+            glob(os.path.join(out_dir, f"{table}.*.csv")):
+        os.remove(path)
+
+
+def build_tasks(args):
+    """One (function, args) task per shard of each table."""
+
+    num_users = max(2, round(NUM_USERS * args.scale))
+    num_messages = round(NUM_MESSAGES * args.scale)
+    num_follows = round(NUM_FOLLWERS * args.scale)
+    until = datetime.fromisoformat(args.until)
+
+    tasks = []
+    for shard, (start, stop) in enumerate(shard_ranges(num_users, args.shards)):
+        tasks.append((write_users, (shard_path(args.out, 'users', shard, args.shards),
+                                    start, stop, shard_rng(args.seed, 'users', shard))))
+
+    for shard, (start, stop) in enumerate(shard_ranges(num_messages, args.shards)):
+        tasks.append((write_messages, (shard_path(args.out, 'messages', shard, args.shards),
+                                       start, stop, shard_rng(args.seed, 'messages', shard),
+                                       num_users, until)))
+
+    # follows are split by follower, with each shard's share of the edges
+    # in proportion to its share of the users
+    for shard, (start, stop) in enumerate(shard_ranges(num_users, args.shards)):
+        shard_follows = num_follows * stop // num_users - num_follows * start // num_users
+        tasks.append((write_follows, (shard_path(args.out, 'follows', shard, args.shards),
+                                      start, stop, shard_rng(args.seed, 'follows', shard),
+                                      shard_follows, num_users, args.power_law, args.seed)))
+
+    return tasks
+
+
+def run_task(task):
+    fn, fn_args = task
+    fn(*fn_args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help=f"multiplier on the base sizes of {NUM_USERS} users, "
+                             f"{NUM_MESSAGES} messages and {NUM_FOLLWERS} follows")
+    parser.add_argument('--seed', default='warbler',
+                        help="random seed; the same seed gives the same data")
+    parser.add_argument('--until', default=datetime.now().date().isoformat(),
+                        help="messages are dated in the two years before this (default: today)")
+    parser.add_argument('--power-law', type=float, default=0.0, metavar='ALPHA',
+                        help="draw follow targets from a Zipf(ALPHA) popularity "
+                             "distribution instead of uniformly")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes writing shards in parallel")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="files per table; the data depends on this, not on --workers "
+                             "(default: 1)")
+    parser.add_argument('--out', default='generator',
+                        help="output directory (default: generator)")
+    args = parser.parse_args(argv)
+
+    for table in ('users', 'messages', 'follows'):
+        remove_old_output(args.out, table)
+
+    tasks = build_tasks(args)
+
+    if args.workers == 1:
+        for task in tasks:
+            run_task(task)
+    else:
+        with Pool(args.workers) as pool:
+            pool.map(run_task, tasks, chunksize=1)
+
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
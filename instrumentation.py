@@ -0,0 +1,287 @@
+"""Always-on request instrumentation.
+
+Cheap enough to leave running in production:
+
+- SQLAlchemy cursor events count the statements each request runs and the
+  time spent in them. Per statement this is a counter increment and two
+  perf_counter() calls.
+- Latency and statements-per-request histograms are kept for each route.
+  They are exported in Prometheus text format at /metrics. They are
+  recorded at teardown, so requests that die with an unhandled exception
+  are counted too, as 500s.
+- Every response carries a Server-Timing header, so browser dev tools show
+  the database vs. total time of a page.
+- A request that runs more than SQL_STATEMENT_WARN_THRESHOLD statements is
+  logged as a suspected N+1, along with its most repeated statement.
+- The connection pools passed to watch_pools() are reported as gauges:
+  configured size and connections checked out, idle and in overflow.
+
+Metrics are per process; with several workers, scrape each one (or sum
+them in Prometheus).
+"""
+
+import logging
+from bisect import bisect_left
+from collections import Counter
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+from flask import Response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Stats for the request being handled in this thread/context, if any
+_current = ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    """Running totals for one request."""
+
+    __slots__ = ('started', 'statements', 'sql_seconds', 'statement_started', 'by_statement',
+                 'status')
+
+    def __init__(self):
+        self.started = perf_counter()
+        # of the response, once there is one
+        self.status = None
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.statement_started = None
+        self.by_statement = Counter()
+
+
+def current_stats():
+    """RequestStats of the request in progress, or None outside a request."""
+
+    return _current.get()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.by_statement[statement] += 1
+        stats.statement_started = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is not None and stats.statement_started is not None:
+        stats.sql_seconds += perf_counter() - stats.statement_started
+        stats.statement_started = None
+
+
+class Histogram:
+    """Fixed-bucket histogram; counts are per bucket, made cumulative on export."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # one count per bucket plus +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """[(upper bound, observations <= bound)], ending with +Inf."""
+
+        bounds = [format_number(bound) for bound in self.buckets] + ['+Inf']
+        running = 0
+        result = []
+        for bound, bucket_count in zip(bounds, self.counts):
+            running += bucket_count
+            result.append((bound, running))
+        return result
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return ','.join(f'{name}="{escape(value)}"' for name, value in labels)
+
+
+class Metrics:
+    """Process-wide per-route request metrics."""
+
+    def __init__(self, latency_buckets=LATENCY_BUCKETS, statement_buckets=STATEMENT_BUCKETS):
+        self.latency_buckets = latency_buckets
+        self.statement_buckets = statement_buckets
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # (endpoint, method, status) -> Histogram of seconds
+            self.latency = {}
+            # endpoint -> Histogram of statements per request
+            self.statements = {}
+            # endpoint -> total seconds spent in SQL
+            self.sql_seconds = Counter()
+
+    def record(self, endpoint, method, status, seconds, stats):
+        with self._lock:
+            key = (endpoint, method, status)
+            if key not in self.latency:
+                self.latency[key] = Histogram(self.latency_buckets)
+            self.latency[key].observe(seconds)
+
+            if endpoint not in self.statements:
+                self.statements[endpoint] = Histogram(self.statement_buckets)
+            self.statements[endpoint].observe(stats.statements)
+            self.sql_seconds[endpoint] += stats.sql_seconds
+
+    def render(self):
+        """All metrics in Prometheus text exposition format."""
+
+        lines = []
+
+        def histogram(name, help_text, series):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, hist in series:
+                for bound, count in hist.cumulative():
+                    lines.append(f"{name}_bucket{{{format_labels(labels + [('le', bound)])}}} {count}")
+                lines.append(f"{name}_sum{{{format_labels(labels)}}} {format_number(hist.sum)}")
+                lines.append(f"{name}_count{{{format_labels(labels)}}} {hist.count}")
+
+        with self._lock:
+            histogram('warbler_request_duration_seconds',
+                      "Time to handle a request, by route.",
+                      [([('endpoint', endpoint), ('method', method), ('status', status)], hist)
+                       for (endpoint, method, status), hist in sorted(self.latency.items())])
+
+            histogram('warbler_request_sql_statements',
+                      "SQL statements run per request, by route.",
+                      [([('endpoint', endpoint)], hist)
+                       for endpoint, hist in sorted(self.statements.items())])
+
+            lines.append("# HELP warbler_request_sql_seconds_total Time spent in SQL, by route.")
+            lines.append("# TYPE warbler_request_sql_seconds_total counter")
+            for endpoint, seconds in sorted(self.sql_seconds.items()):
+                lines.append(f"warbler_request_sql_seconds_total{{{format_labels([('endpoint', endpoint)])}}} "
+                             f"{format_number(float(seconds))}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def render_pools(pools):
+    """Prometheus gauges for {name: Pool}, skipping pools that don't keep connections."""
+
+    pools = sorted((name, pool) for name, pool in pools.items() if hasattr(pool, 'checkedout'))
+    lines = ["# HELP warbler_db_pool_size Connections a pool keeps open, by database.",
+             "# TYPE warbler_db_pool_size gauge"]
+    for name, pool in pools:
+        lines.append(f"warbler_db_pool_size{{{format_labels([('bind', name)])}}} {pool.size()}")
+
+    lines.append("# HELP warbler_db_pool_connections Pooled connections, by database and state.")
+    lines.append("# TYPE warbler_db_pool_connections gauge")
+    for name, pool in pools:
+        for state, count in (('checked_out', pool.checkedout()),
+                             ('idle', pool.checkedin()),
+                             # negative while the pool is below its size
+                             ('overflow', max(pool.overflow(), 0))):
+            lines.append(f"warbler_db_pool_connections"
+                         f"{{{format_labels([('bind', name), ('state', state)])}}} {count}")
+
+    return '\n'.join(lines) + '\n'
+
+
+class Instrumentation:
+    """Flask extension wiring the SQL hooks, histograms, Server-Timing and /metrics."""
+
+    def __init__(self, app=None):
+        self.metrics = Metrics()
+        self.pool_sources = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQL_STATEMENT_WARN_THRESHOLD', 25)
+
+        # listen on the Engine class so every engine/bind is covered
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+        self.warn_threshold = app.config['SQL_STATEMENT_WARN_THRESHOLD']
+
+        app.before_request(self.start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._end_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def start_request(self):
+        """Begin collecting stats for the current request.
+
+        A before_request hook; also called directly by handlers that skip
+        Flask's request dispatch (see asgi.py).
+        """
+
+        _current.set(RequestStats())
+
+    def _finish_request(self, response):
+        stats = _current.get()
+        if stats is None or request.endpoint == 'metrics':
+            return response
+
+        stats.status = response.status_code
+        elapsed = perf_counter() - stats.started
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats.sql_seconds * 1000:.1f};desc="{stats.statements} queries", '
+            f'app;dur={elapsed * 1000:.1f}')
+
+        return response
+
+    def _end_request(self, exc):
+        stats = _current.get()
+        _current.set(None)
+        if stats is None or request.endpoint == 'metrics':
+            return
+
+        elapsed = perf_counter() - stats.started
+        endpoint = request.endpoint or 'unmatched'
+        # no response got as far as after_request: an unhandled exception
+        status = stats.status or 500
+        self.metrics.record(endpoint, request.method, status, elapsed, stats)
+
+        if self.warn_threshold and stats.statements > self.warn_threshold:
+            statement, repeats = stats.by_statement.most_common(1)[0]
+            logger.warning(
+                "Possible N+1 in %s %s (%s): %d SQL statements; ran %d times: %s",
+                request.method, request.path, endpoint, stats.statements, repeats,
+                ' '.join(statement.split())[:200])
+
+    def watch_pools(self, pools):
+        """Report the pools of `pools()`, a callable returning {name: Pool}, at /metrics."""
+
+        self.pool_sources.append(pools)
+
+    def metrics_view(self):
+        """Prometheus scrape endpoint."""
+
+        body = self.metrics.render()
+        if self.pool_sources:
+            pools = {}
+            for source in self.pool_sources:
+                pools.update(source())
+            body += render_pools(pools)
+
+        return Response(body, content_type=PROMETHEUS_CONTENT_TYPE)
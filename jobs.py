@@ -0,0 +1,319 @@
+"""Background jobs: work that shouldn't make a request wait.
+
+A route queues a job with enqueue(), which adds a row to the jobs table in
+the route's own transaction, so the job exists exactly when the route's
+changes do. Worker processes claim due jobs with SELECT ... FOR UPDATE
+SKIP LOCKED, so several can run side by side, and call the handler named
+by the job's kind with its payload.
+
+A job that raises is retried after RETRY_DELAY seconds, doubling each
+time, until it has had max_attempts attempts; then it's marked failed
+with the traceback kept in last_error. A job still running after LEASE
+seconds is taken to have lost its worker and goes back in the queue.
+Handlers may therefore run more than once and must be safe to repeat.
+
+With JOBS_ALWAYS_EAGER set (as in the tests), enqueue() runs the job on
+the spot and errors propagate to the caller.
+
+Run a worker, or look after the queue, like:
+
+    python jobs.py work
+    python jobs.py status
+    python jobs.py retry 42
+    python jobs.py enqueue reconcile_counts
+    python jobs.py purge --days 7
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, func, select
+
+from models import db, Job, Message, Timeline, User
+
+MAX_ATTEMPTS = 5
+# seconds before the first retry; doubles with each further failure
+RETRY_DELAY = 10
+# seconds a job may run before it's assumed its worker died
+LEASE = 15 * 60
+POLL_INTERVAL = 1.0
+
+# Messages deleted per transaction by delete_user
+DELETE_CHUNK = 500
+
+HANDLERS = {}
+
+
+def handler(func):
+    """Register `func` as the handler for jobs of kind `func.__name__`."""
+
+    HANDLERS[func.__name__] = func
+    return func
+
+
+##############################################################################
+# Handlers
+
+
+@handler
+def delete_user(user_id):
+    """Delete a user and everything of theirs, DELETE_CHUNK messages at a time.
+
+    Each chunk releases its likes from the likers' counters and deletes the
+    messages in one transaction; the database cascades the likes and
+    timeline entries. The user row goes last, taking their follows, likes
+    and remaining timeline with it.
+    """
+
+    while True:
+        message_ids = db.session.scalars(
+            select(Message.id).where(Message.user_id == user_id).limit(DELETE_CHUNK)).all()
+        if not message_ids:
+            break
+
+        Message.release_likes(message_ids)
+        db.session.execute(delete(Message).where(Message.id.in_(message_ids)))
+        db.session.commit()
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        return
+
+    user.release_counts()
+    db.session.execute(delete(User).where(User.id == user_id))
+
+
+@handler
+def fan_out(message_id):
+    """Push a new message into its author's followers' timelines.
+
+    The route has already put it in the author's own.
+    """
+
+    message = db.session.get(Message, message_id)
+    if message is not None:
+        Timeline.fan_out(message, author=False)
+
+
+@handler
+def reconcile_counts():
+    User.reconcile_counts()
+
+
+##############################################################################
+# Queue
+
+
+def enqueue(kind, delay=0, max_attempts=MAX_ATTEMPTS, **payload):
+    """Queue a job calling the `kind` handler with `payload`, due in `delay` seconds.
+
+    The job is only added to the session; it's queued when the caller
+    commits. In eager mode it runs now and everything is committed.
+    """
+
+    if kind not in HANDLERS:
+        raise ValueError(f"no job handler named {kind!r}")
+
+    now = datetime.utcnow()
+    job = Job(kind=kind, payload=payload, status=Job.QUEUED, attempts=0,
+              max_attempts=max_attempts, created_at=now,
+              run_at=now + timedelta(seconds=delay))
+    db.session.add(job)
+
+    if current_app.config.get('JOBS_ALWAYS_EAGER'):
+        start(job, 'eager')
+        run(job, propagate=True)
+
+    return job
+
+
+def select_due(now=None):
+    """Select of the queued jobs that are due, oldest first."""
+
+    return (select(Job)
+            .where(Job.status == Job.QUEUED, Job.run_at <= (now or datetime.utcnow()))
+            .order_by(Job.run_at, Job.id))
+
+
+def start(job, worker):
+    job.status = Job.RUNNING
+    job.attempts += 1
+    job.started_at = datetime.utcnow()
+    job.locked_by = worker
+
+
+def claim(worker):
+    """Mark the next due job as running on `worker` and return it, or None if none is due."""
+
+    job = db.session.scalars(select_due().limit(1).with_for_update(skip_locked=True)).first()
+    if job is not None:
+        start(job, worker)
+    db.session.commit()
+    return job
+
+
+def fail(job, error):
+    """Record a failed attempt: back in the queue for later, or failed for good."""
+
+    job.last_error = error
+    if job.attempts < job.max_attempts:
+        job.status = Job.QUEUED
+        job.run_at = datetime.utcnow() + timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+    else:
+        job.status = Job.FAILED
+        job.finished_at = datetime.utcnow()
+
+
+def run(job, propagate=False):
+    """Call the handler of a claimed job and record the outcome.
+
+    Returns True if the handler succeeded. Unless `propagate`, its
+    exception is recorded on the job rather than raised.
+    """
+
+    try:
+        HANDLERS[job.kind](**job.payload)
+    except Exception:
+        if propagate:
+            raise
+        error = traceback.format_exc()
+        db.session.rollback()
+        fail(job, error)
+        db.session.commit()
+        return False
+
+    job.status = Job.DONE
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    return True
+
+
+def requeue_stale(lease=LEASE):
+    """Fail the current attempt of jobs running longer than `lease` seconds.
+
+    Returns the number of jobs released.
+    """
+
+    cutoff = datetime.utcnow() - timedelta(seconds=lease)
+    stale = db.session.scalars(
+        select(Job)
+        .where(Job.status == Job.RUNNING, Job.started_at < cutoff)
+        .with_for_update(skip_locked=True)).all()
+
+    for job in stale:
+        fail(job, f"lease expired: no result from {job.locked_by} after {lease} seconds")
+    db.session.commit()
+    return len(stale)
+
+
+def work(worker=None, once=False, poll=POLL_INTERVAL, out=None):
+    """Run due jobs, waiting `poll` seconds whenever none are due.
+
+    With `once`, stop as soon as none are due. Returns the number of
+    jobs run.
+    """
+
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    ran = 0
+
+    while True:
+        requeue_stale()
+        job = claim(worker)
+
+        if job is None:
+            if once:
+                return ran
+            time.sleep(poll)
+            continue
+
+        succeeded = run(job)
+        ran += 1
+        if out:
+            print(f"{'done' if succeeded else 'error'} {job!r}", file=out)
+
+
+def retry(job_id):
+    """Queue a failed job again, now, allowing it one more attempt."""
+
+    job = db.session.get(Job, job_id)
+    if job is None or job.status != Job.FAILED:
+        return None
+
+    job.status = Job.QUEUED
+    job.run_at = datetime.utcnow()
+    job.max_attempts = max(job.max_attempts, job.attempts + 1)
+    job.finished_at = None
+    db.session.commit()
+    return job
+
+
+def purge(days=7):
+    """Delete jobs that finished successfully more than `days` days ago; returns how many."""
+
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    purged = db.session.execute(
+        delete(Job).where(Job.status == Job.DONE, Job.finished_at < cutoff)).rowcount
+    db.session.commit()
+    return purged
+
+
+def counts():
+    """{(kind, status): number of jobs}."""
+
+    return {(kind, status): count for kind, status, count in db.session.execute(
+        select(Job.kind, Job.status, func.count()).group_by(Job.kind, Job.status))}
+
+
+def main(argv=None):
+    from app import app
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    work_parser = commands.add_parser('work', help="run jobs as they come due")
+    work_parser.add_argument('--once', action='store_true',
+                             help="exit when no job is due instead of waiting")
+    work_parser.add_argument('--poll', type=float, default=POLL_INTERVAL, metavar='SECONDS')
+
+    commands.add_parser('status', help="count jobs by kind and status; list failures")
+
+    retry_parser = commands.add_parser('retry', help="queue a failed job again")
+    retry_parser.add_argument('job_id', type=int)
+
+    enqueue_parser = commands.add_parser('enqueue', help="queue a job")
+    enqueue_parser.add_argument('kind', choices=sorted(HANDLERS))
+    enqueue_parser.add_argument('--payload', type=json.loads, default={}, metavar='JSON')
+
+    purge_parser = commands.add_parser('purge', help="delete old finished jobs")
+    purge_parser.add_argument('--days', type=float, default=7)
+
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        if args.command == 'work':
+            work(once=args.once, poll=args.poll, out=sys.stdout)
+        elif args.command == 'status':
+            for (kind, status), count in sorted(counts().items()):
+                print(f"{kind:20} {status:8} {count}")
+            for job in Job.query.filter_by(status=Job.FAILED).order_by(Job.id):
+                print(f"\n{job!r}\n{job.last_error}")
+        elif args.command == 'retry':
+            if retry(args.job_id) is None:
+                sys.exit(f"no failed job #{args.job_id}")
+        elif args.command == 'enqueue':
+            job = enqueue(args.kind, **args.payload)
+            db.session.commit()
+            print(f"queued {job!r}")
+        else:
+            print(f"purged {purge(args.days)} job(s)")
+
+
+if __name__ == '__main__':
+    main()
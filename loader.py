@@ -0,0 +1,227 @@
+"""Bulk-load the generator CSVs into the database.
+
+Streams each CSV straight into Postgres with COPY FROM STDIN; on other
+databases (SQLite in development) rows go in with batched executemany.
+Progress and rows/second are reported as it goes. Afterwards id sequences
+are moved past the loaded rows and the derived data (timelines, counters)
+is rebuilt. With --append only the users the new rows touch are rebuilt:
+new users, the authors of new messages and their followers, and both
+ends of new follows.
+
+Run it like:
+
+    python loader.py                  # drop tables, re-run migrations, then load
+    python loader.py --append         # load into the existing tables
+    python loader.py --dir some/where --batch-size 50000
+
+A table may be split over several files: generator/messages.csv plus any
+shards named generator/messages.*.csv are all loaded.
+"""
+
+import argparse
+import csv
+import sys
+from datetime import datetime
+from glob import glob
+from time import monotonic
+
+from sqlalchemy import DateTime, func, select, text
+
+import migrate
+from app import app
+from models import db, User, Message, Follows, Timeline
+
+# Load order matters: messages and follows point at users.
+TABLES = [User.__table__, Message.__table__, Follows.__table__]
+
+PROGRESS_EVERY = 2.0
+
+
+class Progress:
+    """Prints a running row count and rate for one table to stderr."""
+
+    def __init__(self, name, out=sys.stderr):
+        self.name = name
+        self.out = out
+        self.rows = 0
+        self.started = self.last_report = monotonic()
+
+    def add(self, rows):
+        self.rows += rows
+        now = monotonic()
+        if now - self.last_report >= PROGRESS_EVERY:
+            self.last_report = now
+            self.report()
+
+    def report(self, final=False):
+        elapsed = max(monotonic() - self.started, 1e-9)
+        label = "loaded" if final else "loading"
+        print(f"{self.name}: {label} {self.rows:,} rows "
+              f"({self.rows / elapsed:,.0f} rows/s)", file=self.out)
+
+
+class LineCountingReader:
+    """File wrapper that feeds Progress as COPY reads through it."""
+
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.progress.add(data.count('\n'))
+        return data
+
+    def readline(self, size=-1):
+        line = self.file.readline(size)
+        self.progress.add(1 if line else 0)
+        return line
+
+
+def table_files(directory, table):
+    """CSV files holding `table`'s rows: TABLE.csv and any TABLE.*.csv shards."""
+
+    return sorted(glob(f"{directory}/{table.name}.csv")) + \
+        sorted(glob(f"{directory}/{table.name}.*.csv"))
+
+
+def copy_csv(raw_conn, table, path, progress):
+    """Stream one CSV file into `table` with Postgres COPY."""
+
+    with open(path, newline='') as file:
+        columns = ', '.join(next(csv.reader(file)))
+        rows_before = progress.rows
+        cursor = raw_conn.cursor()
+        cursor.copy_expert(
+            f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv)",
+            LineCountingReader(file, progress))
+        # line counts are an estimate (quoted fields may hold newlines)
+        progress.rows = rows_before + cursor.rowcount
+        cursor.close()
+
+
+def insert_csv(conn, table, path, progress, batch_size):
+    """Insert one CSV file into `table` in executemany batches."""
+
+    with open(path, newline='') as file:
+        reader = csv.DictReader(file)
+        timestamps = [name for name in reader.fieldnames
+                      if isinstance(table.c[name].type, DateTime)]
+
+        batch = []
+        for row in reader:
+            row = {name: value if value != '' else None for name, value in row.items()}
+            for name in timestamps:
+                if row[name] is not None:
+                    row[name] = datetime.fromisoformat(row[name])
+            batch.append(row)
+
+            if len(batch) >= batch_size:
+                conn.execute(table.insert(), batch)
+                progress.add(len(batch))
+                batch = []
+
+        if batch:
+            conn.execute(table.insert(), batch)
+            progress.add(len(batch))
+
+
+def reset_sequences(conn):
+    """Move Postgres id sequences past the highest loaded id."""
+
+    for table in TABLES:
+        if 'id' in table.c:
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM {table.name}), 0) + 1, false)"))
+
+
+def follow_ids(directory):
+    """(follower ids, followed ids) named in `directory`'s follows CSVs."""
+
+    followers, followed = set(), set()
+    for path in table_files(directory, Follows.__table__):
+        with open(path, newline='') as file:
+            for row in csv.DictReader(file):
+                followers.add(int(row['user_following_id']))
+                followed.add(int(row['user_being_followed_id']))
+    return followers, followed
+
+
+def appended_users(directory, last_user_id, last_message_id):
+    """(readers, counted): users whose timelines and counters an append changed.
+
+    New rows are those past the ids that were highest before the load.
+    """
+
+    new_users = set(db.session.scalars(select(User.id).where(User.id > last_user_id)))
+    authors = set(db.session.scalars(
+        select(Message.user_id).where(Message.id > last_message_id).distinct()))
+    authors_followers = set(db.session.scalars(
+        select(Follows.user_following_id).where(Follows.user_being_followed_id.in_(authors))))
+    followers, followed = follow_ids(directory)
+
+    readers = new_users | authors | authors_followers | followers
+    counted = new_users | authors | followers | followed
+    return readers, counted
+
+
+def load(directory='generator', append=False, batch_size=10000):
+    """Load every table's CSVs from `directory`; returns {table name: rows}."""
+
+    if append:
+        last_user_id = db.session.scalar(select(func.coalesce(func.max(User.id), 0)))
+        last_message_id = db.session.scalar(select(func.coalesce(func.max(Message.id), 0)))
+        db.session.commit()
+    else:
+        migrate.recreate()
+
+    engine = db.engine
+    is_postgres = engine.dialect.name == 'postgresql'
+    loaded = {}
+
+    with engine.begin() as conn:
+        for table in TABLES:
+            progress = Progress(table.name)
+            for path in table_files(directory, table):
+                if is_postgres:
+                    copy_csv(conn.connection.dbapi_connection, table, path, progress)
+                else:
+                    insert_csv(conn, table, path, progress, batch_size)
+            progress.report(final=True)
+            loaded[table.name] = progress.rows
+
+        if is_postgres:
+            reset_sequences(conn)
+
+    started = monotonic()
+    if append:
+        readers, counted = appended_users(directory, last_user_id, last_message_id)
+        Timeline.rebuild(readers)
+        User.reconcile_counts(counted)
+    else:
+        Timeline.rebuild()
+        User.reconcile_counts()
+    db.session.commit()
+    print(f"rebuilt timelines and counters in {monotonic() - started:.1f}s", file=sys.stderr)
+
+    return loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dir', default='generator',
+                        help="directory holding the CSVs (default: generator)")
+    parser.add_argument('--append', action='store_true',
+                        help="load into the existing tables instead of recreating them, "
+                             "rebuilding only the affected users' timelines and counters")
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help="rows per executemany batch on non-Postgres databases")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        load(args.dir, append=args.append, batch_size=args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Apply the schema migrations in migrations/ to the database.
+
+Applied versions are recorded in the schema_migrations table, so each
+migration runs once per database, in order, in its own transaction (or,
+for one that sets TRANSACTIONAL = False, statement by statement).
+
+Run it like:
+
+    python migrate.py                 # apply pending migrations
+    python migrate.py status          # list applied and pending migrations
+    python migrate.py upgrade --to 0002
+
+The migrations are written for Postgres. On other databases (SQLite in
+development) `recreate` builds the tables from models.py instead.
+"""
+
+import argparse
+import importlib
+import pkgutil
+import sys
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, select
+
+import migrations
+from models import db
+
+# Kept out of db.metadata so drop_all/create_all leave it alone
+version_table = Table(
+    'schema_migrations', MetaData(),
+    Column('version', String, primary_key=True),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow),
+)
+
+
+def discover():
+    """[(version, module)] of every migration, in order."""
+
+    names = sorted(info.name for info in pkgutil.iter_modules(migrations.__path__))
+    return [(name.split('_', 1)[0], importlib.import_module(f'migrations.{name}'))
+            for name in names]
+
+
+def applied_versions(engine):
+    version_table.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return set(conn.scalars(select(version_table.c.version)))
+
+
+def pending(engine=None):
+    """[(version, module)] not yet applied to the database."""
+
+    engine = engine or db.engine
+    applied = applied_versions(engine)
+    return [(version, module) for version, module in discover() if version not in applied]
+
+
+def upgrade(engine=None, target=None, out=None):
+    """Apply pending migrations up to and including `target` (default: all).
+
+    Returns the versions applied.
+    """
+
+    engine = engine or db.engine
+    done = []
+
+    for version, module in pending(engine):
+        if target is not None and version > target:
+            break
+
+        if getattr(module, 'TRANSACTIONAL', True):
+            with engine.begin() as conn:
+                module.upgrade(conn)
+                conn.execute(version_table.insert().values(version=version))
+        else:
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                module.upgrade(conn)
+                conn.execute(version_table.insert().values(version=version))
+
+        done.append(version)
+        if out:
+            print(f"applied {module.__name__.split('.')[-1]}", file=out)
+
+    return done
+
+
+def recreate(engine=None):
+    """Drop every table, then build the schema from scratch."""
+
+    engine = engine or db.engine
+    db.drop_all()
+    version_table.drop(engine, checkfirst=True)
+
+    if engine.dialect.name == 'postgresql':
+        upgrade(engine)
+    else:
+        db.create_all()
+
+
+def main(argv=None):
+    from app import app
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', nargs='?', default='upgrade', choices=['upgrade', 'status'])
+    parser.add_argument('--to', metavar='VERSION',
+                        help="stop after this migration (default: apply all)")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        if args.command == 'status':
+            waiting = {version for version, _ in pending()}
+            for version, module in discover():
+                state = 'pending' if version in waiting else 'applied'
+                print(f"{state:8} {module.__name__.split('.')[-1]}")
+        elif not upgrade(target=args.to, out=sys.stdout):
+            print("database is up to date")
+
+
+if __name__ == '__main__':
+    main()
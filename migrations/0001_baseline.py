@@ -0,0 +1,45 @@
+"""Tables of the original schema: users, messages, follows, likes."""
+
+from sqlalchemy import text
+
+STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        username TEXT NOT NULL UNIQUE,
+        image_url TEXT,
+        header_image_url TEXT,
+        bio TEXT,
+        location TEXT,
+        password TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id SERIAL PRIMARY KEY,
+        text VARCHAR(140) NOT NULL,
+        timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS follows (
+        user_being_followed_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        user_following_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        PRIMARY KEY (user_being_followed_id, user_following_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS likes (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        message_id INTEGER UNIQUE REFERENCES messages (id) ON DELETE CASCADE
+    )
+    """,
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
@@ -0,0 +1,29 @@
+"""Indexes for the per-user and reverse lookups the busiest pages make.
+
+- messages (user_id, timestamp DESC, id DESC): a profile's messages, newest
+  first, read straight off the index (and the cascade when a user goes).
+- follows (user_following_id, user_being_followed_id): "who does X follow";
+  the primary key only serves "who follows X".
+- likes (user_id, message_id): a user's likes, and which of a page of
+  messages they liked.
+- timelines (message_id) and (author_id): the ON DELETE CASCADE lookups when
+  a message or a user is deleted.
+"""
+
+from migrations import create_index_concurrently
+
+# built without blocking writes to tables that may already be large
+TRANSACTIONAL = False
+
+INDEXES = [
+    ('ix_messages_user_timestamp', "messages (user_id, timestamp DESC, id DESC)"),
+    ('ix_follows_user_following', "follows (user_following_id, user_being_followed_id)"),
+    ('ix_likes_user_message', "likes (user_id, message_id)"),
+    ('ix_timelines_message_id', "timelines (message_id)"),
+    ('ix_timelines_author_id', "timelines (author_id)"),
+]
+
+
+def upgrade(conn):
+    for name, definition in INDEXES:
+        create_index_concurrently(conn, name, definition)
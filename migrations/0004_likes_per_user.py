@@ -0,0 +1,27 @@
+"""Let a message be liked by many users, each at most once.
+
+Swaps the UNIQUE (message_id) of the original schema for UNIQUE (user_id,
+message_id), which also replaces the plain (user_id, message_id) index.
+"""
+
+from sqlalchemy import text
+
+STATEMENTS = [
+    "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key",
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_likes_user_message') THEN
+            ALTER TABLE likes ADD CONSTRAINT uq_likes_user_message UNIQUE (user_id, message_id);
+        END IF;
+    END
+    $$
+    """,
+    "DROP INDEX IF EXISTS ix_likes_user_message",
+    "CREATE INDEX IF NOT EXISTS ix_likes_message_id ON likes (message_id)",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
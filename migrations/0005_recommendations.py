@@ -0,0 +1,21 @@
+"""Precomputed "who to follow" suggestions."""
+
+from sqlalchemy import text
+
+STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS recommendations (
+        user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        recommended_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        score DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (user_id, recommended_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_recommendations_recommended_id "
+    "ON recommendations (recommended_id)",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
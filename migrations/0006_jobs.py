@@ -0,0 +1,28 @@
+"""Background job queue (see jobs.py)."""
+
+from sqlalchemy import text
+
+STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id SERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        payload JSON NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 5,
+        run_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        started_at TIMESTAMP WITHOUT TIME ZONE,
+        finished_at TIMESTAMP WITHOUT TIME ZONE,
+        locked_by TEXT,
+        last_error TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at ON jobs (status, run_at)",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
@@ -0,0 +1,32 @@
+"""Indexes for search (see search.py).
+
+- users: trigram GIN indexes on username, bio and location, answering
+  substring searches. Only where the server has pg_trgm to install;
+  elsewhere search.py uses its in-process index.
+- messages: GIN over to_tsvector('english', text), for full-text search.
+
+Until now only db.create_all() made these, through search.py's
+after_create listeners, so a migrated database had none of them.
+"""
+
+from sqlalchemy import text
+
+from migrations import create_index_concurrently
+
+# built without blocking writes to tables that may already be large
+TRANSACTIONAL = False
+
+TRIGRAM_FIELDS = ('username', 'bio', 'location')
+
+
+def upgrade(conn):
+    available = conn.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first()
+    if available:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for field in TRIGRAM_FIELDS:
+            create_index_concurrently(conn, f"ix_users_{field}_trgm",
+                                      f"users USING gin ({field} gin_trgm_ops)")
+
+    create_index_concurrently(conn, "ix_messages_text_fts",
+                              "messages USING gin (to_tsvector('english', text))")
@@ -0,0 +1,19 @@
+"""Mark deleted accounts, so they vanish before the delete_user job runs.
+
+users.deleted hides an account from logins, user lists and timelines as
+soon as it's deleted; a partial index keeps the few pending ones at hand
+for the timeline filter.
+"""
+
+from sqlalchemy import text
+
+from migrations import create_index_concurrently
+
+# built without blocking writes to a table that may already be large
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    conn.execute(text(
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted BOOLEAN NOT NULL DEFAULT false"))
+    create_index_concurrently(conn, "ix_users_deleted", "users (id) WHERE deleted")
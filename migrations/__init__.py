@@ -0,0 +1,32 @@
+"""Schema migrations, applied in order by migrate.py.
+
+Each module is named NNNN_description.py and has an `upgrade(conn)` that
+runs its DDL on a SQLAlchemy connection, inside the transaction that also
+records the version. A module that sets TRANSACTIONAL = False gets an
+autocommit connection instead, for statements like CREATE INDEX
+CONCURRENTLY that can't run in a transaction; it must be safe to re-run
+after failing part way. Migrations are frozen once merged: change the schema
+by adding a new one, and mirror the change in models.py so the two agree
+(test_migrations checks that they do).
+
+The statements use IF NOT EXISTS where Postgres allows it, so databases
+made by the old `db.create_all()` can be brought under migrations by
+running them.
+"""
+
+from sqlalchemy import text
+
+
+def create_index_concurrently(conn, name, definition):
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS `name` ON `definition`.
+
+    A concurrent build that fails leaves an invalid index behind, which
+    IF NOT EXISTS would then keep; such a leftover is dropped and rebuilt.
+    """
+
+    invalid = conn.execute(text(
+        "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+        "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"), {'name': name}).first()
+    if invalid:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+    conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}"))
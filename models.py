@@ -2,11 +2,27 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, delete, event, func, literal, select, true, tuple_, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import aliased, joinedload
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import PasswordHasher
+from replicas import RoutingSession
+
+hasher = PasswordHasher()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def insert_or_ignore(model):
+    """INSERT ... ON CONFLICT DO NOTHING into `model`'s table.
+
+    The statement's rowcount is 0 when the row was already there, e.g.
+    put in by a concurrent request.
+    """
+
+    dialect = sqlite if db.session.get_bind().dialect.name == 'sqlite' else postgresql
+    return dialect.insert(model).on_conflict_do_nothing()
 
 
 class Follows(db.Model):
@@ -26,9 +42,18 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key covers "who follows X"; this is "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following', 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
-    """Mapping user likes to warbles."""
+    """Mapping user likes to warbles.
+
+    A user likes a message at most once; how many likes a message has is
+    kept in Message.likes_count rather than counted from here.
+    """
 
     __tablename__ = 'likes' 
 
@@ -45,11 +70,116 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    __table_args__ = (
+        # also the index for "which messages has this user liked"
+        db.UniqueConstraint('user_id', 'message_id', name='uq_likes_user_message'),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def select_liked_by(cls, user_id, message_ids):
+        return select(cls.message_id).where(cls.user_id == user_id,
+                                            cls.message_id.in_(message_ids))
+
+    @classmethod
+    def liked_by(cls, user_id, message_ids):
+        """Which of `message_ids` has `user_id` liked? Returns a set of ids.
+
+        Only the given ids are looked up, so marking the likes on a page
+        costs one small query however many messages the user has liked.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        return set(db.session.scalars(cls.select_liked_by(user_id, message_ids)))
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` as `user_id`, or unlike it if already liked.
+
+        Returns the change in like count: 1, -1, or 0 when a concurrent
+        toggle liked it first.
+        """
+
+        unliked = db.session.execute(
+            delete(cls).where(cls.user_id == user_id, cls.message_id == message_id))
+        if unliked.rowcount:
+            return -1
+
+        liked = db.session.execute(
+            insert_or_ignore(cls).values(user_id=user_id, message_id=message_id))
+        return liked.rowcount
+
+
+class FollowChecks:
+    """Follow lookups for anything with a user `id`.
+
+    Shared by the User model and the cached CurrentUser snapshot, so both
+    answer "do I follow them?" from one set of ids instead of walking the
+    follow relationships.
+    """
+
+    # Cached by following_ids/follower_ids. On User these are dropped
+    # whenever the instance is expired (see _forget_follow_ids).
+    _following_ids = None
+    _follower_ids = None
+
+    def following_ids(self):
+        """Set of ids of the users this user follows, loaded once."""
+
+        if self._following_ids is None:
+            self._following_ids = set(db.session.scalars(
+                select(Follows.user_being_followed_id)
+                .where(Follows.user_following_id == self.id)))
+
+        return self._following_ids
+
+    def follower_ids(self):
+        """Set of ids of the users following this user, loaded once."""
 
-class User(db.Model):
+        if self._follower_ids is None:
+            self._follower_ids = set(db.session.scalars(
+                select(Follows.user_following_id)
+                .where(Follows.user_being_followed_id == self.id)))
+
+        return self._follower_ids
+
+    def following_status(self, user_ids):
+        """Which of `user_ids` does this user follow? Returns a set of ids.
+
+        Only looks up the given ids, so a page of user cards costs one small
+        query however many people this user follows.
+        """
+
+        user_ids = list(user_ids)
+
+        if self._following_ids is not None:
+            return self._following_ids.intersection(user_ids)
+
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id,
+                   Follows.user_being_followed_id.in_(user_ids))))
+
+    def is_followed_by(self, other_user):
+        """Is this user followed by `other_user`?"""
+
+        return other_user.id in self.follower_ids()
+
+    def is_following(self, other_user):
+        """Is this user following `other_use`?"""
+
+        return other_user.id in self.following_ids()
+
+
+class User(FollowChecks, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
@@ -94,7 +224,63 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', cascade='all, delete')
+    # Denormalized counters, kept in step by the routes that change them
+    # (see adjust_counts) and repairable with reconcile_counts.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped by every UPDATE of the row, counter adjustments included;
+    # the profile page's ETag/Last-Modified are derived from it.
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=func.now(),
+    )
+
+    # Set when the account is deleted, so it disappears at once; the
+    # delete_user job removes the row and everything of theirs later.
+    deleted = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+    )
+
+    __table_args__ = (
+        # the few users waiting for their delete_user job
+        db.Index('ix_users_deleted', 'id', postgresql_where=deleted),
+    )
+
+    # the database cascades the delete; see the delete_user job for large accounts
+    messages = db.relationship('Message', cascade='all, delete', passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -118,17 +304,92 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
-    def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Atomically add `deltas` to counter columns of `user_ids`.
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        `user_ids` may be a single id, a list of ids or a select of ids, e.g.
+        User.adjust_counts(user.id, followers_count=1).
+        """
 
-    def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        (cls.query
+         .filter(cls.id.in_(user_ids))
+         .update({getattr(cls, col): getattr(cls, col) + delta
+                  for col, delta in deltas.items()},
+                 synchronize_session=False))
+
+    @classmethod
+    def active(cls):
+        """Query of the users whose accounts haven't been deleted."""
+
+        return cls.query.filter(cls.deleted.is_(False))
+
+    @classmethod
+    def select_deleted_ids(cls):
+        """Select of the ids of deleted users still waiting for cleanup."""
+
+        return select(cls.id).where(cls.deleted)
+
+    def release_counts(self):
+        """Take this user out of everyone else's counters before deletion."""
+
+        User.adjust_counts(
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id),
+            followers_count=-1)
+
+        User.adjust_counts(
+            select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == self.id),
+            following_count=-1)
+
+        Message.adjust_likes_count(
+            select(Likes.message_id).where(Likes.user_id == self.id), -1)
+
+        Message.release_likes(select(Message.id).where(Message.user_id == self.id))
+
+    @classmethod
+    def reconcile_counts(cls, user_ids=None):
+        """Recompute every user and message counter from the source tables.
+
+        Given `user_ids`, only those users' counters are checked and
+        message counters are left alone. Returns the number of users whose
+        counters had drifted.
+        """
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        actual = {
+            cls.messages_count: (select(func.count())
+                                 .where(Message.user_id == cls.id)
+                                 .scalar_subquery()),
+            cls.following_count: (select(func.count())
+                                  .where(Follows.user_following_id == cls.id)
+                                  .scalar_subquery()),
+            cls.followers_count: (select(func.count())
+                                  .where(Follows.user_being_followed_id == cls.id)
+                                  .scalar_subquery()),
+            cls.likes_count: (select(func.count())
+                              .where(Likes.user_id == cls.id)
+                              .scalar_subquery()),
+        }
+
+        users = cls.query.filter(db.or_(*(col != value for col, value in actual.items())))
+        if user_ids is not None:
+            users = users.filter(cls.id.in_(user_ids))
+        drifted = users.update(actual, synchronize_session=False)
+        if user_ids is not None:
+            return drifted
+
+        message_likes = (select(func.count())
+                         .where(Likes.message_id == Message.id)
+                         .scalar_subquery())
+        (Message.query
+         .filter(Message.likes_count != message_likes)
+         .update({Message.likes_count: message_likes}, synchronize_session=False))
+
+        return drifted
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +398,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -157,18 +418,35 @@ class User(db.Model):
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
 
-        If can't find matching user (or if password is wrong), returns False.
+        If the stored hash was made at a different cost than the configured
+        one, it is replaced with a fresh hash (the caller commits).
+
+        If can't find matching user (or if password is wrong, or the account
+        was deleted), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted=False).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            if hasher.needs_rehash(user.password):
+                user.password = hasher.hash(password)
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's stored hash?"""
+
+        return hasher.check(self.password, password)
+
+
+@event.listens_for(User, 'expire', raw=True)
+def _forget_follow_ids(state, attrs):
+    """Drop cached follow-id sets along with the rest of the loaded state."""
+
+    state.dict.pop('_following_ids', None)
+    state.dict.pop('_follower_ids', None)
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -188,7 +466,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -197,8 +475,384 @@ class Message(db.Model):
         nullable=False,
     )
 
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', timestamp.desc(), id.desc()),
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def with_authors(cls):
+        """Message query that loads each message's author in the same SELECT.
+
+        Use this for any list that renders msg.user, so a page of N messages
+        doesn't turn into N extra queries for the authors.
+        """
+
+        return cls.query.options(joinedload(cls.user))
+
+    @classmethod
+    def with_active_authors(cls):
+        """with_authors(), less the messages of deleted accounts.
+
+        For lists not already narrowed to one live author; a timeline
+        filters on its own author_id column instead.
+        """
+
+        return cls.with_authors().filter(cls.user_id.not_in(User.select_deleted_ids()))
+
+    @classmethod
+    def adjust_likes_count(cls, message_ids, delta):
+        """Atomically add `delta` to the like count of `message_ids`."""
+
+        if isinstance(message_ids, int):
+            message_ids = [message_ids]
+
+        (cls.query
+         .filter(cls.id.in_(message_ids))
+         .update({cls.likes_count: cls.likes_count + delta},
+                 synchronize_session=False))
+
+    @classmethod
+    def release_likes(cls, message_ids):
+        """Take the likes of `message_ids` out of their likers' counters before deletion.
+
+        Each liker loses one like per message of `message_ids` they liked.
+        `message_ids` may be a list of ids or a select of ids.
+        """
+
+        liked_here = (select(func.count())
+                      .select_from(Likes)
+                      .where(Likes.message_id.in_(message_ids),
+                             Likes.user_id == User.id)
+                      .scalar_subquery())
+
+        (User.query
+         .filter(User.id.in_(select(Likes.user_id).where(Likes.message_id.in_(message_ids))))
+         .update({User.likes_count: User.likes_count - liked_here},
+                 synchronize_session=False))
+
+
+class Timeline(db.Model):
+    """Materialized home timeline: one row per message in a user's feed.
+
+    Rows are written when a message is posted (fan-out on write) and when a
+    user starts following someone (backfill), so the home page only has to
+    read a bounded, pre-sorted slice instead of scanning every message.
+    """
+
+    __tablename__ = 'timelines'
+
+    # Entries kept per user; older ones are trimmed as new ones arrive.
+    MAX_ENTRIES = 800
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_timestamp', 'user_id', timestamp.desc()),
+        # for the ON DELETE CASCADE lookups
+        db.Index('ix_timelines_message_id', 'message_id'),
+        db.Index('ix_timelines_author_id', 'author_id'),
+    )
+
+    @classmethod
+    def fan_out(cls, message, author=True):
+        """Push `message` into its author's and every follower's timeline.
+
+        With `author` false only the followers get it, e.g. when the
+        author's own entry was made by add_own. The message must already be
+        flushed so it has an id and timestamp. Entries already there (from a
+        backfill, or an earlier run of the job) are left alone.
+        """
+
+        followers = (select(Follows.user_following_id)
+                     .where(Follows.user_being_followed_id == message.user_id))
+        if author:
+            followers = union_all(select(literal(message.user_id)), followers)
+        recipients = followers.subquery()
+
+        db.session.execute(
+            insert_or_ignore(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                select(recipients.c[0],
+                       literal(message.id),
+                       literal(message.user_id),
+                       literal(message.timestamp, db.DateTime))))
+
+        cls.trim(select(recipients.c[0]))
+
+    @classmethod
+    def add_own(cls, message):
+        """Put `message` in its author's timeline, so they see it right away."""
+
+        db.session.execute(insert_or_ignore(cls).values(
+            user_id=message.user_id, message_id=message.id,
+            author_id=message.user_id, timestamp=message.timestamp))
+        cls.trim([message.user_id])
+
+    @classmethod
+    def backfill(cls, user_id, followed_id):
+        """Copy `followed_id`'s most recent messages into `user_id`'s timeline."""
+
+        recent = (select(literal(user_id), Message.id, Message.user_id, Message.timestamp)
+                  .where(Message.user_id == followed_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(cls.MAX_ENTRIES))
+
+        db.session.execute(
+            insert_or_ignore(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'], recent))
+
+        cls.trim([user_id])
+
+    @classmethod
+    def prune(cls, user_id, unfollowed_id):
+        """Remove `unfollowed_id`'s messages from `user_id`'s timeline."""
+
+        (cls.query
+         .filter(cls.user_id == user_id, cls.author_id == unfollowed_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def trim(cls, user_ids):
+        """Drop entries beyond MAX_ENTRIES for each of `user_ids`.
+
+        `user_ids` may be a list of ids or a select of ids. Each user's
+        first entry past the cap is found by walking the (user_id,
+        timestamp) index, and only it and the entries older than it are
+        touched, so a timeline at or under the cap costs one short scan.
+        """
+
+        readers = select(User.id.label('user_id')).where(User.id.in_(user_ids)).subquery()
+        first_dropped = (select(cls.message_id)
+                         .where(cls.user_id == readers.c.user_id)
+                         .order_by(cls.timestamp.desc(), cls.message_id.desc())
+                         .offset(cls.MAX_ENTRIES)
+                         .limit(1)
+                         .scalar_subquery())
+        cutoffs = select(readers.c.user_id, first_dropped.label('message_id')).subquery()
+
+        cutoff = aliased(cls)
+        overflow = (select(cls.user_id, cls.message_id)
+                    .join(cutoff, cutoff.user_id == cls.user_id)
+                    .join(cutoffs, and_(cutoffs.c.user_id == cutoff.user_id,
+                                        cutoffs.c.message_id == cutoff.message_id))
+                    .where(tuple_(cls.timestamp, cls.message_id)
+                           <= tuple_(cutoff.timestamp, cutoff.message_id)))
+
+        (cls.query
+         .filter(tuple_(cls.user_id, cls.message_id).in_(overflow))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, user_ids=None):
+        """Recompute every timeline from scratch (e.g. after a bulk load).
+
+        Given `user_ids`, only those users' timelines are rebuilt.
+        """
+
+        stale = cls.query
+        if user_ids is not None:
+            stale = stale.filter(cls.user_id.in_(user_ids))
+        stale.delete(synchronize_session=False)
+
+        audience = union_all(
+            select(Follows.user_following_id.label('user_id'),
+                   Follows.user_being_followed_id.label('author_id')),
+            select(User.id, User.id),
+        ).subquery()
+        readers = audience.c.user_id.in_(user_ids) if user_ids is not None else true()
+
+        ranked = (select(audience.c.user_id,
+                         Message.id.label('message_id'),
+                         Message.user_id.label('author_id'),
+                         Message.timestamp,
+                         func.row_number().over(
+                             partition_by=audience.c.user_id,
+                             order_by=(Message.timestamp.desc(), Message.id.desc()),
+                         ).label('position'))
+                  .join(Message, Message.user_id == audience.c.author_id)
+                  .where(readers)
+                  .subquery())
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                select(ranked.c.user_id, ranked.c.message_id,
+                       ranked.c.author_id, ranked.c.timestamp)
+                .where(ranked.c.position <= cls.MAX_ENTRIES)))
+
+    @classmethod
+    def rebuild_in_batches(cls, batch_size=1000):
+        """Rebuild every timeline, committing each `batch_size` users.
+
+        Safe on a live site: a reader's timeline is only missing for the
+        length of its own batch. Returns the number of users rebuilt.
+        """
+
+        rebuilt = last_id = 0
+        while True:
+            user_ids = db.session.scalars(
+                select(User.id).where(User.id > last_id)
+                .order_by(User.id).limit(batch_size)).all()
+            if not user_ids:
+                return rebuilt
+            cls.rebuild(user_ids)
+            db.session.commit()
+            rebuilt += len(user_ids)
+            last_id = user_ids[-1]
+
+
+class Recommendation(db.Model):
+    """Precomputed "who to follow" suggestion, written by recommendations.py."""
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    recommended_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # for the ON DELETE CASCADE lookup
+        db.Index('ix_recommendations_recommended_id', 'recommended_id'),
+    )
+
+    @classmethod
+    def select_for(cls, user_id):
+        """Select of the users suggested to `user_id`, best first."""
+
+        return (select(User)
+                .join(cls, cls.recommended_id == User.id)
+                .where(cls.user_id == user_id, User.deleted.is_(False))
+                .order_by(cls.score.desc(), cls.recommended_id))
+
+
+class Job(db.Model):
+    """Unit of background work, queued by the routes and run by jobs.py workers."""
+
+    __tablename__ = 'jobs'
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # name of the handler in jobs.HANDLERS, called with payload as keyword arguments
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default=QUEUED,
+        server_default=QUEUED,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+        server_default='5',
+    )
+
+    # not picked up before this time; pushed back after each failed attempt
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind} {self.status}, attempt {self.attempts}>"
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -208,3 +862,4 @@ def connect_db(app):
     db.app = app
     app.app_context().push()
     db.init_app(app)
+    hasher.init_app(app)
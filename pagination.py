@@ -0,0 +1,73 @@
+"""Keyset (cursor) pagination for message lists.
+
+Pages are ordered newest first on (timestamp, id). The cursor for the next
+page encodes the last row of the current page, so fetching an older page is
+an index range scan no matter how deep the reader has scrolled -- unlike
+OFFSET, which has to walk past every skipped row.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from models import Message
+
+PER_PAGE = 100
+
+
+def encode_cursor(timestamp, row_id):
+    """Turn the sort key of a row into an opaque `before=` cursor string."""
+
+    return f"{timestamp.isoformat()}_{row_id}"
+
+
+def decode_cursor(cursor):
+    """Parse a cursor made by `encode_cursor` into (timestamp, id).
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    timestamp, _, row_id = cursor.rpartition('_')
+    return datetime.fromisoformat(timestamp), int(row_id)
+
+
+def paginate(query, before=None, key=(Message.timestamp, Message.id), per_page=None):
+    """Return (items, next_cursor) for the page of `query` older than `before`.
+
+    `key` is the (timestamp, id) column pair the query is ordered on; it
+    defaults to the message's own columns but can point at a denormalized
+    copy (e.g. Timeline) so the sort uses that table's index. `next_cursor`
+    is None on the last page.
+    """
+
+    per_page = per_page or PER_PAGE
+    return page_result(page_query(query, before, key, per_page).all(), per_page)
+
+
+def page_query(query, before=None, key=(Message.timestamp, Message.id), per_page=None):
+    """`query` (a Query or a select) narrowed to one page, plus one row to spare.
+
+    Run it and pass the rows to `page_result`; `paginate` does both.
+    """
+
+    per_page = per_page or PER_PAGE
+    timestamp_col, id_col = key
+
+    if before:
+        query = query.filter(tuple_(timestamp_col, id_col) < decode_cursor(before))
+
+    return (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1))
+
+
+def page_result(items, per_page=None):
+    """Split the rows of a `page_query` into (items, next_cursor)."""
+
+    per_page = per_page or PER_PAGE
+    if len(items) <= per_page:
+        return items, None
+
+    items = items[:per_page]
+    last = items[-1]
+    return items, encode_cursor(last.timestamp, last.id)
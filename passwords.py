@@ -0,0 +1,74 @@
+"""Password hashing and checking, optionally in a pool of worker processes.
+
+A bcrypt hash at cost 12 takes a few hundred milliseconds of CPU. Done
+inline, a burst of logins/signups ties up every request worker; handing
+the work to a process pool spreads it over all cores while the web workers
+just wait on the result.
+
+Configure with BCRYPT_LOG_ROUNDS (the cost for new hashes) and
+PASSWORD_HASH_WORKERS (pool size; 0 hashes inline, which tests use).
+
+The pool starts its workers with the spawn method, which re-imports the
+main module in each one. A script that hashes with workers enabled must
+keep its top-level code under `if __name__ == '__main__':`, or run with
+PASSWORD_HASH_WORKERS=0.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('UTF-8'), bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password.encode('UTF-8'), hashed.encode('UTF-8'))
+
+
+class PasswordHasher:
+    """bcrypt hashing that runs inline or on a process pool."""
+
+    def __init__(self, rounds=12, workers=0):
+        self.rounds = rounds
+        self.workers = workers
+        self._pool = None
+
+    def init_app(self, app):
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = app.config.setdefault('PASSWORD_HASH_WORKERS', self.workers)
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        if self._pool is None:
+            # spawn, not fork: the parent holds DB connections and threads
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'))
+
+        return self._pool.submit(fn, *args).result()
+
+    def hash(self, password):
+        """Hash `password` at the configured cost; returns the hash as text."""
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match the stored `hashed`?"""
+
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than the configured one?"""
+
+        # bcrypt hashes look like $2b$12$<salt+digest>
+        return int(hashed.split('$')[2]) != self.rounds
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
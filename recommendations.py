@@ -0,0 +1,128 @@
+"""Batch job computing "who to follow" suggestions from the follows graph.
+
+For each user u and candidate w the score is
+
+    FRIENDS_OF_FRIENDS_WEIGHT * (people u follows who follow w)
+  + COMMON_FOLLOWERS_WEIGHT   * (people who follow both u and w)
+
+With A the follows adjacency matrix (A[x, y] = 1 when x follows y) those
+are the rows of A @ A and A.T @ A, computed as sparse matrix products a
+chunk of users at a time. The best TOP_K candidates per user, excluding
+themselves and anyone they already follow, replace their rows in the
+recommendations table in one transaction. The home page only reads that
+table.
+
+Run it nightly for everyone, or for just the users whose follows changed:
+
+    python recommendations.py
+    python recommendations.py --user 17 --user 42
+"""
+
+import argparse
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, insert, select
+
+from models import db, Follows, Recommendation
+
+TOP_K = 20
+FRIENDS_OF_FRIENDS_WEIGHT = 1.0
+COMMON_FOLLOWERS_WEIGHT = 0.5
+
+# Users scored per sparse product; bounds the size of the intermediate matrices
+CHUNK_ROWS = 2000
+
+
+def load_graph():
+    """(ids, A): sorted user ids with follows, and the CSR adjacency matrix over them."""
+
+    edges = np.array(db.session.execute(
+        select(Follows.user_following_id, Follows.user_being_followed_id)).all(),
+        dtype=np.int64).reshape(-1, 2)
+
+    ids = np.unique(edges)
+    follower = np.searchsorted(ids, edges[:, 0])
+    followed = np.searchsorted(ids, edges[:, 1])
+    A = sparse.csr_matrix((np.ones(len(edges), dtype=np.float32), (follower, followed)),
+                          shape=(len(ids), len(ids)))
+    return ids, A
+
+
+def score_rows(A, A_T, rows):
+    """Sparse matrix of candidate scores for the users at `rows`."""
+
+    scores = (FRIENDS_OF_FRIENDS_WEIGHT * (A[rows] @ A)
+              + COMMON_FOLLOWERS_WEIGHT * (A_T[rows] @ A)).tocsr()
+
+    # drop everyone already followed, and each user themselves
+    own = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (np.arange(len(rows)), rows)),
+                            shape=scores.shape)
+    scores = (scores - scores.multiply((A[rows] + own) > 0)).tocsr()
+    scores.eliminate_zeros()
+    return scores
+
+
+def top_k(scores, k):
+    """For each row of a CSR matrix, [(column, score)] of its k best entries.
+
+    Best first; ties go to the lower column.
+    """
+
+    result = []
+    for i in range(scores.shape[0]):
+        start, end = scores.indptr[i], scores.indptr[i + 1]
+        columns, values = scores.indices[start:end], scores.data[start:end]
+        order = np.lexsort((columns, -values))[:k]
+        result.append(list(zip(columns[order].tolist(), values[order].tolist())))
+    return result
+
+
+def refresh(user_ids=None, k=TOP_K):
+    """Recompute the suggestions of `user_ids` (default: everyone).
+
+    Returns the number of suggestion rows written.
+    """
+
+    ids, A = load_graph()
+    A_T = A.T.tocsr()
+
+    if user_ids is None:
+        db.session.execute(delete(Recommendation))
+        targets = np.arange(len(ids))
+    else:
+        user_ids = np.unique(np.asarray(list(user_ids), dtype=np.int64))
+        db.session.execute(delete(Recommendation)
+                           .where(Recommendation.user_id.in_(user_ids.tolist())))
+        # users who don't follow and aren't followed have no suggestions
+        targets = np.searchsorted(ids, user_ids[np.isin(user_ids, ids)])
+
+    written = 0
+    for start in range(0, len(targets), CHUNK_ROWS):
+        rows = targets[start:start + CHUNK_ROWS]
+        batch = [dict(user_id=int(ids[row]), recommended_id=int(ids[column]), score=score)
+                 for row, best in zip(rows, top_k(score_rows(A, A_T, rows), k))
+                 for column, score in best]
+        if batch:
+            db.session.execute(insert(Recommendation), batch)
+            written += len(batch)
+
+    db.session.commit()
+    return written
+
+
+def main(argv=None):
+    from app import app
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--user', type=int, action='append', dest='user_ids', metavar='ID',
+                        help="only refresh this user (repeatable; default: everyone)")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        written = refresh(args.user_ids)
+    print(f"wrote {written} suggestions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Read replicas for the read-heavy pages.
+
+GET and HEAD requests to the endpoints a ReplicaRouter is given run their
+queries on a read replica, taking turns across SQLALCHEMY_REPLICA_URIS.
+Every other request uses the primary, and so does any flush or INSERT,
+UPDATE or DELETE, even in a routed request.
+
+Replicas run a little behind the primary. So that a user sees their own
+change on the page a form redirects to, each POST (or other unsafe
+request) stamps the session cookie, and that browser reads from the
+primary for the next REPLICA_STICKY_SECONDS.
+
+Anything cached beyond the request (the user cache, the social graph) is
+loaded from the primary even in a routed request; see primary_bind().
+
+With no replica URIs configured, everything uses the primary.
+"""
+
+import itertools
+from contextvars import ContextVar
+from time import time
+
+from flask import current_app, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+
+SAFE_METHODS = ('GET', 'HEAD')
+WROTE_AT_KEY = 'db_wrote_at'
+
+# Replica engine serving the request in progress, if any
+_current = ContextVar('replica_engine', default=None)
+
+
+def primary_bind():
+    """Session bind_arguments that send a query to the primary, routed or not.
+
+    For reads that fill a cross-request cache: a lagging replica's rows
+    would keep being served after the sticky window has sent that user back
+    to the primary.
+    """
+
+    return {'bind': current_app.extensions['sqlalchemy'].engine}
+
+
+class RoutingSession(Session):
+    """db.session class that runs the reads of a routed request on its replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = _current.get()
+        if (replica is not None and bind is None and not self._flushing
+                and not getattr(clause, 'is_dml', False)):
+            return replica
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """Flask extension picking the database that serves each request."""
+
+    def __init__(self, app=None, endpoints=()):
+        self.endpoints = set(endpoints)
+        self._engines = None
+        self._turn = itertools.count()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._end_request)
+
+    def engines(self):
+        """Engines of the configured replicas, made on first use.
+
+        They take the same SQLALCHEMY_ENGINE_OPTIONS (pool size etc.) as
+        the primary.
+        """
+
+        if self._engines is None:
+            options = current_app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+            self._engines = [create_engine(uri, **options)
+                             for uri in current_app.config['SQLALCHEMY_REPLICA_URIS']]
+        return self._engines
+
+    def dispose(self):
+        """Close the replicas' connections; the engines are remade on next use."""
+
+        for engine in self._engines or ():
+            engine.dispose()
+        self._engines = None
+
+    def pools(self):
+        """{name: Pool} of the replica engines."""
+
+        return {f'replica-{i}': engine.pool for i, engine in enumerate(self.engines())}
+
+    def pick(self, choices):
+        """The next of `choices`, round robin."""
+
+        return choices[next(self._turn) % len(choices)]
+
+    def wants_replica(self):
+        """May the current request read from a replica?"""
+
+        if request.endpoint not in self.endpoints or request.method not in SAFE_METHODS:
+            return False
+
+        wrote_at = session.get(WROTE_AT_KEY)
+        return (wrote_at is None
+                or wrote_at < time() - current_app.config['REPLICA_STICKY_SECONDS'])
+
+    def _start_request(self):
+        engines = self.engines()
+        _current.set(self.pick(engines) if engines and self.wants_replica() else None)
+
+    def _finish_request(self, response):
+        if request.method not in SAFE_METHODS and self.engines():
+            session[WROTE_AT_KEY] = time()
+        return response
+
+    def _end_request(self, exc):
+        if _current.get() is not None:
+            # a routed request only reads: hand the replica connection back,
+            # and don't let later work on the primary see the replica's rows
+            current_app.extensions['sqlalchemy'].session.rollback()
+        _current.set(None)
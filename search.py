@@ -0,0 +1,384 @@
+"""Search over users and messages.
+
+On Postgres with the pg_trgm extension, substring matches on username (and
+optionally bio/location) are answered from trigram GIN indexes and ranked
+by trigram similarity, so a leading-wildcard search doesn't scan the users
+table. Elsewhere -- SQLite, or a Postgres without pg_trgm -- an in-process
+trigram index built from the users table stands in.
+
+Messages get full-text search: a GIN index over to_tsvector(text) on
+Postgres, and an in-process inverted index everywhere else.
+"""
+
+import math
+import re
+from collections import Counter, defaultdict
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import Numeric, cast, event, func, or_, select, text, tuple_
+from sqlalchemy.orm import joinedload
+
+from models import db, User, Message
+
+PER_PAGE = 24
+
+# Columns a search may cover; username is always searched.
+SEARCH_FIELDS = ('username', 'bio', 'location')
+
+
+def has_trigram_support(bind):
+    """Is pg_trgm installed in this connection's database?"""
+
+    if bind.dialect.name != 'postgresql':
+        return False
+
+    return bind.execute(text(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+
+
+def _create_trigram_indexes(target, bind, **kw):
+    # as migration 0007 does, for databases made by create_all()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    available = bind.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first()
+    if available:
+        bind.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for field in SEARCH_FIELDS:
+            bind.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_users_{field}_trgm "
+                f"ON users USING gin ({field} gin_trgm_ops)"))
+
+
+event.listen(User.__table__, 'after_create', _create_trigram_indexes)
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in `term` so it matches literally."""
+
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def trigrams(value):
+    """Set of lower-cased, space-padded trigrams of `value`, like pg_trgm."""
+
+    grams = set()
+    for word in (value or '').lower().split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """Small in-process trigram index: document id -> searchable text.
+
+    Candidates for a substring search are the documents sharing every
+    trigram of the term, confirmed with a plain substring test and ranked by
+    trigram overlap. Built from the database on first use and kept current
+    with `add`/`remove`.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._docs = {}
+        self._postings = defaultdict(set)
+
+    def add(self, doc_id, value):
+        self.remove(doc_id)
+        value = value or ''
+        self._docs[doc_id] = value.lower()
+        for gram in trigrams(value):
+            self._postings[gram].add(doc_id)
+
+    def remove(self, doc_id):
+        value = self._docs.pop(doc_id, None)
+        if value is None:
+            return
+        for gram in trigrams(value):
+            self._postings[gram].discard(doc_id)
+
+    def clear(self):
+        self.loaded = False
+        self._docs.clear()
+        self._postings.clear()
+
+    def search(self, term):
+        """Return [(score, doc_id)] for docs containing `term`, best first."""
+
+        term = term.lower()
+        # Inner trigrams only: a substring needn't start or end a word.
+        grams = {gram for gram in trigrams(term) if ' ' not in gram}
+
+        if grams:
+            candidates = set.intersection(*(self._postings.get(gram, set()) for gram in grams))
+        else:
+            candidates = self._docs.keys()
+
+        query_grams = trigrams(term)
+        results = []
+        for doc_id in candidates:
+            value = self._docs[doc_id]
+            if term in value:
+                doc_grams = trigrams(value)
+                score = len(query_grams & doc_grams) / len(query_grams | doc_grams)
+                results.append((score, doc_id))
+
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return results
+
+
+class UserSearch:
+    """Ranked, paged user search backed by pg_trgm or a TrigramIndex."""
+
+    def __init__(self):
+        # fallback indexes: usernames alone, and username + bio + location
+        self.usernames = TrigramIndex()
+        self.profiles = TrigramIndex()
+        self._use_trigrams = None
+
+    def uses_trigrams(self):
+        if self._use_trigrams is None:
+            self._use_trigrams = has_trigram_support(db.session.connection())
+        return self._use_trigrams
+
+    @staticmethod
+    def _document(user):
+        return ' '.join(getattr(user, field) or '' for field in SEARCH_FIELDS)
+
+    def index_user(self, user):
+        """Reflect a new or edited user in the fallback indexes."""
+
+        if self.usernames.loaded:
+            self.usernames.add(user.id, user.username)
+            self.profiles.add(user.id, self._document(user))
+
+    def remove_user(self, user_id):
+        if self.usernames.loaded:
+            self.usernames.remove(user_id)
+            self.profiles.remove(user_id)
+
+    def _load_fallback(self):
+        self.usernames.clear()
+        self.profiles.clear()
+        for user in db.session.execute(
+                select(User.id, User.username, User.bio, User.location)):
+            self.usernames.add(user.id, user.username)
+            self.profiles.add(user.id, self._document(user))
+        self.usernames.loaded = self.profiles.loaded = True
+
+    def clear(self):
+        """Forget the fallback indexes; they reload from the database on next use."""
+
+        self.usernames.clear()
+        self.profiles.clear()
+
+    def search(self, term, all_fields=False, page=1, per_page=PER_PAGE):
+        """Return (users, has_more) for page `page` of matches for `term`.
+
+        Matches `term` anywhere in the username, or also in bio and location
+        when `all_fields` is set. Best matches come first.
+        """
+
+        offset = (page - 1) * per_page
+        fields = SEARCH_FIELDS if all_fields else ('username',)
+
+        if self.uses_trigrams():
+            columns = [getattr(User, field) for field in fields]
+            pattern = f"%{escape_like(term)}%"
+            score = func.greatest(*(func.coalesce(func.word_similarity(term, col), 0)
+                                    for col in columns))
+            users = (User.active()
+                     .filter(or_(*(col.ilike(pattern, escape='\\') for col in columns)))
+                     .order_by(score.desc(), User.id)
+                     .offset(offset)
+                     .limit(per_page + 1)
+                     .all())
+            return users[:per_page], len(users) > per_page
+
+        if not self.usernames.loaded:
+            self._load_fallback()
+
+        index = self.profiles if all_fields else self.usernames
+        ids = [doc_id for _, doc_id in index.search(term)[offset:offset + per_page + 1]]
+
+        by_id = {user.id: user for user in User.active().filter(User.id.in_(ids))}
+        users = [by_id[user_id] for user_id in ids if user_id in by_id]
+        return users[:per_page], len(users) > per_page
+
+
+##############################################################################
+# Message full-text search
+
+TS_CONFIG = 'english'
+
+MESSAGES_PER_PAGE = 20
+
+
+def _create_message_text_index(target, bind, **kw):
+    if bind.dialect.name == 'postgresql':
+        bind.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_messages_text_fts "
+            f"ON messages USING gin (to_tsvector('{TS_CONFIG}', text))"))
+
+
+event.listen(Message.__table__, 'after_create', _create_message_text_index)
+
+
+def tokenize(value):
+    """Lower-cased word tokens of `value`."""
+
+    return re.findall(r"\w+", (value or '').lower())
+
+
+def encode_search_cursor(score, message_id):
+    return f"{score}_{message_id}"
+
+
+def decode_search_cursor(cursor):
+    """Parse a cursor into (score, id); raises ValueError if malformed."""
+
+    score, _, message_id = cursor.rpartition('_')
+    try:
+        score = Decimal(score)
+    except InvalidOperation:
+        raise ValueError(f"bad search cursor score: {score!r}") from None
+    if not score.is_finite():
+        raise ValueError(f"bad search cursor score: {score!r}")
+
+    return score, int(message_id)
+
+
+class InvertedIndex:
+    """In-process inverted index: token -> {document id: term frequency}.
+
+    Matches contain every query token; they're ranked by a tf-idf sum.
+    Built from the database on first use and kept current with
+    `add`/`remove`.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._postings = defaultdict(dict)
+        self._doc_tokens = {}
+
+    def add(self, doc_id, value):
+        self.remove(doc_id)
+        counts = Counter(tokenize(value))
+        self._doc_tokens[doc_id] = list(counts)
+        for token, count in counts.items():
+            self._postings[token][doc_id] = count
+
+    def remove(self, doc_id):
+        for token in self._doc_tokens.pop(doc_id, ()):
+            postings = self._postings[token]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self._postings[token]
+
+    def clear(self):
+        self.loaded = False
+        self._postings.clear()
+        self._doc_tokens.clear()
+
+    def search(self, query):
+        """Return [(score, doc_id)] for docs with every token of `query`.
+
+        Ordered best first, ties broken by newest (highest) id.
+        """
+
+        tokens = set(tokenize(query))
+        if not tokens:
+            return []
+
+        postings = [self._postings.get(token, {}) for token in tokens]
+        postings.sort(key=len)
+        matches = set(postings[0]).intersection(*postings[1:])
+
+        total = len(self._doc_tokens)
+        results = []
+        for doc_id in matches:
+            score = sum((1 + math.log(p[doc_id])) * math.log(1 + total / len(p))
+                        for p in postings)
+            results.append((Decimal(f"{score:.6f}"), doc_id))
+
+        results.sort(reverse=True)
+        return results
+
+
+class MessageSearch:
+    """Ranked, cursor-paged message search on Postgres FTS or an InvertedIndex."""
+
+    def __init__(self):
+        self.fallback = InvertedIndex()
+
+    @staticmethod
+    def uses_postgres():
+        return db.session.connection().dialect.name == 'postgresql'
+
+    def index_message(self, message):
+        """Reflect a new message in the fallback index."""
+
+        if self.fallback.loaded:
+            self.fallback.add(message.id, message.text)
+
+    def remove_message(self, message_id):
+        if self.fallback.loaded:
+            self.fallback.remove(message_id)
+
+    def clear(self):
+        """Forget the fallback index; it reloads from the database on next use."""
+
+        self.fallback.clear()
+
+    def _load_fallback(self):
+        self.fallback.clear()
+        for message_id, message_text in db.session.execute(select(Message.id, Message.text)):
+            self.fallback.add(message_id, message_text)
+        self.fallback.loaded = True
+
+    def search(self, query, before=None, per_page=None):
+        """Return (messages, next_cursor) for the page of matches after `before`.
+
+        Best matches come first. Raises ValueError for a malformed cursor.
+        """
+
+        per_page = per_page or MESSAGES_PER_PAGE
+        after = decode_search_cursor(before) if before else None
+
+        if self.uses_postgres():
+            document = func.to_tsvector(TS_CONFIG, Message.text)
+            # ranks are compared as numeric so cursors round-trip exactly
+            rank = cast(func.ts_rank(document, func.websearch_to_tsquery(TS_CONFIG, query)),
+                        Numeric(12, 6))
+            page_query = (db.session.query(Message, rank)
+                          .options(joinedload(Message.user))
+                          .filter(document.op('@@')(func.websearch_to_tsquery(TS_CONFIG, query)),
+                                  Message.user_id.not_in(User.select_deleted_ids())))
+            if after:
+                page_query = page_query.filter(tuple_(rank, Message.id) < after)
+            rows = (page_query
+                    .order_by(rank.desc(), Message.id.desc())
+                    .limit(per_page + 1)
+                    .all())
+            hits = [(score, message) for message, score in rows]
+
+        else:
+            if not self.fallback.loaded:
+                self._load_fallback()
+
+            ranked = self.fallback.search(query)
+            if after:
+                ranked = [hit for hit in ranked if hit < after]
+            ranked = ranked[:per_page + 1]
+
+            by_id = {message.id: message for message in
+                     Message.with_active_authors().filter(Message.id.in_([i for _, i in ranked]))}
+            hits = [(score, by_id[i]) for score, i in ranked if i in by_id]
+
+        if len(hits) <= per_page:
+            return [message for _, message in hits], None
+
+        hits = hits[:per_page]
+        score, last = hits[-1]
+        return [message for _, message in hits], encode_search_cursor(score, last.id)
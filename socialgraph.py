@@ -0,0 +1,226 @@
+"""In-process cache of the follow graph.
+
+Each user's followers and following are kept as a sorted array of ids
+(4 bytes per edge), loaded with one query the first time they're asked for
+and held in an LRU. Membership is a binary search and intersections are a
+merge of two sorted arrays, so "do I follow them?", mutual follows and
+"followed by people you follow" are answered without touching the database
+or loading User objects.
+
+The routes that change follows (add_follow, stop_following, delete_user)
+apply their change to whatever lists are cached. As with the user cache,
+changes made by another worker process are picked up once the entry
+expires after `ttl` seconds.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy import select
+
+from models import db, Follows
+from replicas import primary_bind
+
+FOLLOWERS = 'followers'
+FOLLOWING = 'following'
+
+# For each direction: (column holding the user asked about, column holding their neighbours)
+COLUMNS = {
+    FOLLOWERS: (Follows.user_being_followed_id, Follows.user_following_id),
+    FOLLOWING: (Follows.user_following_id, Follows.user_being_followed_id),
+}
+
+
+def select_neighbours(kind, user_id):
+    """Select of the ids in `user_id`'s `kind` list, in id order."""
+
+    user_col, neighbour_col = COLUMNS[kind]
+    return select(neighbour_col).where(user_col == user_id).order_by(neighbour_col)
+
+
+class AdjacencyList:
+    """Sorted, duplicate-free array of user ids.
+
+    Never changed in place: updates make a copy, so a reader holding a list
+    isn't disturbed by a follow in another thread.
+    """
+
+    __slots__ = ('ids',)
+
+    def __init__(self, ids=()):
+        self.ids = array('i', sorted(set(ids)))
+
+    def __contains__(self, user_id):
+        i = bisect_left(self.ids, user_id)
+        return i < len(self.ids) and self.ids[i] == user_id
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __repr__(self):
+        return f"<AdjacencyList {list(self.ids)}>"
+
+    def with_id(self, user_id):
+        """A copy of this list with `user_id` added."""
+
+        if user_id in self:
+            return self
+        copy = AdjacencyList()
+        copy.ids = array('i', self.ids)
+        copy.ids.insert(bisect_left(self.ids, user_id), user_id)
+        return copy
+
+    def without(self, user_id):
+        """A copy of this list with `user_id` removed."""
+
+        if user_id not in self:
+            return self
+        copy = AdjacencyList()
+        copy.ids = array('i', self.ids)
+        del copy.ids[bisect_left(self.ids, user_id)]
+        return copy
+
+    def intersection(self, other):
+        """Ids in both lists, in order. `other` may be any iterable of ids."""
+
+        if not isinstance(other, AdjacencyList):
+            return [user_id for user_id in sorted(set(other)) if user_id in self]
+
+        a, b = self.ids, other.ids
+        i = j = 0
+        result = []
+        while i < len(a) and j < len(b):
+            if a[i] < b[j]:
+                i += 1
+            elif a[i] > b[j]:
+                j += 1
+            else:
+                result.append(a[i])
+                i += 1
+                j += 1
+        return result
+
+
+class SocialGraph:
+    """LRU of (direction, user id) -> AdjacencyList, entries expiring after `ttl` seconds."""
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    # Loading
+
+    def peek(self, kind, user_id):
+        """The cached `kind` list of `user_id`, or None; never queries."""
+
+        with self._lock:
+            entry = self._entries.get((kind, user_id))
+            if entry and entry[0] > monotonic():
+                self._entries.move_to_end((kind, user_id))
+                return entry[1]
+
+        return None
+
+    def put(self, kind, user_id, ids):
+        """Cache `ids` as `user_id`'s `kind` list; returns the AdjacencyList."""
+
+        neighbours = AdjacencyList(ids)
+        with self._lock:
+            self._entries[(kind, user_id)] = (monotonic() + self.ttl, neighbours)
+            self._entries.move_to_end((kind, user_id))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return neighbours
+
+    def get(self, kind, user_id):
+        neighbours = self.peek(kind, user_id)
+        if neighbours is None:
+            neighbours = self.put(kind, user_id,
+                                  db.session.scalars(select_neighbours(kind, user_id),
+                                                     bind_arguments=primary_bind()))
+        return neighbours
+
+    def followers(self, user_id):
+        """AdjacencyList of the users following `user_id`."""
+
+        return self.get(FOLLOWERS, user_id)
+
+    def following(self, user_id):
+        """AdjacencyList of the users `user_id` follows."""
+
+        return self.get(FOLLOWING, user_id)
+
+    # Queries
+
+    def is_following(self, user_id, other_id):
+        return other_id in self.following(user_id)
+
+    def followers_count(self, user_id):
+        return len(self.followers(user_id))
+
+    def following_count(self, user_id):
+        return len(self.following(user_id))
+
+    def mutuals(self, user_id):
+        """Ids of the users who follow `user_id` and are followed back."""
+
+        return self.following(user_id).intersection(self.followers(user_id))
+
+    def common_following(self, user_id, other_id):
+        """Ids followed by both users."""
+
+        return self.following(user_id).intersection(self.following(other_id))
+
+    def common_followers(self, user_id, other_id):
+        """Ids following both users."""
+
+        return self.followers(user_id).intersection(self.followers(other_id))
+
+    # Updates
+
+    def _update(self, kind, user_id, change):
+        """Apply `change` to the cached `kind` list of `user_id`, if there is one."""
+
+        entry = self._entries.get((kind, user_id))
+        if entry:
+            self._entries[(kind, user_id)] = (entry[0], change(entry[1]))
+
+    def follow(self, user_id, followed_id):
+        """Record that `user_id` now follows `followed_id`."""
+
+        with self._lock:
+            self._update(FOLLOWING, user_id, lambda ids: ids.with_id(followed_id))
+            self._update(FOLLOWERS, followed_id, lambda ids: ids.with_id(user_id))
+
+    def unfollow(self, user_id, followed_id):
+        """Record that `user_id` no longer follows `followed_id`."""
+
+        with self._lock:
+            self._update(FOLLOWING, user_id, lambda ids: ids.without(followed_id))
+            self._update(FOLLOWERS, followed_id, lambda ids: ids.without(user_id))
+
+    def remove_user(self, user_id):
+        """Forget `user_id`, including their place in everyone else's lists."""
+
+        with self._lock:
+            self._entries.pop((FOLLOWERS, user_id), None)
+            self._entries.pop((FOLLOWING, user_id), None)
+            for key, (expires, neighbours) in list(self._entries.items()):
+                if user_id in neighbours:
+                    self._entries[key] = (expires, neighbours.without(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,165 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, Follows, Message, Timeline, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+
+# must import after setting database
+from app import app, CURR_USER_KEY, social_graph, user_cache
+import api
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class APITestCase(TestCase):
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+
+        self.users = [User.signup(f"user{i}", f"user{i}@email.com", "password", None)
+                      for i in range(6)]
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+        main = self.ids[0]
+
+        # everyone else follows user0; user0 follows user1
+        for other in self.ids[1:]:
+            db.session.add(Follows(user_being_followed_id=main, user_following_id=other))
+        db.session.add(Follows(user_being_followed_id=self.ids[1], user_following_id=main))
+
+        start = datetime(2023, 1, 1)
+        for i in range(5):
+            db.session.add(Message(text=f"message {i}", user_id=self.ids[1],
+                                   timestamp=start + timedelta(minutes=i)))
+        db.session.commit()
+        Timeline.rebuild()
+        User.reconcile_counts()
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        return super().tearDown()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_user_detail(self):
+        resp = self.client.get(f"/api/v1/users/{self.ids[0]}")
+
+        self.assertEqual(resp.status_code, 200)
+        user = resp.json['user']
+        self.assertEqual(user['username'], "user0")
+        self.assertEqual(user['followers_count'], 5)
+        self.assertEqual(user['following_count'], 1)
+        self.assertNotIn('password', user)
+        self.assertNotIn('email', user)
+
+    def test_not_found(self):
+        resp = self.client.get("/api/v1/users/99999")
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn('error', resp.json)
+
+    def test_user_messages_paged(self):
+        url = f"/api/v1/users/{self.ids[1]}/messages"
+        first = self.client.get(url, query_string={'limit': 3}).json
+
+        self.assertEqual([m['text'] for m in first['messages']],
+                         ["message 4", "message 3", "message 2"])
+        self.assertEqual(first['messages'][0]['user']['username'], "user1")
+        self.assertEqual(first['messages'][0]['timestamp'], "2023-01-01T00:04:00Z")
+
+        second = self.client.get(url, query_string={'limit': 3, 'before': first['next']}).json
+        self.assertEqual([m['text'] for m in second['messages']], ["message 1", "message 0"])
+        self.assertIsNone(second['next'])
+
+    def test_bad_arguments(self):
+        url = f"/api/v1/users/{self.ids[1]}/messages"
+
+        self.assertEqual(self.client.get(url, query_string={'before': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(url, query_string={'limit': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(url, query_string={'limit': 0}).status_code, 400)
+
+    def test_message_detail(self):
+        message = Message.query.first()
+        resp = self.client.get(f"/api/v1/messages/{message.id}")
+
+        self.assertEqual(resp.json['message']['text'], message.text)
+        self.assertEqual(self.client.get("/api/v1/messages/99999").status_code, 404)
+
+    def test_timeline(self):
+        self.assertEqual(self.client.get("/api/v1/timeline").status_code, 401)
+
+        self.login(self.ids[0])
+        resp = self.client.get("/api/v1/timeline", query_string={'limit': 2})
+
+        self.assertEqual([m['text'] for m in resp.json['messages']], ["message 4", "message 3"])
+        self.assertIsNotNone(resp.json['next'])
+
+    def test_followers_streamed(self):
+        url = f"/api/v1/users/{self.ids[0]}/followers"
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+        self.login(self.ids[0])
+        # small batches, so the stream takes several queries
+        with patch.object(api, 'STREAM_BATCH', 2):
+            resp = self.client.get(url)
+
+            self.assertTrue(resp.is_streamed)
+            body = resp.json
+
+        self.assertEqual([u['id'] for u in body['users']], self.ids[1:])
+        self.assertEqual(set(body['users'][0]), {'id', 'username', 'image_url'})
+        self.assertIsNone(body['next'])
+
+    def test_followers_limit_and_after(self):
+        url = f"/api/v1/users/{self.ids[0]}/followers"
+        self.login(self.ids[0])
+
+        first = self.client.get(url, query_string={'limit': 3}).json
+        self.assertEqual([u['id'] for u in first['users']], self.ids[1:4])
+
+        rest = self.client.get(url, query_string={'after': first['next']}).json
+        self.assertEqual([u['id'] for u in rest['users']], self.ids[4:])
+        self.assertIsNone(rest['next'])
+
+    def test_following(self):
+        self.login(self.ids[2])
+        resp = self.client.get(f"/api/v1/users/{self.ids[0]}/following")
+
+        self.assertEqual([u['username'] for u in resp.json['users']], ["user1"])
+
+    def test_deleted_user_hidden(self):
+        message = Message.query.first()
+        User.query.filter_by(id=self.ids[1]).update({User.deleted: True})
+        db.session.commit()
+        self.login(self.ids[2])
+
+        for url in [f"/api/v1/users/{self.ids[1]}", f"/api/v1/users/{self.ids[1]}/messages",
+                    f"/api/v1/users/{self.ids[1]}/followers", f"/api/v1/messages/{message.id}"]:
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+        followers = self.client.get(f"/api/v1/users/{self.ids[0]}/followers").json
+        self.assertEqual([u['id'] for u in followers['users']], self.ids[2:])
+        following = self.client.get(f"/api/v1/users/{self.ids[0]}/following").json
+        self.assertEqual(following['users'], [])
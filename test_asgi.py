@@ -0,0 +1,211 @@
+"""ASGI entry point tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import os
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, Follows, Message, Timeline, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+
+# must import after setting database
+from app import app, CURR_USER_KEY, fragment_cache, social_graph, user_cache
+import asgi
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ASGIResponse:
+
+    def __init__(self, messages):
+        start = messages[0]
+        self.status_code = start['status']
+        self.headers = {name.decode(): value.decode() for name, value in start['headers']}
+        self.body = b''.join(m.get('body', b'') for m in messages[1:])
+
+    @property
+    def text(self):
+        return self.body.decode()
+
+
+async def call(path, method='GET', query_string=b'', headers=(), body=b''):
+    """Send one request straight to asgi.application; returns an ASGIResponse."""
+
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query_string,
+        'root_path': '',
+        'headers': [(b'host', b'localhost'), *headers],
+        'client': ('127.0.0.1', 5000),
+        'server': ('localhost', 80),
+    }
+    requests = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return requests.pop(0) if requests else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.application(scope, receive, send)
+    return ASGIResponse(sent)
+
+
+def run(*requests):
+    """Run request coroutines in order on one event loop; returns their responses."""
+
+    async def main():
+        try:
+            return [await request for request in requests]
+        finally:
+            # asyncpg connections belong to this loop
+            await asgi.dispose_engine()
+
+    return asyncio.run(main())
+
+
+def run_together(*requests):
+    """Run request coroutines concurrently on one event loop; returns their responses."""
+
+    async def main():
+        try:
+            return await asyncio.gather(*requests)
+        finally:
+            await asgi.dispose_engine()
+
+    return asyncio.run(main())
+
+
+class ASGITestCase(TestCase):
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        social_graph.clear()
+        fragment_cache.clear()
+
+        self.user = User.signup("testuser", "test@email.com", "password", None)
+        self.other = User.signup("other", "other@email.com", "password", None)
+        db.session.commit()
+        self.user_id, self.other_id = self.user.id, self.other.id
+
+        db.session.add(Follows(user_being_followed_id=self.other_id,
+                               user_following_id=self.user_id))
+        self.message = Message(text="hello from other", user_id=self.other_id)
+        db.session.add(self.message)
+        db.session.commit()
+        self.message_id = self.message.id
+        Timeline.rebuild()
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        signed = app.session_interface.get_signing_serializer(app).dumps({CURR_USER_KEY: self.user_id})
+        self.cookie = (b'cookie', f"session={signed}".encode())
+
+    def tearDown(self) -> None:
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        return super().tearDown()
+
+    def test_matches_wsgi(self):
+        """The async views render the same pages as the Flask ones."""
+
+        paths = ['/', '/users', f'/users/{self.other_id}', f'/messages/{self.message_id}']
+        responses = run(*(call(path, headers=[self.cookie]) for path in paths))
+
+        for path, resp in zip(paths, responses):
+            with self.subTest(path=path):
+                self.assertEqual(resp.status_code, 200)
+                expected = self.client.get(path).get_data(as_text=True)
+                self.assertEqual(resp.text, expected)
+
+        self.assertIn("hello from other", responses[0].text)
+        self.assertIn("Unfollow", responses[2].text)
+
+    def test_anonymous(self):
+        resp, = run(call('/'))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("New to Warbler?", resp.text)
+
+    def test_cache_headers_and_304(self):
+        path = f'/users/{self.other_id}'
+        first, = run(call(path, headers=[self.cookie]))
+
+        self.assertIn('private', first.headers['cache-control'])
+        # async queries are counted too
+        self.assertNotIn('"0 queries"', first.headers['server-timing'])
+
+        second, = run(call(path, headers=[self.cookie,
+                                          (b'if-none-match', first.headers['etag'].encode())]))
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.body, b'')
+
+    def test_not_found(self):
+        missing, bad_cursor = run(call('/users/99999'),
+                                  call('/', query_string=b'before=nope', headers=[self.cookie]))
+
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(bad_cursor.status_code, 400)
+
+    def test_deleted_user_hidden(self):
+        User.query.filter_by(id=self.other_id).update({User.deleted: True})
+        db.session.commit()
+
+        profile, message = run(call(f'/users/{self.other_id}', headers=[self.cookie]),
+                               call(f'/messages/{self.message_id}', headers=[self.cookie]))
+
+        self.assertEqual(profile.status_code, 404)
+        self.assertEqual(message.status_code, 404)
+
+    def test_falls_back_to_wsgi(self):
+        """POSTs and routes without an async view go to the Flask app."""
+
+        follow, search, login_page = run(
+            call(f'/users/stop-following/{self.other_id}', method='POST', headers=[self.cookie]),
+            call('/users', query_string=b'q=other'),
+            call('/login'))
+
+        self.assertEqual(follow.status_code, 302)
+        self.assertIsNone(db.session.get(Follows, (self.other_id, self.user_id)))
+        self.assertIn("@other", search.text)
+        self.assertEqual(login_page.status_code, 200)
+
+    def test_wsgi_requests_run_concurrently(self):
+        """A slow fallback request doesn't hold up the others."""
+
+        # each request waits for the other to arrive, so run one at a time
+        # they'd both time out
+        both_rendering = threading.Barrier(2, timeout=5)
+        render = app.jinja_env.get_template
+
+        def render_template(name, **context):
+            both_rendering.wait()
+            return render(name).render(**context)
+
+        with patch('app.render_template', render_template):
+            first, second = run_together(call('/login'), call('/login'))
+
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
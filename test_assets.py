@@ -0,0 +1,134 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+
+# must import after setting database
+from app import app, assets
+import assets as pipeline
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+
+class AssetBuildTestCase(TestCase):
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.manifest = pipeline.build(SOURCE, self.dest)
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def test_fingerprinted_names(self):
+        built = self.manifest['stylesheets/style.css']
+
+        self.assertRegex(built, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, built)))
+        self.assertIn('images/warbler-hero.jpg', self.manifest)
+
+    def test_same_content_same_name(self):
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other)
+        self.assertEqual(pipeline.build(SOURCE, other), self.manifest)
+
+    def test_css_urls_rewritten(self):
+        with open(os.path.join(self.dest, self.manifest['stylesheets/style.css'])) as css:
+            text = css.read()
+
+        self.assertIn(f'url("/static/dist/{self.manifest["images/nav-bg.png"]}")', text)
+        self.assertNotIn('url("/static/images/', text)
+
+    def test_compressed_variants(self):
+        path = os.path.join(self.dest, self.manifest['stylesheets/style.css'])
+
+        with open(path, 'rb') as original, gzip.open(path + '.gz') as compressed:
+            self.assertEqual(compressed.read(), original.read())
+        if pipeline.brotli:
+            self.assertTrue(os.path.isfile(path + '.br'))
+
+        # images aren't worth compressing again
+        image = os.path.join(self.dest, self.manifest['images/warbler-hero.jpg'])
+        self.assertFalse(os.path.exists(image + '.gz'))
+
+
+class AssetServingTestCase(TestCase):
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.manifest = pipeline.build(SOURCE, self.dest)
+        self.client = app.test_client()
+
+        self.dist = app.config['ASSETS_DIST']
+        app.config['ASSETS_DIST'] = self.dest
+        assets.load_manifest(self.dest)
+
+    def tearDown(self):
+        app.config['ASSETS_DIST'] = self.dist
+        assets.load_manifest(self.dist)
+        shutil.rmtree(self.dest)
+
+    def test_asset_url(self):
+        built = self.manifest['images/default-pic.png']
+
+        with app.test_request_context():
+            self.assertEqual(assets.url('images/default-pic.png'), f"/static/dist/{built}")
+            self.assertEqual(assets.url('/static/images/default-pic.png'), f"/static/dist/{built}")
+            self.assertEqual(assets.url('images/missing.png'), "/static/images/missing.png")
+            self.assertEqual(assets.url('https://example.com/me.jpg'), "https://example.com/me.jpg")
+            self.assertIsNone(assets.url(None))
+
+    def test_pages_use_built_assets(self):
+        resp = self.client.get("/")
+        html = resp.get_data(as_text=True)
+
+        self.assertIn(f'href="/static/dist/{self.manifest["stylesheets/style.css"]}"', html)
+
+    def test_serves_gzip(self):
+        url = f"/static/dist/{self.manifest['stylesheets/style.css']}"
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertIn(b'body', gzip.decompress(resp.get_data()))
+        resp.close()
+
+    def test_prefers_brotli(self):
+        if not pipeline.brotli:
+            self.skipTest("brotli isn't installed")
+
+        url = f"/static/dist/{self.manifest['stylesheets/style.css']}"
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate, br'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertIn(b'body', pipeline.brotli.decompress(resp.get_data()))
+        resp.close()
+
+    def test_serves_identity(self):
+        url = f"/static/dist/{self.manifest['stylesheets/style.css']}"
+        resp = self.client.get(url, headers={'Accept-Encoding': 'identity'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'body', resp.get_data())
+        resp.close()
+
+    def test_plain_static_still_served(self):
+        resp = self.client.get("/static/stylesheets/style.css")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+        resp.close()
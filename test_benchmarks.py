@@ -0,0 +1,103 @@
+"""Benchmark suite tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_benchmarks.py
+
+
+import os
+import random
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+
+# must import after setting database
+from app import app, social_graph, user_cache, user_search, message_search
+from benchmarks import runner
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BenchmarkStatsTestCase(TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(runner.percentile(values, 50), 50)
+        self.assertEqual(runner.percentile(values, 99), 99)
+        self.assertEqual(runner.percentile([7], 95), 7)
+        self.assertIsNone(runner.percentile([], 50))
+
+    def test_compare(self):
+        result = dict(route='homepage', mode='test_client', p95_ms=10.0, statements_per_request=3)
+        baseline = dict(results=[result])
+
+        same = dict(results=[dict(result, p95_ms=11.0)])
+        self.assertEqual(runner.compare(baseline, same, 0.2), [])
+
+        slower = dict(results=[dict(result, p95_ms=13.0, statements_per_request=4)])
+        regressions = runner.compare(baseline, slower, 0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn("homepage (test_client): p95_ms 10.0 -> 13.0", regressions)
+
+
+class BenchmarkRunTestCase(TestCase):
+
+    def setUp(self) -> None:
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        social_graph.clear()
+        user_search.clear()
+        message_search.clear()
+
+        users = [User.signup(f"user{i}", f"user{i}@email.com", "password", None)
+                 for i in range(4)]
+        db.session.commit()
+        for user in users:
+            db.session.add(Message(text=f"hello from {user.username}", user_id=user.id))
+        db.session.add(Follows(user_being_followed_id=users[0].id,
+                               user_following_id=users[1].id))
+        db.session.commit()
+
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        return super().tearDown()
+
+    def test_run_every_route(self):
+        results = runner.run(list(runner.SCENARIOS), requests=3, concurrency=2,
+                             modes=('test_client', 'live_server'))
+
+        self.assertEqual(len(results), len(runner.SCENARIOS) * 2)
+        for result in results:
+            self.assertEqual(result['errors'], 0, result)
+            self.assertEqual(result['requests'], 3)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['statements_per_request'], 0)
+
+    def test_follow_pairs_are_new(self):
+        sample = runner.Sample(random.Random(0), follows=5)
+        following = {(f.user_following_id, f.user_being_followed_id)
+                     for f in Follows.query}
+
+        self.assertTrue(sample.follow_pairs)
+        self.assertFalse(following & set(sample.follow_pairs))
+
+    def test_follow_pairs_refill(self):
+        rng = random.Random(0)
+        sample = runner.Sample(rng, follows=1)
+
+        # 4 users make 12 pairs, one of them already a follow
+        pairs = [sample.follow_pair(rng) for _ in range(11)]
+
+        self.assertEqual(len(set(pairs)), 11)
+        with self.assertRaises(RuntimeError):
+            sample.follow_pair(rng)
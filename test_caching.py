@@ -0,0 +1,139 @@
+"""HTTP caching policy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_caching.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+
+# must import after setting database
+from app import app, CURR_USER_KEY, social_graph, user_cache
+from caching import static_policy, IMMUTABLE, REVALIDATE
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CachingTestCase(TestCase):
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+
+        self.user = User.signup("testuser", "test@email.com", "password", None)
+        self.other = User.signup("otheruser", "other@email.com", "password", None)
+        db.session.commit()
+
+        self.message = Message(text="hello", user_id=self.other.id)
+        db.session.add(self.message)
+        db.session.commit()
+
+        self.user_id = self.user.id
+        self.other_id = self.other.id
+        self.message_id = self.message.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self) -> None:
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        return super().tearDown()
+
+    def revalidate(self, url, resp):
+        return self.client.get(url, headers={'If-None-Match': resp.headers['ETag']})
+
+    def test_static_policy(self):
+        self.assertEqual(static_policy("stylesheets/style.css"), REVALIDATE)
+        self.assertEqual(static_policy("stylesheets/style.3f2a9c1d7e.css"), IMMUTABLE)
+        self.assertEqual(static_policy("images/warbler-hero.jpg"), REVALIDATE)
+
+    def test_static_file(self):
+        resp = self.client.get("/static/stylesheets/style.css")
+
+        self.assertEqual(resp.headers['Cache-Control'], REVALIDATE)
+        self.assertIn('ETag', resp.headers)
+        resp.close()
+
+    def test_default_no_store(self):
+        resp = self.client.get("/")
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_users_show_not_modified(self):
+        url = f"/users/{self.other_id}"
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+        self.assertIn('Cookie', resp.headers['Vary'])
+        self.assertTrue(resp.headers['ETag'].startswith('W/"'))
+        self.assertIn('Last-Modified', resp.headers)
+
+        again = self.revalidate(url, resp)
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.get_data(), b"")
+        self.assertEqual(again.headers['ETag'], resp.headers['ETag'])
+
+        by_date = self.client.get(url, headers={'If-Modified-Since': resp.headers['Last-Modified']})
+        self.assertEqual(by_date.status_code, 304)
+
+    def test_users_show_changes_with_the_user(self):
+        url = f"/users/{self.other_id}"
+        resp = self.client.get(url)
+
+        db.session.add(Message(text="another", user_id=self.other_id))
+        User.adjust_counts(self.other_id, messages_count=1)
+        db.session.commit()
+
+        again = self.revalidate(url, resp)
+        self.assertEqual(again.status_code, 200)
+        self.assertIn("another", again.get_data(as_text=True))
+
+    def test_users_show_changes_with_the_viewer(self):
+        url = f"/users/{self.other_id}"
+        resp = self.client.get(url)
+
+        self.client.post(f"/users/follow/{self.other_id}")
+
+        again = self.revalidate(url, resp)
+        self.assertEqual(again.status_code, 200)
+        self.assertIn("Unfollow", again.get_data(as_text=True))
+
+    def test_users_show_etag_per_page(self):
+        url = f"/users/{self.other_id}"
+        resp = self.client.get(url)
+
+        other_page = self.client.get(url + "?before=2020-01-01T00:00:00_1",
+                                     headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(other_page.status_code, 200)
+
+    def test_users_show_missing(self):
+        self.assertEqual(self.client.get("/users/99999").status_code, 404)
+
+    def test_messages_show_not_modified(self):
+        url = f"/messages/{self.message_id}"
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.revalidate(url, resp).status_code, 304)
+
+        # renaming the author changes the page
+        other = db.session.get(User, self.other_id)
+        other.username = "renamed"
+        db.session.commit()
+
+        again = self.revalidate(url, resp)
+        self.assertEqual(again.status_code, 200)
+        self.assertIn("@renamed", again.get_data(as_text=True))
@@ -0,0 +1,136 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+
+import os
+from unittest import TestCase
+
+from jinja2 import Environment
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+
+# must import after setting database
+from app import app, CURR_USER_KEY, fragment_cache, social_graph, user_cache
+from fragments import FragmentCache, FragmentCacheExtension, LRUBackend
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_ALWAYS_EAGER'] = True
+
+
+class FragmentCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.cache = FragmentCache(max_size=10)
+        self.env = Environment(extensions=[FragmentCacheExtension], autoescape=True)
+        self.env.fragment_cache = self.cache
+        self.template = self.env.from_string(
+            "{% cache 'user.card', user.id, user.version %}"
+            "<b>{{ user.name }}</b>{{ render() }}"
+            "{% endcache %}")
+        self.renders = 0
+
+    def render(self, **user):
+        def count():
+            self.renders += 1
+            return ''
+        return self.template.render(user=user, render=count)
+
+    def test_hit(self):
+        self.assertEqual(self.render(id=1, version=1, name="a<"), "<b>a&lt;</b>")
+        self.assertEqual(self.render(id=1, version=1, name="changed"), "<b>a&lt;</b>")
+        self.assertEqual(self.renders, 1)
+
+    def test_new_version(self):
+        self.render(id=1, version=1, name="a")
+        self.assertEqual(self.render(id=1, version=2, name="b"), "<b>b</b>")
+        self.assertEqual(self.renders, 2)
+
+    def test_invalidate(self):
+        self.render(id=1, version=1, name="a")
+        self.render(id=2, version=1, name="b")
+
+        self.cache.invalidate('user', 1)
+        self.cache.invalidate('message', 2)
+
+        self.assertEqual(self.render(id=1, version=1, name="c"), "<b>c</b>")
+        self.assertEqual(self.render(id=2, version=1, name="d"), "<b>b</b>")
+
+    def test_lru_eviction(self):
+        backend = LRUBackend(max_size=2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+
+        self.assertEqual(backend.get('a'), 1)
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(len(backend), 2)
+
+    def test_without_cache(self):
+        self.env.fragment_cache = None
+        self.render(id=1, version=1, name="a")
+        self.render(id=1, version=1, name="a")
+        self.assertEqual(self.renders, 2)
+
+
+class FragmentViewTestCase(TestCase):
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+        fragment_cache.clear()
+
+        self.user = User.signup("testuser", "test@email.com", "password", None)
+        db.session.commit()
+        self.message = Message(text="first warble", user_id=self.user.id)
+        db.session.add(self.message)
+        db.session.commit()
+
+        self.user_id = self.user.id
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self) -> None:
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        return super().tearDown()
+
+    def test_cards_cached(self):
+        self.client.get(f"/users/{self.user_id}")
+        self.client.get("/users")
+
+        self.assertIsNotNone(fragment_cache.backend.get(('message.card', self.message.id)))
+        self.assertIsNotNone(fragment_cache.backend.get(('user.card-bio', self.user_id)))
+
+    def test_profile_edit(self):
+        self.client.get("/users")
+
+        resp = self.client.post("/users/profile", data={
+            'username': "renamed", 'email': "test@email.com", 'bio': "new bio",
+            'password': "password"}, follow_redirects=True)
+        self.assertEqual(resp.status_code, 200)
+
+        html = self.client.get("/users").get_data(as_text=True)
+        self.assertIn("@renamed", html)
+        self.assertIn("new bio", html)
+
+    def test_message_delete(self):
+        message_id = self.message.id
+        self.client.get(f"/users/{self.user_id}")
+
+        self.client.post(f"/messages/{message_id}/delete")
+
+        self.assertIsNone(fragment_cache.backend.get(('message.card', message_id)))
+        html = self.client.get(f"/users/{self.user_id}").get_data(as_text=True)
+        self.assertNotIn("first warble", html)
@@ -0,0 +1,96 @@
+"""CSV generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+from glob import glob
+from unittest import TestCase
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generator', 'create_csvs.py')
+
+
+def generate(out, *args):
+    subprocess.run(
+        [sys.executable, GENERATOR, '--out', out, '--until', '2024-01-01', *args],
+        check=True, timeout=60)
+
+
+def read_csvs(out, table):
+    rows = []
+    for path in sorted(glob(os.path.join(out, f"{table}*.csv"))):
+        with open(path, newline='') as file:
+            rows.extend(csv.DictReader(file))
+    return rows
+
+
+class GeneratorTestCase(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def out(self, name):
+        path = os.path.join(self.dir.name, name)
+        os.mkdir(path)
+        return path
+
+    def contents(self, out):
+        return {os.path.basename(path): open(path).read()
+                for path in sorted(glob(os.path.join(out, '*.csv')))}
+
+    def test_same_seed_same_data(self):
+        first, second, other = self.out('first'), self.out('second'), self.out('other')
+        generate(first, '--scale', '0.1', '--seed', 'a', '--power-law', '1.1')
+        generate(second, '--scale', '0.1', '--seed', 'a', '--power-law', '1.1', '--workers', '2')
+        generate(other, '--scale', '0.1', '--seed', 'b', '--power-law', '1.1')
+
+        self.assertEqual(self.contents(first), self.contents(second))
+        self.assertNotEqual(self.contents(first)['follows.csv'],
+                            self.contents(other)['follows.csv'])
+
+    def test_shards_same_data_whatever_workers(self):
+        serial, parallel = self.out('serial'), self.out('parallel')
+        generate(serial, '--scale', '0.1', '--shards', '2')
+        generate(parallel, '--scale', '0.1', '--shards', '2', '--workers', '2')
+
+        self.assertEqual(self.contents(serial), self.contents(parallel))
+
+    def test_output_shape(self):
+        out = self.out('small')
+        generate(out, '--scale', '0.1', '--shards', '2')
+
+        self.assertEqual(sorted(os.listdir(out)), [
+            'follows.000.csv', 'follows.001.csv', 'messages.000.csv', 'messages.001.csv',
+            'users.000.csv', 'users.001.csv'])
+
+        users = read_csvs(out, 'users')
+        messages = read_csvs(out, 'messages')
+        follows = read_csvs(out, 'follows')
+        self.assertEqual((len(users), len(messages), len(follows)), (30, 100, 500))
+
+        user_ids = {int(user['id']) for user in users}
+        self.assertEqual(user_ids, set(range(1, 31)))
+        self.assertEqual(len({user['username'] for user in users}), 30)
+        self.assertTrue(all(int(msg['user_id']) in user_ids for msg in messages))
+        self.assertTrue(all(len(msg['text']) <= 140 for msg in messages))
+
+        pairs = {(int(f['user_being_followed_id']), int(f['user_following_id'])) for f in follows}
+        self.assertEqual(len(pairs), len(follows))
+        self.assertTrue(all(a != b and {a, b} <= user_ids for a, b in pairs))
+
+    def test_follows_capped_at_every_pair(self):
+        # 3 users can only make 6 follows; a steep power law mustn't stall
+        out = self.out('dense')
+        generate(out, '--scale', '0.01', '--power-law', '50')
+
+        follows = read_csvs(out, 'follows')
+        pairs = {(f['user_being_followed_id'], f['user_following_id']) for f in follows}
+        self.assertEqual(len(follows), 6)
+        self.assertEqual(len(pairs), 6)
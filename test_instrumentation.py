@@ -0,0 +1,136 @@
+"""Instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+import os
+import re
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+
+# must import after setting database
+from app import app, CURR_USER_KEY, instrumentation, social_graph, user_cache
+from instrumentation import Histogram, Metrics, RequestStats, current_stats
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HistogramTestCase(TestCase):
+
+    def test_cumulative_buckets(self):
+        hist = Histogram((1, 5, 10))
+        for value in (0.5, 1, 3, 7, 50):
+            hist.observe(value)
+
+        self.assertEqual(hist.cumulative(), [('1', 2), ('5', 3), ('10', 4), ('+Inf', 5)])
+        self.assertEqual(hist.count, 5)
+        self.assertEqual(hist.sum, 61.5)
+
+    def test_render_escapes_labels(self):
+        metrics = Metrics(latency_buckets=(0.1,), statement_buckets=(1,))
+        stats = RequestStats()
+        stats.statements = 3
+        metrics.record('odd"name', 'GET', 200, 0.05, stats)
+
+        text = metrics.render()
+        self.assertIn('warbler_request_duration_seconds_bucket'
+                      '{endpoint="odd\\"name",method="GET",status="200",le="0.1"} 1', text)
+        self.assertIn('warbler_request_sql_statements_bucket{endpoint="odd\\"name",le="+Inf"} 1',
+                      text)
+
+
+class InstrumentationViewTestCase(TestCase):
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+        instrumentation.metrics.clear()
+
+        self.user = User.signup("testuser", "test@email.com", "password", None)
+        db.session.commit()
+        for i in range(3):
+            db.session.add(Message(text=f"message {i}", user_id=self.user.id))
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        instrumentation.warn_threshold = app.config['SQL_STATEMENT_WARN_THRESHOLD']
+        return super().tearDown()
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+    def test_server_timing(self):
+        self.login()
+        resp = self.client.get(f"/users/{self.user.id}")
+
+        timing = resp.headers['Server-Timing']
+        match = re.match(r'db;dur=[\d.]+;desc="(\d+) queries", app;dur=[\d.]+$', timing)
+        self.assertIsNotNone(match, timing)
+        self.assertGreater(int(match.group(1)), 0)
+        self.assertIsNone(current_stats())
+
+    def test_metrics(self):
+        self.login()
+        self.client.get("/")
+        self.client.get("/")
+        self.client.get("/no-such-page")
+
+        resp = self.client.get("/metrics")
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE warbler_request_duration_seconds histogram', text)
+        self.assertIn('warbler_request_duration_seconds_count'
+                      '{endpoint="homepage",method="GET",status="200"} 2', text)
+        self.assertIn('warbler_request_duration_seconds_count'
+                      '{endpoint="unmatched",method="GET",status="404"} 1', text)
+        self.assertIn('warbler_request_sql_statements_count{endpoint="homepage"} 2', text)
+        self.assertIn('warbler_request_sql_seconds_total{endpoint="homepage"}', text)
+        # scrapes aren't counted
+        self.assertNotIn('endpoint="metrics"', text)
+
+    def test_n_plus_one_warning(self):
+        self.login()
+        instrumentation.warn_threshold = 1
+
+        with self.assertLogs('instrumentation', level='WARNING') as logs:
+            self.client.get(f"/users/{self.user.id}")
+
+        self.assertIn("Possible N+1 in GET", logs.output[0])
+        self.assertIn("(users_show)", logs.output[0])
+
+    def test_unhandled_errors_counted(self):
+        self.login()
+        propagate = app.config['PROPAGATE_EXCEPTIONS']
+        self.addCleanup(app.config.__setitem__, 'PROPAGATE_EXCEPTIONS', propagate)
+
+        with patch('app.render_template', side_effect=RuntimeError("boom")):
+            # as in production: Flask turns the error into a 500 page
+            app.config['PROPAGATE_EXCEPTIONS'] = False
+            self.assertEqual(self.client.get(f"/users/{self.user.id}").status_code, 500)
+
+            # as in debug: the error reaches the server
+            app.config['PROPAGATE_EXCEPTIONS'] = True
+            with self.assertRaises(RuntimeError):
+                self.client.get(f"/users/{self.user.id}")
+
+        text = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn('warbler_request_duration_seconds_count'
+                      '{endpoint="users_show",method="GET",status="500"} 2', text)
+        self.assertIsNone(current_stats())
@@ -0,0 +1,234 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import select
+
+from models import db, Follows, Job, Likes, Message, Timeline, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+
+# must import after setting database
+from app import app, CURR_USER_KEY, social_graph, user_cache
+import jobs
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+failures = {}
+
+
+@jobs.handler
+def flaky(name, fail_times):
+    """Fails the first `fail_times` times it's called with `name`."""
+
+    failures[name] = failures.get(name, 0) + 1
+    if failures[name] <= fail_times:
+        raise RuntimeError(f"{name} failed")
+
+
+class JobTestCase(TestCase):
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+        failures.clear()
+
+        self.eager = app.config['JOBS_ALWAYS_EAGER']
+        app.config['JOBS_ALWAYS_EAGER'] = False
+        self.retry_delay = jobs.RETRY_DELAY
+        jobs.RETRY_DELAY = 0
+
+        self.author = User.signup("author", "author@email.com", "password", None)
+        self.reader = User.signup("reader", "reader@email.com", "password", None)
+        db.session.commit()
+        self.author_id, self.reader_id = self.author.id, self.reader.id
+
+    def tearDown(self) -> None:
+        app.config['JOBS_ALWAYS_EAGER'] = self.eager
+        jobs.RETRY_DELAY = self.retry_delay
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        return super().tearDown()
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            jobs.enqueue('no_such_job')
+
+    def test_runs_when_worker_does(self):
+        jobs.enqueue('flaky', name="a", fail_times=0)
+        jobs.enqueue('flaky', name="later", fail_times=0, delay=60)
+        db.session.commit()
+
+        self.assertEqual(failures, {})
+        self.assertEqual(jobs.work(once=True), 1)
+        self.assertEqual(failures, {"a": 1})
+        self.assertEqual(jobs.counts(), {('flaky', Job.DONE): 1, ('flaky', Job.QUEUED): 1})
+
+    def test_retries(self):
+        job = jobs.enqueue('flaky', name="a", fail_times=2)
+        db.session.commit()
+
+        self.assertEqual(jobs.work(once=True), 3)
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 3))
+        self.assertIn("RuntimeError: a failed", job.last_error)
+
+    def test_gives_up(self):
+        job = jobs.enqueue('flaky', name="a", fail_times=5, max_attempts=2)
+        db.session.commit()
+
+        self.assertEqual(jobs.work(once=True), 2)
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+
+        jobs.retry(job.id)
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertEqual(jobs.work(once=True), 1)
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 3))
+
+    def test_backoff(self):
+        jobs.RETRY_DELAY = 60
+        job = jobs.enqueue('flaky', name="a", fail_times=1)
+        db.session.commit()
+
+        self.assertEqual(jobs.work(once=True), 1)
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertGreater(job.run_at, datetime.utcnow() + timedelta(seconds=50))
+
+    def test_skips_locked_jobs(self):
+        job = jobs.enqueue('flaky', name="a", fail_times=0)
+        db.session.commit()
+
+        with db.engine.connect() as other_worker:
+            other_worker.execute(select(Job).where(Job.id == job.id).with_for_update())
+            self.assertIsNone(jobs.claim("me"))
+
+        self.assertEqual(jobs.claim("me").id, job.id)
+
+    def test_requeue_stale(self):
+        job = jobs.enqueue('flaky', name="a", fail_times=0)
+        db.session.commit()
+        jobs.claim("lost worker")
+        job.started_at = datetime.utcnow() - timedelta(seconds=jobs.LEASE + 1)
+        db.session.commit()
+
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertIn("lost worker", job.last_error)
+        self.assertEqual(jobs.work(once=True), 1)
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 2))
+
+    def test_eager(self):
+        app.config['JOBS_ALWAYS_EAGER'] = True
+
+        job = jobs.enqueue('flaky', name="a", fail_times=0)
+        self.assertEqual(job.status, Job.DONE)
+
+        with self.assertRaises(RuntimeError):
+            jobs.enqueue('flaky', name="b", fail_times=1)
+
+    def test_post_fans_out_in_background(self):
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+
+        self.client.post("/messages/new", data={"text": "hello"})
+        self.assertEqual(Message.query.count(), 1)
+        # the author's own entry doesn't wait for the worker
+        self.assertEqual({entry.user_id for entry in Timeline.query}, {self.author_id})
+
+        jobs.work(once=True)
+        self.assertEqual({entry.user_id for entry in Timeline.query},
+                         {self.author_id, self.reader_id})
+
+    def test_follow_between_post_and_fan_out(self):
+        other = User.signup("other", "other@email.com", "password", None)
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+        other_id = other.id
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+        self.client.post("/messages/new", data={"text": "hello"})
+
+        # other follows the author before the worker gets to the post
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = other_id
+        self.client.post(f"/users/follow/{self.author_id}")
+
+        self.assertEqual(jobs.work(once=True), 1)
+        self.assertEqual(jobs.counts(), {('fan_out', Job.DONE): 1})
+        self.assertEqual({entry.user_id for entry in Timeline.query},
+                         {self.author_id, self.reader_id, other_id})
+
+        # and running it again changes nothing
+        jobs.fan_out(Message.query.one().id)
+        db.session.commit()
+        self.assertEqual(Timeline.query.count(), 3)
+
+    def test_delete_user_in_chunks(self):
+        chunk = jobs.DELETE_CHUNK
+        jobs.DELETE_CHUNK = 2
+        self.addCleanup(setattr, jobs, 'DELETE_CHUNK', chunk)
+
+        messages = [Message(text=f"warble {i}", user_id=self.author_id) for i in range(5)]
+        db.session.add_all(messages)
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+        for msg in messages[:3]:
+            Likes.toggle(self.reader_id, msg.id)
+        User.reconcile_counts()
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+        self.client.post("/users/delete")
+
+        # queued, not done, by the request
+        self.assertIsNotNone(db.session.get(User, self.author_id))
+        self.assertEqual(jobs.work(once=True), 1)
+
+        db.session.expire_all()
+        self.assertIsNone(db.session.get(User, self.author_id))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        reader = db.session.get(User, self.reader_id)
+        self.assertEqual((reader.likes_count, reader.following_count), (0, 0))
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    def test_deleted_user_hidden_before_cleanup(self):
+        db.session.add(Message(text="soon gone", user_id=self.author_id))
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+        Timeline.rebuild()
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+        self.client.post("/users/delete")
+
+        # the job hasn't run yet
+        self.assertEqual(jobs.counts(), {('delete_user', Job.QUEUED): 1})
+        self.assertIsNotNone(db.session.get(User, self.author_id))
+
+        self.assertFalse(User.authenticate("author", "password"))
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+        self.assertNotIn("@author", self.client.get("/users").get_data(as_text=True))
+        self.assertNotIn("@author", self.client.get("/users?q=auth").get_data(as_text=True))
+        self.assertNotIn("soon gone", self.client.get("/").get_data(as_text=True))
@@ -0,0 +1,119 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+import csv
+import io
+import os
+import tempfile
+from contextlib import redirect_stderr
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+
+# must import after setting database
+from app import app
+import loader
+
+USERS = [
+    dict(email=f"user{i}@email.com", username=f"user{i}", image_url="", bio=f"bio {i}",
+         location="", header_image_url="", password="HASHED_PASSWORD")
+    for i in range(1, 4)
+]
+
+MESSAGES = [
+    dict(text="hello, \"world\"", timestamp="2017-01-21 11:04:53.522807", user_id=1),
+    dict(text="second", timestamp="2017-01-22 11:04:53.522807", user_id=2),
+]
+
+FOLLOWS = [
+    dict(user_being_followed_id=1, user_following_id=2),
+    dict(user_being_followed_id=2, user_following_id=3),
+]
+
+
+class LoaderTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.write_csv('users.csv', USERS[:2])
+        self.write_csv('users.001.csv', USERS[2:])
+        self.write_csv('messages.csv', MESSAGES)
+        self.write_csv('follows.csv', FOLLOWS)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        db.session.rollback()
+        # loading recreates the tables; don't leave stale rows in the session
+        db.session.remove()
+        self.dir.cleanup()
+        return super().tearDown()
+
+    def write_csv(self, name, rows):
+        with open(os.path.join(self.dir.name, name), 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=rows[0].keys())
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def load(self, **kwargs):
+        with redirect_stderr(io.StringIO()):
+            return loader.load(self.dir.name, **kwargs)
+
+    def test_load(self):
+        loaded = self.load()
+
+        self.assertEqual(loaded, {'users': 3, 'messages': 2, 'follows': 2})
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(Message.query.filter_by(text='hello, "world"').count(), 1)
+        self.assertIsNone(User.query.filter_by(username='user1').one().location)
+
+        # derived data is rebuilt
+        self.assertEqual(User.query.filter_by(username='user1').one().followers_count, 1)
+        self.assertEqual(Timeline.query.filter_by(user_id=2).count(), 2)
+
+        # sequences were moved past the loaded rows
+        User.signup("fresh", "fresh@email.com", "password", None)
+        db.session.commit()
+
+    def test_append(self):
+        self.load()
+        os.remove(os.path.join(self.dir.name, 'users.001.csv'))
+        self.write_csv('users.csv', [dict(USERS[0], username='another', email='another@email.com')])
+        self.write_csv('messages.csv', MESSAGES[:1])
+        os.remove(os.path.join(self.dir.name, 'follows.csv'))
+        # user3 doesn't follow user1, so their timeline should be left as is
+        Timeline.query.filter_by(user_id=3).delete()
+        db.session.commit()
+
+        self.load(append=True)
+
+        self.assertEqual(User.query.count(), 4)
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Follows.query.count(), 2)
+
+        # only the new message's author and followers were rebuilt
+        self.assertEqual(User.query.filter_by(username='user1').one().messages_count, 2)
+        self.assertEqual(Timeline.query.filter_by(user_id=2).count(), 3)
+        self.assertEqual(Timeline.query.filter_by(user_id=3).count(), 0)
+
+    def test_insert_csv_batches(self):
+        db.drop_all()
+        db.create_all()
+        progress = loader.Progress('users', out=io.StringIO())
+
+        with db.engine.begin() as conn:
+            loader.insert_csv(conn, User.__table__, os.path.join(self.dir.name, 'users.csv'),
+                              progress, batch_size=1)
+            loader.insert_csv(conn, Message.__table__, os.path.join(self.dir.name, 'messages.csv'),
+                              progress, batch_size=1)
+
+        self.assertEqual(progress.rows, 4)
+        self.assertEqual(Message.query.count(), 2)
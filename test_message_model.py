@@ -1,9 +1,15 @@
 import os
+import threading
 
 from models import db, User, Message, Follows, Likes
 from unittest import TestCase
 
+from sqlalchemy import insert
+
 os.environ['DATABASE_URL'] = 'postgresql:///warbler-test'
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
 
 # must import after setting database
 from app import app
@@ -44,6 +50,58 @@ class UserModelTestCase(TestCase):
         self.assertEquals(len(likes), 1)
         self.assertEquals(likes[0].message_id, message.id)
         
+    def test_many_users_like_message(self):
+        message = Message(text="a message", user_id=self.user.id)
+        db.session.add(message)
+        u2 = User.signup("username2", "email2@email.com", "password", None)
+        u3 = User.signup("username3", "email3@email.com", "password", None)
+        db.session.commit()
+
+        self.assertEqual(Likes.toggle(u2.id, message.id), 1)
+        self.assertEqual(Likes.toggle(u3.id, message.id), 1)
+        db.session.commit()
+        self.assertEqual(Likes.query.filter_by(message_id=message.id).count(), 2)
+
+        # liking again unlikes
+        self.assertEqual(Likes.toggle(u2.id, message.id), -1)
+        db.session.commit()
+        self.assertEqual(Likes.liked_by(u3.id, [message.id]), {message.id})
+        self.assertEqual(Likes.liked_by(u2.id, [message.id]), set())
+
+    def test_concurrent_like(self):
+        """A like another request commits mid-toggle counts as already liked."""
+
+        message = Message(text="a message", user_id=self.user.id)
+        db.session.add(message)
+        u2 = User.signup("username2", "email2@email.com", "password", None)
+        db.session.commit()
+
+        with db.engine.connect() as other:
+            other.execute(insert(Likes).values(user_id=u2.id, message_id=message.id))
+            # the toggle's INSERT waits on this one, then finds it there
+            committer = threading.Timer(1, other.commit)
+            committer.start()
+            delta = Likes.toggle(u2.id, message.id)
+            committer.join()
+
+        self.assertEqual(delta, 0)
+        db.session.commit()
+        self.assertEqual(Likes.query.filter_by(message_id=message.id).count(), 1)
+
+    def test_liked_by(self):
+        messages = [Message(text=f"message {i}", user_id=self.user.id) for i in range(3)]
+        db.session.add_all(messages)
+        u2 = User.signup("username2", "email2@email.com", "password", None)
+        db.session.commit()
+
+        Likes.toggle(u2.id, messages[0].id)
+        Likes.toggle(u2.id, messages[2].id)
+        db.session.commit()
+
+        self.assertEqual(Likes.liked_by(u2.id, [messages[0].id, messages[1].id]),
+                         {messages[0].id})
+        self.assertEqual(Likes.liked_by(u2.id, []), set())
+
     def test_delete_user_deletes_messages(self):
         message = Message(text="a message", user_id=self.user.id)
         db.session.add(message)
@@ -7,9 +7,11 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
 from models import db, connect_db, Message, User
 from bs4 import BeautifulSoup
+from search import MessageSearch
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,11 +19,15 @@ from bs4 import BeautifulSoup
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+os.environ['PASSWORD_HASH_WORKERS'] = "0"
 
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, social_graph, user_cache, user_search, message_search, fragment_cache
+import pagination
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,6 +38,7 @@ db.create_all()
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_ALWAYS_EAGER'] = True
 
 
 class MessageViewTestCase(TestCase):
@@ -43,6 +50,11 @@ class MessageViewTestCase(TestCase):
         db.drop_all()
         db.create_all()
         self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+        fragment_cache.clear()
+        user_search.clear()
+        message_search.clear()
         
         user = User.signup("testuser", "test@email.com", "password1", None)
         user2 = User.signup("testuser2", "test2@email.com", "password2", None)
@@ -59,7 +71,8 @@ class MessageViewTestCase(TestCase):
         db.session.commit()
         
     def tearDown(self) -> None:
-        db.session.rollback()
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
         return super().tearDown()
 
     def test_add_message(self):
@@ -125,6 +138,24 @@ class MessageViewTestCase(TestCase):
             c.post(f"/users/add_like/{msg.id}", follow_redirects=True)
             
             self.assertEqual(len(user.likes), 0)
+
+    def test_like_counts(self):
+        user = User.query.filter_by(username='testuser').first()
+        user2 = User.query.filter_by(username='testuser2').first()
+        
+        msg = user2.messages[0]
+        
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+            
+            c.post(f"/users/add_like/{msg.id}")
+            self.assertEqual(User.query.get(user.id).likes_count, 1)
+            self.assertEqual(Message.query.get(msg.id).likes_count, 1)
+            
+            c.post(f"/users/add_like/{msg.id}")
+            self.assertEqual(User.query.get(user.id).likes_count, 0)
+            self.assertEqual(Message.query.get(msg.id).likes_count, 0)
     
     def test_like_page(self):
         # have testuser like testuser2's message
@@ -162,4 +193,107 @@ class MessageViewTestCase(TestCase):
             soup = BeautifulSoup(str(resp.data), 'html.parser')
             
             # should end up back at likes page with like gone
-            self.assertIsNone(soup.find(string=msg.text))
\ No newline at end of file
+            self.assertIsNone(soup.find(string=msg.text))
+
+    def test_profile_pagination(self):
+        user = User.query.filter_by(username='testuser').first()
+        for i in range(3):
+            db.session.add(Message(text=f"paged {i}", user_id=user.id))
+        db.session.commit()
+
+        original_per_page = pagination.PER_PAGE
+        pagination.PER_PAGE = 2
+        try:
+            with self.client as c:
+                resp = c.get(f"/users/{user.id}")
+                soup = BeautifulSoup(str(resp.data), 'html.parser')
+                first_page = [p.string for p in soup.select('#messages p')]
+                self.assertEqual(len(first_page), 2)
+
+                older = soup.find('a', id='older-messages')
+                self.assertIsNotNone(older)
+
+                resp = c.get(older['href'])
+                soup = BeautifulSoup(str(resp.data), 'html.parser')
+                second_page = [p.string for p in soup.select('#messages p')]
+                self.assertEqual(len(second_page), 2)
+                self.assertFalse(set(first_page) & set(second_page))
+                self.assertIsNone(soup.find('a', id='older-messages'))
+        finally:
+            pagination.PER_PAGE = original_per_page
+
+    def test_bad_cursor(self):
+        user = User.query.filter_by(username='testuser').first()
+        with self.client as c:
+            resp = c.get(f"/users/{user.id}?before=garbage")
+            self.assertEqual(resp.status_code, 400)
+
+    def search_pages(self, c, query):
+        """Follow a message search through all its pages; returns texts per page."""
+
+        pages = []
+        url = f"/messages/search?q={query}"
+        while url:
+            resp = c.get(url)
+            soup = BeautifulSoup(str(resp.data), 'html.parser')
+            pages.append([p.string for p in soup.select('#messages p')])
+            more = soup.find('a', id='older-messages')
+            url = more['href'] if more else None
+        return pages
+
+    def check_search(self):
+        user = User.query.filter_by(username='testuser').first()
+        with self.client as c:
+            c.get("/messages/search?q=warm")
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+            c.post("/messages/new", data={"text": "warm warm weather"})
+            c.post("/messages/new", data={"text": "warm coffee"})
+            c.post("/messages/new", data={"text": "cold weather"})
+
+            pages = self.search_pages(c, "warm")
+            self.assertEqual(pages, [["warm warm weather", "warm coffee"]])
+
+            with patch('search.MESSAGES_PER_PAGE', 1):
+                pages = self.search_pages(c, "warm")
+            self.assertEqual(pages, [["warm warm weather"], ["warm coffee"]])
+
+            self.assertEqual(self.search_pages(c, "warm weather"), [["warm warm weather"]])
+
+            msg = Message.query.filter_by(text="warm coffee").one()
+            c.post(f"/messages/{msg.id}/delete")
+            self.assertEqual(self.search_pages(c, "coffee"), [[]])
+
+    def test_search_messages(self):
+        self.check_search()
+
+    def test_search_messages_fallback_index(self):
+        with patch.object(MessageSearch, 'uses_postgres', return_value=False):
+            self.check_search()
+
+    def test_deleted_author_hidden(self):
+        user = User.query.filter_by(username='testuser').first()
+        msg = Message.query.filter_by(text="message2 here").one()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+            c.post(f"/users/add_like/{msg_id}")
+
+            User.query.filter_by(username='testuser2').update({User.deleted: True})
+            db.session.commit()
+
+            self.assertEqual(c.get(f"/messages/{msg_id}").status_code, 404)
+            self.assertNotIn("message2 here", c.get(f"/users/{user.id}/likes").get_data(as_text=True))
+            self.assertEqual(self.search_pages(c, "message2"), [[]])
+            with patch.object(MessageSearch, 'uses_postgres', return_value=False):
+                self.assertEqual(self.search_pages(c, "message2"), [[]])
+
+    def test_bad_search_cursor(self):
+        with self.client as c:
+            for before in ["garbage_1", "NaN_1", "Infinity_1", "1.5_x", "nounderscore"]:
+                with self.subTest(before=before):
+                    resp = c.get(f"/messages/search?q=hi&before={before}")
+                    self.assertEqual(resp.status_code, 400)
+
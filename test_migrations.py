@@ -0,0 +1,230 @@
+"""Migration and query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+import re
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import UniqueConstraint, delete, inspect, select
+
+from models import db, Follows, Job, Likes, Message, Recommendation, Timeline, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+os.environ['PASSWORD_HASH_WORKERS'] = "0"
+
+# must import after setting database
+from app import app
+import jobs
+import migrate
+import search
+from pagination import encode_cursor, page_query
+
+
+class MigrationTestCase(TestCase):
+
+    def tearDown(self) -> None:
+        migrate.version_table.drop(db.engine, checkfirst=True)
+        db.session.remove()
+        return super().tearDown()
+
+    def assertSchemaMatchesModels(self):
+        inspector = inspect(db.engine)
+
+        for table in db.metadata.sorted_tables:
+            with self.subTest(table=table.name):
+                self.assertEqual({c['name'] for c in inspector.get_columns(table.name)},
+                                 set(table.c.keys()))
+                self.assertLessEqual({index.name for index in table.indexes},
+                                     {index['name'] for index in inspector.get_indexes(table.name)})
+                self.assertEqual(
+                    {tuple(sorted(c.name for c in constraint.columns))
+                     for constraint in table.constraints if isinstance(constraint, UniqueConstraint)},
+                    {tuple(sorted(u['column_names']))
+                     for u in inspector.get_unique_constraints(table.name)})
+
+    def test_fresh_database(self):
+        migrate.recreate()
+
+        self.assertSchemaMatchesModels()
+        self.assertEqual(migrate.pending(), [])
+        self.assertEqual(migrate.upgrade(), [])
+
+    def test_adopts_create_all_database(self):
+        """A database made by db.create_all() takes the migrations cleanly."""
+
+        db.drop_all()
+        db.create_all()
+        migrate.version_table.drop(db.engine, checkfirst=True)
+
+        self.assertEqual(migrate.upgrade(), [version for version, _ in migrate.discover()])
+        self.assertSchemaMatchesModels()
+
+    def test_backfills_existing_data(self):
+        """Counters and timelines come out right on a database that already has rows."""
+
+        db.drop_all()
+        migrate.version_table.drop(db.engine, checkfirst=True)
+        migrate.upgrade(target='0001')
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "INSERT INTO users (id, email, username, password) VALUES "
+                "(1, 'author@email.com', 'author', 'x'), (2, 'reader@email.com', 'reader', 'x'), "
+                "(3, 'loner@email.com', 'loner', 'x')")
+            conn.exec_driver_sql(
+                "INSERT INTO messages (id, text, timestamp, user_id) VALUES "
+                "(1, 'first', '2023-01-01', 1), (2, 'second', '2023-01-02', 1)")
+            conn.exec_driver_sql(
+                "INSERT INTO follows (user_being_followed_id, user_following_id) VALUES (1, 2)")
+            conn.exec_driver_sql("INSERT INTO likes (user_id, message_id) VALUES (2, 1)")
+
+        migrate.upgrade()
+
+        counts = {user.username: (user.messages_count, user.following_count,
+                                  user.followers_count, user.likes_count)
+                  for user in User.query}
+        self.assertEqual(counts, {'author': (2, 0, 1, 0), 'reader': (0, 1, 0, 1),
+                                  'loner': (0, 0, 0, 0)})
+        self.assertEqual(dict(db.session.execute(select(Message.id, Message.likes_count)).all()),
+                         {1: 1, 2: 0})
+        timelines = db.session.execute(select(Timeline.user_id, Timeline.message_id)).all()
+        self.assertEqual(sorted(timelines), [(1, 1), (1, 2), (2, 1), (2, 2)])
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    def index_validity(self):
+        """{index name: valid?} of every index in the database."""
+
+        with db.engine.connect() as conn:
+            return dict(conn.exec_driver_sql(
+                "SELECT pg_class.relname, pg_index.indisvalid FROM pg_index "
+                "JOIN pg_class ON pg_class.oid = pg_index.indexrelid").all())
+
+    def test_rebuilds_invalid_concurrent_index(self):
+        """A CONCURRENTLY build that failed part way is redone on the next upgrade."""
+
+        migrate.recreate()
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("UPDATE pg_index SET indisvalid = false "
+                                 "WHERE indexrelid = 'ix_timelines_author_id'::regclass")
+            conn.execute(delete(migrate.version_table)
+                         .where(migrate.version_table.c.version == '0003'))
+        self.assertFalse(self.index_validity()['ix_timelines_author_id'])
+
+        self.assertEqual(migrate.upgrade(), ['0003'])
+        self.assertTrue(self.index_validity()['ix_timelines_author_id'])
+
+    def test_search_indexes(self):
+        with db.engine.begin() as conn:
+            # so the migration has to install it, where the server has it
+            conn.exec_driver_sql("DROP EXTENSION IF EXISTS pg_trgm CASCADE")
+            available = conn.exec_driver_sql(
+                "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'").first() is not None
+
+        migrate.recreate()
+
+        indexes = self.index_validity()
+        self.assertTrue(indexes['ix_messages_text_fts'])
+        for field in search.SEARCH_FIELDS:
+            with self.subTest(field=field):
+                self.assertEqual(indexes.get(f'ix_users_{field}_trgm'), True if available else None)
+        with db.engine.connect() as conn:
+            self.assertEqual(search.has_trigram_support(conn), available)
+
+    def test_upgrade_to(self):
+        migrate.recreate()
+        migrate.version_table.drop(db.engine)
+
+        self.assertEqual(migrate.upgrade(target='0001'), ['0001'])
+        self.assertEqual([version for version, _ in migrate.pending()][0], '0002')
+
+
+class QueryPlanTestCase(TestCase):
+    """The hot queries must be answerable from an index.
+
+    With sequential scans disabled the planner still falls back to one when
+    no index fits, or to reading a whole index whose leading column the
+    query doesn't constrain. Both count as full scans here.
+    """
+
+    HOT_QUERIES = {
+        'profile messages': page_query(select(Message).where(Message.user_id == 1)),
+        'profile messages, older page': page_query(
+            select(Message).where(Message.user_id == 1),
+            before=encode_cursor(datetime(2023, 1, 1), 50)),
+        'home timeline': page_query(
+            select(Message)
+            .join(Timeline, Timeline.message_id == Message.id)
+            .where(Timeline.user_id == 1,
+                   Timeline.author_id.not_in(User.select_deleted_ids())),
+            key=(Timeline.timestamp, Timeline.message_id)),
+        'following ids': select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == 1),
+        'follower ids': select(Follows.user_following_id)
+        .where(Follows.user_being_followed_id == 1),
+        'liked messages on a page': Likes.select_liked_by(1, [1, 2, 3]),
+        'message likers': select(Likes.user_id).where(Likes.message_id == 1),
+        'user likes page': page_query(
+            select(Message)
+            .join(Likes, Likes.message_id == Message.id)
+            .where(Likes.user_id == 1)),
+        'user by username': select(User).where(User.username == 'someone'),
+        'who to follow': Recommendation.select_for(1),
+        'next due job': jobs.select_due(datetime(2023, 1, 1)).limit(1),
+        'stale jobs': select(Job).where(Job.status == Job.RUNNING,
+                                        Job.started_at < datetime(2023, 1, 1)),
+        # what ON DELETE CASCADE runs when a message or user is deleted
+        'message delete cascade': delete(Timeline).where(Timeline.message_id == 1),
+        'user delete cascade (timelines)': delete(Timeline).where(Timeline.author_id == 1),
+        'user delete cascade (messages)': delete(Message).where(Message.user_id == 1),
+        'user delete cascade (recommendations)':
+            delete(Recommendation).where(Recommendation.recommended_id == 1),
+    }
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+    def full_scans(self, plan, leading_columns):
+        """Relations or indexes a JSON plan reads in full."""
+
+        scans = []
+        if plan['Node Type'] == 'Seq Scan':
+            scans.append(plan['Relation Name'])
+        elif 'Index Name' in plan:
+            leading = leading_columns.get(plan['Index Name'])
+            if leading and not re.search(rf"\b{leading}\b", plan.get('Index Cond', '')):
+                scans.append(plan['Index Name'])
+
+        for child in plan.get('Plans', []):
+            scans.extend(self.full_scans(child, leading_columns))
+        return scans
+
+    def test_no_full_scans(self):
+        with db.engine.connect() as conn:
+            # index name -> first column (expression indexes have none);
+            # partial indexes hold only the few rows their WHERE picks, so
+            # reading one whole is fine
+            leading_columns = dict(conn.exec_driver_sql(
+                "SELECT index.relname, attribute.attname FROM pg_index "
+                "JOIN pg_class index ON index.oid = pg_index.indexrelid "
+                "JOIN pg_attribute attribute ON attribute.attrelid = pg_index.indrelid "
+                "AND attribute.attnum = pg_index.indkey[0] "
+                "WHERE pg_index.indpred IS NULL").all())
+            conn.exec_driver_sql("SET enable_seqscan = off")
+
+            for name, query in self.HOT_QUERIES.items():
+                compiled = query.compile(dialect=conn.dialect,
+                                         compile_kwargs={'render_postcompile': True})
+                explained = conn.exec_driver_sql(
+                    f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+
+                with self.subTest(query=name):
+                    self.assertEqual(self.full_scans(explained[0]['Plan'], leading_columns), [])
+
+            conn.rollback()
@@ -0,0 +1,116 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Follows, Recommendation, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+os.environ['PASSWORD_HASH_WORKERS'] = "0"
+
+# must import after setting database
+from app import app, CURR_USER_KEY, social_graph, user_cache
+import recommendations
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RecommendationTestCase(TestCase):
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+
+        self.ids = []
+        for name in ["me", "alice", "bob", "carol", "dave", "loner"]:
+            self.ids.append(User.signup(name, f"{name}@email.com", "password", None))
+        db.session.commit()
+        me, alice, bob, carol, dave, self.loner = [user.id for user in self.ids]
+        self.ids = dict(me=me, alice=alice, bob=bob, carol=carol, dave=dave)
+
+        def follow(who, whom):
+            db.session.add(Follows(user_following_id=self.ids[who],
+                                   user_being_followed_id=self.ids[whom]))
+
+        # me follows alice and bob; both follow carol, only alice follows dave
+        follow('me', 'alice')
+        follow('me', 'bob')
+        follow('alice', 'carol')
+        follow('bob', 'carol')
+        follow('alice', 'dave')
+        follow('bob', 'me')
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        return super().tearDown()
+
+    def suggested(self, user_id):
+        return [user.username for user in db.session.scalars(Recommendation.select_for(user_id))]
+
+    def test_friends_of_friends_ranked(self):
+        recommendations.refresh()
+
+        # carol is followed by two of my friends and shares a follower (bob)
+        # with me; dave is followed by one friend
+        self.assertEqual(self.suggested(self.ids['me']), ["carol", "dave"])
+        rows = Recommendation.query.filter_by(user_id=self.ids['me']).all()
+        self.assertEqual({row.recommended_id: row.score for row in rows},
+                         {self.ids['carol']: 2.5, self.ids['dave']: 1.0})
+
+    def test_common_followers(self):
+        recommendations.refresh()
+
+        # alice and bob share a follower (me), and bob follows me
+        self.assertIn("alice", self.suggested(self.ids['bob']))
+        self.assertNotIn("me", self.suggested(self.ids['bob']))
+
+    def test_top_k(self):
+        recommendations.refresh(k=1)
+
+        self.assertEqual(self.suggested(self.ids['me']), ["carol"])
+
+    def test_refresh_some_users(self):
+        recommendations.refresh()
+        db.session.add(Follows(user_following_id=self.ids['me'],
+                               user_being_followed_id=self.ids['carol']))
+        db.session.commit()
+
+        recommendations.refresh([self.ids['me'], self.loner])
+
+        self.assertEqual(self.suggested(self.ids['me']), ["dave"])
+        self.assertEqual(self.suggested(self.loner), [])
+        self.assertNotEqual(self.suggested(self.ids['alice']), [])
+
+    def test_empty_graph(self):
+        Follows.query.delete()
+        db.session.commit()
+
+        self.assertEqual(recommendations.refresh(), 0)
+        self.assertEqual(recommendations.refresh([self.ids['me']]), 0)
+
+    def test_home_sidebar(self):
+        recommendations.refresh()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids['me']
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("Who to follow", html)
+        self.assertIn("@carol", html)
+
+        # followed since the last refresh: no longer suggested
+        self.client.post(f"/users/follow/{self.ids['carol']}")
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertNotIn("@carol", html)
+        self.assertIn("@dave", html)
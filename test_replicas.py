@@ -0,0 +1,197 @@
+"""Read replica routing tests.
+
+A second local database stands in for the replica. Rows are copied to it
+by hand, and a change made only on the primary plays the part of
+replication lag.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+import time
+from unittest import TestCase
+
+from sqlalchemy import select, update
+from sqlalchemy.engine import make_url
+
+from models import db, Follows, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+os.environ['PASSWORD_HASH_WORKERS'] = "0"
+REPLICA_URL = "postgresql:///warbler-test-replica"
+
+# must import after setting database
+from app import app, CURR_USER_KEY, fragment_cache, replica_router, social_graph, user_cache
+import replicas
+from socialgraph import FOLLOWING
+from test_asgi import call, run
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def create_database(url):
+    """Create the database at `url` if it doesn't exist yet."""
+
+    url = make_url(url)
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM pg_database WHERE datname = %(name)s", {'name': url.database}).scalar()
+        if not exists:
+            conn.exec_driver_sql(f'CREATE DATABASE "{url.database}"')
+
+
+class ReplicaTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        create_database(REPLICA_URL)
+        app.config['SQLALCHEMY_REPLICA_URIS'] = [REPLICA_URL]
+        replica_router.dispose()
+
+    @classmethod
+    def tearDownClass(cls):
+        replica_router.dispose()
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.replica = replica_router.engines()[0]
+        db.metadata.drop_all(self.replica)
+        db.metadata.create_all(self.replica)
+
+        self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+        fragment_cache.clear()
+
+        self.users = [User.signup(f"user{i}", f"user{i}@email.com", "password", None)
+                      for i in range(2)]
+        for user in self.users:
+            user.bio = "replicated bio"
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+        db.session.add(Message(text="replicated warble", user_id=self.ids[0]))
+        db.session.commit()
+        self.replicate()
+
+        # then a change the replica hasn't caught up with
+        db.session.execute(update(User).where(User.id == self.ids[0]).values(bio="new bio"))
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        return super().tearDown()
+
+    def replicate(self):
+        """Copy every table from the primary to the replica."""
+
+        with db.engine.connect() as primary, self.replica.begin() as replica:
+            for table in db.metadata.sorted_tables:
+                rows = primary.execute(select(table)).mappings().all()
+                if rows:
+                    replica.execute(table.insert(), [dict(row) for row in rows])
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_routed_pages_read_replica(self):
+        for path in ["/users", f"/users/{self.ids[0]}"]:
+            with self.subTest(path=path):
+                html = self.client.get(path).get_data(as_text=True)
+                self.assertIn("replicated bio", html)
+                self.assertNotIn("new bio", html)
+
+    def test_other_pages_read_primary(self):
+        self.login(self.ids[1])
+
+        html = self.client.get(f"/users/{self.ids[0]}/followers").get_data(as_text=True)
+
+        self.assertIn("new bio", html)
+
+    def test_read_your_writes(self):
+        self.login(self.ids[1])
+        self.client.post(f"/users/follow/{self.ids[0]}")
+
+        # just followed: the primary serves the page, with the new follow
+        html = self.client.get(f"/users/{self.ids[0]}").get_data(as_text=True)
+        self.assertIn("new bio", html)
+        self.assertIn(f'<a href="/users/{self.ids[0]}/followers">1</a>', html)
+
+        with self.client.session_transaction() as sess:
+            sess[replicas.WROTE_AT_KEY] = time.time() - app.config['REPLICA_STICKY_SECONDS'] - 1
+        # as a new request would, start from a fresh session
+        db.session.remove()
+        html = self.client.get(f"/users/{self.ids[0]}").get_data(as_text=True)
+        self.assertIn("replicated bio", html)
+
+    def test_writes_go_to_primary(self):
+        token = replicas._current.set(self.replica)
+        try:
+            self.assertIs(db.session.get_bind(mapper=User), self.replica)
+            self.assertIs(db.session.get_bind(clause=update(User).values(bio="x")), db.engine)
+            self.assertIs(db.session.get_bind(clause=Follows.__table__.insert()), db.engine)
+        finally:
+            replicas._current.reset(token)
+
+        self.assertIs(db.session.get_bind(mapper=User), db.engine)
+
+    def test_pool_options(self):
+        pool_size = app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size']
+
+        self.assertEqual(db.engine.pool.size(), pool_size)
+        self.assertEqual(self.replica.pool.size(), pool_size)
+
+    def test_pool_metrics(self):
+        self.client.get("/users")
+
+        metrics = self.client.get("/metrics").get_data(as_text=True)
+
+        self.assertIn('warbler_db_pool_size{bind="primary"}', metrics)
+        self.assertIn('warbler_db_pool_connections{bind="replica-0",state="checked_out"} 0',
+                      metrics)
+        self.assertRegex(metrics,
+                         r'warbler_db_pool_connections\{bind="replica-0",state="idle"\} [1-9]')
+
+    def test_asgi_reads_replica(self):
+        resp, = run(call(f"/users/{self.ids[0]}"))
+
+        self.assertIn("replicated bio", resp.text)
+        self.assertNotIn("new bio", resp.text)
+
+    def lagging_follow(self):
+        """user1 follows user0, on the primary only."""
+
+        db.session.add(Follows(user_being_followed_id=self.ids[0], user_following_id=self.ids[1]))
+        db.session.execute(update(User).where(User.id == self.ids[1]).values(following_count=1))
+        db.session.commit()
+
+    def test_cache_fills_read_primary(self):
+        self.lagging_follow()
+        self.login(self.ids[1])
+
+        html = self.client.get("/users").get_data(as_text=True)
+
+        # the page itself comes from the replica...
+        self.assertIn("replicated bio", html)
+        # ...but what's cached for later requests doesn't
+        self.assertEqual(user_cache.peek(self.ids[1]).following_count, 1)
+        self.assertIn(self.ids[0], social_graph.peek(FOLLOWING, self.ids[1]))
+
+    def test_asgi_cache_fills_read_primary(self):
+        self.lagging_follow()
+        signed = app.session_interface.get_signing_serializer(app).dumps(
+            {CURR_USER_KEY: self.ids[1]})
+
+        resp, = run(call("/users", headers=[(b'cookie', f"session={signed}".encode())]))
+
+        self.assertIn("replicated bio", resp.text)
+        self.assertEqual(user_cache.peek(self.ids[1]).following_count, 1)
+        self.assertIn(self.ids[0], social_graph.peek(FOLLOWING, self.ids[1]))
@@ -0,0 +1,150 @@
+"""Social graph cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_socialgraph.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Follows, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+os.environ['PASSWORD_HASH_WORKERS'] = "0"
+
+# must import after setting database
+from app import app, CURR_USER_KEY, social_graph, user_cache
+from socialgraph import AdjacencyList, SocialGraph, FOLLOWERS, FOLLOWING
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_ALWAYS_EAGER'] = True
+
+
+class AdjacencyListTestCase(TestCase):
+
+    def test_sorted_membership(self):
+        ids = AdjacencyList([5, 1, 3, 3])
+
+        self.assertEqual(list(ids), [1, 3, 5])
+        self.assertIn(3, ids)
+        self.assertNotIn(4, ids)
+        self.assertEqual(len(ids), 3)
+
+    def test_copy_on_update(self):
+        ids = AdjacencyList([1, 5])
+        added = ids.with_id(3)
+
+        self.assertEqual(list(added), [1, 3, 5])
+        self.assertEqual(list(ids), [1, 5])
+        self.assertEqual(list(added.without(1)), [3, 5])
+        self.assertIs(ids.without(4), ids)
+
+    def test_intersection(self):
+        ids = AdjacencyList([1, 2, 4, 8])
+
+        self.assertEqual(ids.intersection(AdjacencyList([2, 3, 4, 9])), [2, 4])
+        self.assertEqual(ids.intersection([8, 7, 1]), [1, 8])
+
+
+class SocialGraphTestCase(TestCase):
+
+    def setUp(self):
+        self.graph = SocialGraph(max_size=3)
+        # 1 -> 2, 1 -> 3, 2 -> 1, 3 -> 2
+        self.graph.put(FOLLOWING, 1, [2, 3])
+        self.graph.put(FOLLOWERS, 1, [2])
+        self.graph.put(FOLLOWERS, 2, [1, 3])
+
+    def test_queries(self):
+        self.assertTrue(self.graph.is_following(1, 3))
+        self.assertEqual(self.graph.following_count(1), 2)
+        self.assertEqual(self.graph.mutuals(1), [2])
+        self.assertEqual(self.graph.common_followers(1, 2), [])
+
+    def test_incremental_updates(self):
+        self.graph.follow(3, 2)
+        self.graph.unfollow(1, 3)
+
+        self.assertEqual(list(self.graph.peek(FOLLOWING, 1)), [2])
+        self.assertEqual(list(self.graph.peek(FOLLOWERS, 2)), [1, 3])
+        # lists that aren't cached stay that way
+        self.assertIsNone(self.graph.peek(FOLLOWING, 3))
+
+    def test_remove_user(self):
+        self.graph.remove_user(2)
+
+        self.assertIsNone(self.graph.peek(FOLLOWERS, 2))
+        self.assertEqual(list(self.graph.peek(FOLLOWING, 1)), [3])
+        self.assertEqual(list(self.graph.peek(FOLLOWERS, 1)), [])
+
+    def test_lru(self):
+        self.graph.peek(FOLLOWING, 1)
+        self.graph.put(FOLLOWING, 4, [])
+
+        self.assertIsNone(self.graph.peek(FOLLOWERS, 1))
+        self.assertIsNotNone(self.graph.peek(FOLLOWING, 1))
+        self.assertEqual(len(self.graph), 3)
+
+    def test_ttl(self):
+        graph = SocialGraph(ttl=0)
+        graph.put(FOLLOWING, 1, [2])
+
+        self.assertIsNone(graph.peek(FOLLOWING, 1))
+
+
+class SocialGraphViewTestCase(TestCase):
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+
+        self.users = [User.signup(f"user{i}", f"user{i}@email.com", "password", None)
+                      for i in range(3)]
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+        db.session.add(Follows(user_being_followed_id=self.ids[1],
+                               user_following_id=self.ids[0]))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[0]
+
+    def tearDown(self) -> None:
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        return super().tearDown()
+
+    def test_loads_lazily(self):
+        self.assertIsNone(social_graph.peek(FOLLOWING, self.ids[0]))
+
+        self.assertEqual(list(social_graph.following(self.ids[0])), [self.ids[1]])
+        self.assertEqual(list(social_graph.followers(self.ids[1])), [self.ids[0]])
+
+    def test_follow_and_unfollow_update_graph(self):
+        self.assertEqual(list(social_graph.followers(self.ids[2])), [])
+        self.client.get("/users")
+
+        self.client.post(f"/users/follow/{self.ids[2]}")
+        self.assertEqual(list(social_graph.peek(FOLLOWING, self.ids[0])), self.ids[1:])
+        self.assertEqual(list(social_graph.peek(FOLLOWERS, self.ids[2])), [self.ids[0]])
+
+        # following twice doesn't add a second row or count
+        self.client.post(f"/users/follow/{self.ids[2]}")
+        self.assertEqual(User.query.get(self.ids[2]).followers_count, 1)
+
+        self.client.post(f"/users/stop-following/{self.ids[1]}")
+        self.assertEqual(list(social_graph.peek(FOLLOWING, self.ids[0])), [self.ids[2]])
+        self.assertEqual(Follows.query.filter_by(user_following_id=self.ids[0]).count(), 1)
+
+    def test_delete_user(self):
+        social_graph.followers(self.ids[1])
+
+        self.client.post("/users/delete")
+
+        self.assertEqual(list(social_graph.peek(FOLLOWERS, self.ids[1])), [])
@@ -0,0 +1,146 @@
+"""Timeline model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline_model.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+os.environ['PASSWORD_HASH_WORKERS'] = "0"
+
+# must import after setting database
+from app import app
+
+
+class TimelineModelTestCase(TestCase):
+
+    def setUp(self) -> None:
+        db.drop_all()
+        db.create_all()
+
+        self.author = User.signup("author", "author@email.com", "password", None)
+        self.reader = User.signup("reader", "reader@email.com", "password", None)
+        db.session.commit()
+
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        db.session.rollback()
+        return super().tearDown()
+
+    def timeline_ids(self, user):
+        return [entry.message_id for entry in
+                Timeline.query.filter_by(user_id=user.id)
+                .order_by(Timeline.timestamp.desc(), Timeline.message_id.desc())]
+
+    def post(self, user, text):
+        message = Message(text=text, user_id=user.id)
+        db.session.add(message)
+        db.session.flush()
+        Timeline.fan_out(message)
+        db.session.commit()
+        return message
+
+    def test_fan_out_reaches_author_and_followers(self):
+        self.reader.following.append(self.author)
+        db.session.commit()
+
+        message = self.post(self.author, "hello")
+
+        self.assertEqual(self.timeline_ids(self.author), [message.id])
+        self.assertEqual(self.timeline_ids(self.reader), [message.id])
+
+    def test_fan_out_skips_non_followers(self):
+        self.post(self.author, "hello")
+        self.assertEqual(self.timeline_ids(self.reader), [])
+
+    def test_backfill_and_prune(self):
+        first = self.post(self.author, "first")
+        second = self.post(self.author, "second")
+
+        self.reader.following.append(self.author)
+        db.session.flush()
+        Timeline.backfill(self.reader.id, self.author.id)
+        db.session.commit()
+        self.assertCountEqual(self.timeline_ids(self.reader), [first.id, second.id])
+
+        self.reader.following.remove(self.author)
+        Timeline.prune(self.reader.id, self.author.id)
+        db.session.commit()
+        self.assertEqual(self.timeline_ids(self.reader), [])
+
+    def test_trim_bounds_timeline(self):
+        original_max = Timeline.MAX_ENTRIES
+        Timeline.MAX_ENTRIES = 2
+        try:
+            messages = [self.post(self.author, f"message {i}") for i in range(3)]
+        finally:
+            Timeline.MAX_ENTRIES = original_max
+
+        self.assertEqual(len(self.timeline_ids(self.author)), 2)
+        self.assertNotIn(messages[0].id, self.timeline_ids(self.author))
+
+    def test_trim_only_users_over_cap(self):
+        self.reader.following.append(self.author)
+        db.session.commit()
+        # same timestamp throughout, so ties are broken by message id
+        timestamp = datetime(2023, 1, 1)
+        messages = [Message(text=f"message {i}", user_id=self.author.id, timestamp=timestamp)
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        for message in messages[:2]:
+            Timeline.add_own(message)
+        for message in messages:
+            Timeline.fan_out(message, author=False)
+        db.session.commit()
+
+        original_max = Timeline.MAX_ENTRIES
+        Timeline.MAX_ENTRIES = 2
+        try:
+            Timeline.trim([self.author.id, self.reader.id])
+            db.session.commit()
+        finally:
+            Timeline.MAX_ENTRIES = original_max
+
+        self.assertEqual(self.timeline_ids(self.author), [messages[1].id, messages[0].id])
+        self.assertEqual(self.timeline_ids(self.reader), [messages[2].id, messages[1].id])
+
+    def test_rebuild(self):
+        self.reader.following.append(self.author)
+        message = Message(text="bulk loaded", user_id=self.author.id)
+        db.session.add(message)
+        db.session.commit()
+
+        Timeline.rebuild()
+        db.session.commit()
+
+        self.assertEqual(self.timeline_ids(self.reader), [message.id])
+        self.assertEqual(self.timeline_ids(self.author), [message.id])
+
+    def test_rebuild_timelines_command(self):
+        self.reader.following.append(self.author)
+        message = Message(text="from before timelines", user_id=self.author.id)
+        db.session.add(message)
+        stale = User.signup("stale", "stale@email.com", "password", None)
+        db.session.commit()
+        # a leftover entry the rebuild has to drop
+        db.session.add(Timeline(user_id=stale.id, message_id=message.id,
+                                author_id=self.author.id, timestamp=message.timestamp))
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['rebuild-timelines', '--batch-size', '2'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("3 user(s)", result.output)
+        self.assertEqual(self.timeline_ids(self.reader), [message.id])
+        self.assertEqual(self.timeline_ids(self.author), [message.id])
+        self.assertEqual(self.timeline_ids(stale), [])
@@ -0,0 +1,197 @@
+"""Trending tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+os.environ['PASSWORD_HASH_WORKERS'] = "0"
+
+# must import after setting database
+from app import app, CURR_USER_KEY, social_graph, trending, user_cache, fragment_cache
+from trending import CountMinSketch, SlidingTopK, TopK, Trending, LIKES, FOLLOWS, POSTS
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_ALWAYS_EAGER'] = True
+
+
+class Clock:
+    """Settable stand-in for time.time."""
+
+    def __init__(self, now=1_000_000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SketchTestCase(TestCase):
+
+    def test_count_min_never_underestimates(self):
+        sketch = CountMinSketch(width=8, depth=3)
+        for key in range(40):
+            for _ in range(key % 5):
+                sketch.add(key)
+
+        for key in range(40):
+            self.assertGreaterEqual(sketch.estimate(key), key % 5)
+
+    def test_count_min_exact_when_sparse(self):
+        sketch = CountMinSketch()
+
+        self.assertEqual(sketch.add("a", 3), 3)
+        self.assertEqual(sketch.add("a"), 4)
+        self.assertEqual(sketch.estimate("b"), 0)
+
+    def test_top_k_keeps_highest(self):
+        top = TopK(2)
+        for key, count in [("a", 1), ("b", 2), ("c", 3), ("a", 4), ("d", 1)]:
+            top.offer(key, count)
+
+        self.assertEqual(set(top), {"a", "c"})
+
+
+class SlidingTopKTestCase(TestCase):
+
+    def test_top(self):
+        counter = SlidingTopK(span=60, buckets=6, k=10)
+        for key, times in [(1, 3), (2, 5), (3, 1)]:
+            for _ in range(times):
+                counter.add(key, now=100)
+
+        self.assertEqual(counter.top(now=100, n=2), [(2, 5), (1, 3)])
+
+    def test_sums_buckets(self):
+        counter = SlidingTopK(span=60, buckets=6, k=10)
+        counter.add(1, now=100)
+        counter.add(2, now=100, count=2)
+        counter.add(1, now=125, count=2)
+
+        self.assertEqual(counter.top(now=130, n=5), [(1, 3), (2, 2)])
+
+    def test_old_buckets_expire(self):
+        counter = SlidingTopK(span=60, buckets=6, k=10)
+        counter.add(1, now=100, count=5)
+        counter.add(2, now=150)
+
+        self.assertEqual(counter.top(now=165, n=5), [(2, 1)])
+        self.assertEqual(counter.top(now=220, n=5), [])
+        self.assertEqual(len(counter.buckets), 0)
+
+    def test_windows(self):
+        clock = Clock()
+        counts = Trending(clock=clock)
+        counts.record_like(7)
+        clock.now += 2 * 60 * 60
+        counts.record_like(8)
+
+        self.assertEqual(counts.top(LIKES, '1h'), [(8, 1)])
+        self.assertEqual(counts.top(LIKES, '24h'), [(7, 1), (8, 1)])
+        self.assertEqual(counts.top(FOLLOWS, '24h'), [])
+
+
+class TrendingViewTestCase(TestCase):
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+        fragment_cache.clear()
+        trending.clear()
+
+        self.users = [User.signup(f"user{i}", f"user{i}@email.com", "password", None)
+                      for i in range(3)]
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+        self.msg = Message(text="trending warble", user_id=self.ids[2])
+        db.session.add(self.msg)
+        db.session.commit()
+        self.msg_id = self.msg.id
+
+    def tearDown(self) -> None:
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
+        return super().tearDown()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_routes_record_events(self):
+        for user_id in self.ids[:2]:
+            self.login(user_id)
+            self.client.post(f"/users/add_like/{self.msg_id}")
+            self.client.post(f"/users/follow/{self.ids[2]}")
+        self.client.post("/messages/new", data={"text": "hello"})
+
+        self.assertEqual(trending.top(LIKES), [(self.msg_id, 2)])
+        self.assertEqual(trending.top(FOLLOWS), [(self.ids[2], 2)])
+        self.assertEqual(trending.top(POSTS), [(self.ids[1], 1)])
+
+        # unliking doesn't count as another like
+        self.client.post(f"/users/add_like/{self.msg_id}")
+        self.assertEqual(trending.top(LIKES), [(self.msg_id, 2)])
+
+    def test_failed_like_not_recorded(self):
+        self.login(self.ids[0])
+        with patch.object(db.session, 'commit', side_effect=RuntimeError("commit failed")):
+            resp = self.client.post(f"/users/add_like/{self.msg_id}")
+        db.session.rollback()
+
+        self.assertEqual(resp.status_code, 500)
+
+        self.assertEqual(trending.top(LIKES), [])
+
+    def test_page(self):
+        trending.record_like(self.msg_id)
+        trending.record_follow(self.ids[1])
+        trending.record_post(self.ids[2])
+
+        resp = self.client.get("/trending?window=1h")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("trending warble", html)
+        self.assertIn("1 like", html)
+        self.assertIn("+1 follower", html)
+        self.assertIn("1 warble", html)
+
+    def test_deleted_rows_skipped(self):
+        trending.record_like(self.msg_id)
+        Message.query.filter_by(id=self.msg_id).delete()
+        db.session.commit()
+
+        resp = self.client.get("/trending")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("trending warble", resp.get_data(as_text=True))
+
+    def test_deleted_users_skipped(self):
+        trending.record_like(self.msg_id)
+        trending.record_follow(self.ids[2])
+        trending.record_post(self.ids[2])
+        User.query.filter_by(id=self.ids[2]).update({User.deleted: True})
+        db.session.commit()
+
+        resp = self.client.get("/trending")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("trending warble", html)
+        self.assertNotIn("@user2", html)
+
+    def test_bad_window(self):
+        resp = self.client.get("/trending?window=1y")
+
+        self.assertEqual(resp.status_code, 400)
@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 from sqlalchemy import exc
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, hasher
+from passwords import PasswordHasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -16,6 +17,9 @@ from models import db, User, Message, Follows
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+os.environ['PASSWORD_HASH_WORKERS'] = "0"
 
 
 # Now we can import app
@@ -81,6 +85,27 @@ class UserModelTestCase(TestCase):
         result = User.authenticate('username1', 'password')
         self.assertFalse(result)
         
+    def test_authenticate_rehashes_on_cost_change(self):
+        original_rounds = hasher.rounds
+        hasher.rounds = original_rounds + 1
+        try:
+            user = User.authenticate('username', 'password')
+        finally:
+            hasher.rounds = original_rounds
+        
+        self.assertTrue(user.password.startswith(f'$2b${original_rounds + 1:02d}$'))
+        self.assertTrue(user.check_password('password'))
+        
+    def test_hasher_process_pool(self):
+        pool_hasher = PasswordHasher(rounds=4, workers=1)
+        try:
+            hashed = pool_hasher.hash('password')
+            self.assertTrue(pool_hasher.check(hashed, 'password'))
+            self.assertFalse(pool_hasher.check(hashed, 'wrong'))
+            self.assertFalse(pool_hasher.needs_rehash(hashed))
+        finally:
+            pool_hasher.shutdown()
+        
     def test_user_already_exists(self):
         User.signup("username", "email2@email.com", "password", None)
         with self.assertRaises(exc.IntegrityError) as context:
@@ -108,6 +133,46 @@ class UserModelTestCase(TestCase):
         self.assertTrue(u1.is_followed_by(u2))
         self.assertFalse(u2.is_followed_by(u1))
         
+    def test_following_status(self):
+        u2 = User.signup("username2", "email2@email.com", "password", None)
+        u3 = User.signup("username3", "email3@email.com", "password", None)
+        u1 = self.user
+        
+        u1.following.append(u2)
+        db.session.commit()
+        
+        self.assertEqual(u1.following_status([u2.id, u3.id]), {u2.id})
+        self.assertEqual(u1.following_status([]), set())
+        
+        # the cached set is dropped on commit, so new follows show up
+        self.assertTrue(u1.is_following(u2))
+        u1.following.append(u3)
+        db.session.commit()
+        self.assertTrue(u1.is_following(u3))
+        self.assertEqual(u1.following_status([u2.id, u3.id]), {u2.id, u3.id})
+        
+    def test_reconcile_counts(self):
+        u2 = User.signup("username2", "email2@email.com", "password", None)
+        u1 = self.user
+        
+        u1.followers.append(u2)
+        message = Message(text="a message", user_id=u1.id)
+        db.session.add(message)
+        u2.likes.append(message)
+        db.session.commit()
+        
+        # everything above bypassed the counters
+        self.assertEqual(User.reconcile_counts(), 2)
+        db.session.commit()
+        
+        self.assertEqual(u1.messages_count, 1)
+        self.assertEqual(u1.followers_count, 1)
+        self.assertEqual(u2.following_count, 1)
+        self.assertEqual(u2.likes_count, 1)
+        self.assertEqual(message.likes_count, 1)
+        
+        self.assertEqual(User.reconcile_counts(), 0)
+        
     def test_delete_user(self):
         # add a second user to test if followers table gets updated
         u2 = User.signup("username2", "email2@email.com", "password", None)
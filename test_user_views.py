@@ -1,14 +1,36 @@
 import os
 from unittest import TestCase
-from models import db, User, Message
+from unittest.mock import patch
+from models import db, Follows, User, Message, Timeline
 from flask import session
+from sqlalchemy import event
 from bs4 import BeautifulSoup
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+os.environ['PASSWORD_HASH_WORKERS'] = "0"
 
 # must import after setting database
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, social_graph, user_cache, user_search, fragment_cache
+from socialgraph import FOLLOWING
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_ALWAYS_EAGER'] = True
+
+class count_statements:
+    """Context manager counting SQL statements sent to the database."""
+    
+    def __enter__(self):
+        self.count = 0
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+        return self
+    
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+    
+    def _count(self, *args):
+        self.count += 1
+
 
 class UserViewTestCase(TestCase):
     
@@ -16,6 +38,10 @@ class UserViewTestCase(TestCase):
         db.drop_all()
         db.create_all()
         self.client = app.test_client()
+        user_cache.clear()
+        social_graph.clear()
+        fragment_cache.clear()
+        user_search.clear()
         
         user = User.signup("testuser", "test@email.com", "password1", None)
         user2 = User.signup("testuser2", "test2@email.com", "password2", None)
@@ -31,10 +57,15 @@ class UserViewTestCase(TestCase):
         
         db.session.commit()
         
+        Timeline.rebuild()
+        User.reconcile_counts()
+        db.session.commit()
+        
         return super().setUp()
     
     def tearDown(self) -> None:
-        db.session.rollback()
+        # ids restart with the tables, so don't keep last test's rows around
+        db.session.remove()
         return super().tearDown()
     
     def test_login(self):
@@ -100,8 +131,105 @@ class UserViewTestCase(TestCase):
             soup = BeautifulSoup(str(resp.data), "html.parser")
             
             self.assertIsNotNone(soup.find(string="message here"))
+            # testuser doesn't follow testuser2, so their message stays off the timeline
+            self.assertIsNone(soup.find(string="message2 here"))
+            
+    def test_home_page_after_follow(self):
+        with self.client as c:
+            user = User.query.filter_by(username='testuser').first()
+            user2 = User.query.filter_by(username='testuser2').first()
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+                
+            c.post(f"/users/follow/{user2.id}")
+            resp = c.get("/")
+            soup = BeautifulSoup(str(resp.data), "html.parser")
             self.assertIsNotNone(soup.find(string="message2 here"))
             
+            c.post(f"/users/stop-following/{user2.id}")
+            resp = c.get("/")
+            soup = BeautifulSoup(str(resp.data), "html.parser")
+            self.assertIsNone(soup.find(string="message2 here"))
+            
+    def test_home_page_query_count(self):
+        with self.client as c:
+            user = User.query.filter_by(username='testuser').first()
+            user_id = user.id
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+            
+            for author in User.query.filter(User.id != user.id):
+                c.post(f"/users/follow/{author.id}")
+                for i in range(5):
+                    db.session.add(Message(text=f"{author.username} says {i}", user_id=author.id))
+            db.session.commit()
+            Timeline.rebuild()
+            db.session.commit()
+            # start cold, so authors can't come from the identity map
+            db.session.expunge_all()
+            # but with the follow graph cached, as it is in steady state
+            social_graph.following(user_id)
+            
+            with count_statements() as counter:
+                resp = c.get("/")
+            
+            soup = BeautifulSoup(str(resp.data), "html.parser")
+            self.assertEqual(len(soup.select('#messages li')), 17)
+            # authors are loaded with the page, not one query per message
+            self.assertLessEqual(counter.count, 4)
+            
+    def test_profile_page_query_count(self):
+        with self.client as c:
+            user = User.query.filter_by(username='testuser').first()
+            author = User.query.filter_by(username='testuser2').first()
+            user_id, author_id = user.id, author.id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for i in range(5):
+                db.session.add(Message(text=f"testuser2 says {i}", user_id=author_id))
+            db.session.commit()
+            # start cold, so the author can't come from the identity map
+            db.session.expunge_all()
+            social_graph.following(user_id)
+
+            with count_statements() as counter:
+                resp = c.get(f"/users/{author_id}")
+
+            soup = BeautifulSoup(str(resp.data), "html.parser")
+            self.assertEqual(len(soup.select('#messages li')), 6)
+            # the author is loaded once, not once per message
+            self.assertLessEqual(counter.count, 4)
+
+    def test_likes_page_query_count(self):
+        with self.client as c:
+            user = User.query.filter_by(username='testuser').first()
+            user_id = user.id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for author in User.query.filter(User.id != user_id):
+                for i in range(3):
+                    db.session.add(Message(text=f"{author.username} says {i}", user_id=author.id))
+            db.session.commit()
+            for message in Message.query.filter(Message.user_id != user_id):
+                c.post(f"/users/add_like/{message.id}")
+            # start cold, so authors can't come from the identity map
+            db.session.expunge_all()
+            social_graph.following(user_id)
+
+            with count_statements() as counter:
+                resp = c.get(f"/users/{user_id}/likes")
+
+            soup = BeautifulSoup(str(resp.data), "html.parser")
+            self.assertEqual(len(soup.select('#messages li')), 10)
+            # authors are loaded with the page, not one query per message
+            self.assertLessEqual(counter.count, 3)
+
     def test_users_page(self):
         with self.client as c:
             resp = c.get("/users")
@@ -122,6 +250,44 @@ class UserViewTestCase(TestCase):
             self.assertEqual(len(user_cards), 1)
             self.assertIsNotNone(soup.find(string='@testuser4'))
             
+    def test_users_search_ranking(self):
+        with self.client as c:
+            resp = c.get("/users?q=user")
+            
+            soup = BeautifulSoup(str(resp.data), "html.parser")
+            
+            user_cards = soup.find_all(class_='user-card')
+            self.assertEqual(len(user_cards), 4)
+            # the closest match comes first
+            self.assertEqual(user_cards[0].find('p').string, '@testuser')
+            
+    def test_users_search_bio(self):
+        user = User.query.filter_by(username='testuser3').first()
+        user.bio = "I like birdwatching"
+        db.session.commit()
+        
+        with self.client as c:
+            resp = c.get("/users?q=birdwatch")
+            soup = BeautifulSoup(str(resp.data), "html.parser")
+            self.assertEqual(len(soup.find_all(class_='user-card')), 0)
+            
+            resp = c.get("/users?q=birdwatch&all=1")
+            soup = BeautifulSoup(str(resp.data), "html.parser")
+            self.assertEqual(len(soup.find_all(class_='user-card')), 1)
+            self.assertIsNotNone(soup.find(string='@testuser3'))
+            
+    def test_users_paging(self):
+        with self.client as c:
+            with patch('app.USERS_PER_PAGE', 3):
+                resp = c.get("/users?q=testuser")
+                soup = BeautifulSoup(str(resp.data), "html.parser")
+                self.assertEqual(len(soup.find_all(class_='user-card')), 3)
+                
+                resp = c.get(soup.find('a', id='next-users')['href'])
+                soup = BeautifulSoup(str(resp.data), "html.parser")
+                self.assertEqual(len(soup.find_all(class_='user-card')), 1)
+                self.assertIsNone(soup.find('a', id='next-users'))
+            
     def test_user_profile(self):
         with self.client as c:
             user = User.query.filter_by(username='testuser').first()
@@ -193,6 +359,50 @@ class UserViewTestCase(TestCase):
             # should redirect to testuser3's following page and see testuser2 in html
             self.assertIsNotNone(soup.find(string=f'@{user2.username}'))
             
+    def test_follow_counts(self):
+        with self.client as c:
+            user = User.query.filter_by(username='testuser3').first()
+            user2 = User.query.filter_by(username='testuser2').first()
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+                
+            c.post(f"/users/follow/{user2.id}")
+            self.assertEqual(User.query.get(user.id).following_count, 1)
+            self.assertEqual(User.query.get(user2.id).followers_count, 1)
+            
+            c.post(f"/users/stop-following/{user2.id}")
+            self.assertEqual(User.query.get(user.id).following_count, 0)
+            self.assertEqual(User.query.get(user2.id).followers_count, 0)
+            
+    def test_follow_with_stale_graph_missing_follow(self):
+        # testuser2 already follows testuser, but the cached graph says not
+        user = User.query.filter_by(username='testuser').first()
+        user2 = User.query.filter_by(username='testuser2').first()
+        social_graph.put(FOLLOWING, user2.id, [])
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user2.id
+
+        resp = self.client.post(f"/users/follow/{user.id}")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Follows.query.filter_by(user_following_id=user2.id).count(), 1)
+        self.assertEqual(User.query.get(user.id).followers_count, 1)
+        self.assertTrue(social_graph.is_following(user2.id, user.id))
+
+    def test_follow_with_stale_graph_extra_follow(self):
+        # testuser3 doesn't follow testuser2, but the cached graph says so
+        user2 = User.query.filter_by(username='testuser2').first()
+        user3 = User.query.filter_by(username='testuser3').first()
+        social_graph.put(FOLLOWING, user3.id, [user2.id])
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user3.id
+
+        self.client.post(f"/users/follow/{user2.id}")
+
+        self.assertIsNotNone(db.session.get(Follows, (user2.id, user3.id)))
+        self.assertEqual(User.query.get(user3.id).following_count, 1)
+
     def test_stop_following(self):
         with self.client as c:
             # testuser2 is following testuser in setup
@@ -226,6 +436,27 @@ class UserViewTestCase(TestCase):
             self.assertIsNotNone(soup.find(string='new bio'))
             self.assertEqual(user.email, 'newemail@email.com')
             
+    def test_deleted_user_hidden(self):
+        user = User.query.filter_by(username='testuser').first()
+        user_id = user.id
+        user2_id = User.query.filter_by(username='testuser2').first().id
+        User.query.filter_by(id=user2_id).update({User.deleted: True})
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for path in [f"/users/{user2_id}", f"/users/{user2_id}/following",
+                         f"/users/{user2_id}/followers", f"/users/{user2_id}/likes"]:
+                with self.subTest(path=path):
+                    self.assertEqual(c.get(path).status_code, 404)
+
+            # testuser2 followed testuser
+            resp = c.get(f"/users/{user_id}/followers")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("@testuser2", resp.get_data(as_text=True))
+
     def test_delete_user(self):
         with self.client as c:
             user = User.query.filter_by(username='testuser').first()
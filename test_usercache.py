@@ -0,0 +1,84 @@
+"""User cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_usercache.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheapest bcrypt cost, hashed inline
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+os.environ['PASSWORD_HASH_WORKERS'] = "0"
+
+# must import after setting database
+from app import app
+from usercache import UserCache
+
+
+class UserCacheTestCase(TestCase):
+
+    def setUp(self) -> None:
+        db.drop_all()
+        db.create_all()
+
+        self.users = [User.signup(f"user{i}", f"user{i}@email.com", "password", None)
+                      for i in range(3)]
+        db.session.commit()
+
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        db.session.rollback()
+        return super().tearDown()
+
+    def rename(self, user, username):
+        user.username = username
+        db.session.commit()
+
+    def test_get(self):
+        cache = UserCache()
+        current = cache.get(self.users[0].id)
+
+        self.assertEqual(current.username, "user0")
+        self.assertEqual(current.image_url, "/static/images/default-pic.png")
+        self.assertIs(current.model, self.users[0])
+        self.assertIsNone(cache.get(-1))
+
+    def test_hit_until_invalidated(self):
+        cache = UserCache()
+        user = self.users[0]
+        cache.get(user.id)
+
+        self.rename(user, "renamed")
+        self.assertEqual(cache.get(user.id).username, "user0")
+
+        cache.invalidate(user.id)
+        self.assertEqual(cache.get(user.id).username, "renamed")
+
+    def test_ttl(self):
+        cache = UserCache(ttl=0)
+        user = self.users[0]
+        cache.get(user.id)
+
+        self.rename(user, "renamed")
+        self.assertEqual(cache.get(user.id).username, "renamed")
+
+    def test_lru_eviction(self):
+        cache = UserCache(max_size=2)
+        first, second, third = self.users
+
+        cache.get(first.id)
+        cache.get(second.id)
+        cache.get(first.id)
+        cache.get(third.id)
+
+        # second was least recently used, so it was evicted
+        self.rename(first, "first")
+        self.rename(second, "second")
+        self.assertEqual(cache.get(first.id).username, "user0")
+        self.assertEqual(cache.get(second.id).username, "second")
@@ -0,0 +1,184 @@
+"""Trending messages and accounts, counted from a stream of events.
+
+Routes report events as they happen: a like (toggle_like), a new
+follower (add_follow) and a new message (messages_add). Each kind of event
+is counted over three sliding windows (1h, 24h and 7d). No query ever runs
+GROUP BY over likes or follows.
+
+A window is a ring of time buckets, e.g. twelve 5-minute buckets for the
+last hour. Each bucket holds a count-min sketch (approximate counts for
+any key in fixed memory) and a heap of the keys with the highest counts
+in that bucket. The window's top list is drawn from the buckets' heaps,
+ranked by the sum of their sketch estimates. Old buckets are dropped as
+time moves on. Memory is fixed by the sketch size, the heap size and the
+number of buckets, however many events arrive.
+
+Counts are approximate: a sketch can only overestimate, by a small share
+of the bucket's total. Unlikes are not subtracted. Each worker process
+counts the events it handled, so with several workers each one ranks a
+sample of the traffic.
+"""
+
+import heapq
+from array import array
+from collections import deque
+from threading import Lock
+from time import time
+
+LIKES = 'likes'
+FOLLOWS = 'follows'
+POSTS = 'posts'
+
+# name -> (window length in seconds, number of buckets)
+WINDOWS = {
+    '1h': (60 * 60, 12),
+    '24h': (24 * 60 * 60, 24),
+    '7d': (7 * 24 * 60 * 60, 28),
+}
+DEFAULT_WINDOW = '24h'
+
+
+class CountMinSketch:
+    """Approximate counter for any number of keys in width * depth cells."""
+
+    def __init__(self, width=1024, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('I', bytes(4 * width)) for _ in range(depth)]
+
+    def _cells(self, key):
+        for seed, row in enumerate(self.rows):
+            yield row, hash((seed, key)) % self.width
+
+    def add(self, key, count=1):
+        """Count `key`; returns its new estimate."""
+
+        estimate = None
+        for row, cell in self._cells(key):
+            row[cell] += count
+            estimate = row[cell] if estimate is None else min(estimate, row[cell])
+        return estimate
+
+    def estimate(self, key):
+        return min(row[cell] for row, cell in self._cells(key))
+
+
+class TopK:
+    """The `k` keys with the highest counts seen, kept in a lazy min-heap."""
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self.heap = []
+
+    def offer(self, key, count):
+        if key in self.counts or len(self.counts) < self.k:
+            self.counts[key] = count
+            heapq.heappush(self.heap, (count, key))
+        else:
+            self._drop_stale()
+            if count <= self.heap[0][0]:
+                return
+            _, evicted = heapq.heappop(self.heap)
+            del self.counts[evicted]
+            self.counts[key] = count
+            heapq.heappush(self.heap, (count, key))
+
+        if len(self.heap) > 4 * self.k:
+            self.heap = [(count, key) for key, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def _drop_stale(self):
+        # entries left behind when a key's count went up
+        while self.heap[0][0] != self.counts.get(self.heap[0][1]):
+            heapq.heappop(self.heap)
+
+    def __iter__(self):
+        return iter(self.counts)
+
+
+class Bucket:
+    __slots__ = ('start', 'sketch', 'top')
+
+    def __init__(self, start, width, depth, k):
+        self.start = start
+        self.sketch = CountMinSketch(width, depth)
+        self.top = TopK(k)
+
+    def add(self, key, count):
+        self.top.offer(key, self.sketch.add(key, count))
+
+
+class SlidingTopK:
+    """Approximate top keys over the last `span` seconds, in `buckets` slices."""
+
+    def __init__(self, span, buckets, k=50, width=1024, depth=4):
+        self.span = span
+        self.bucket_span = span / buckets
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self.buckets = deque()
+
+    def _expire(self, now):
+        while self.buckets and self.buckets[0].start <= now - self.span:
+            self.buckets.popleft()
+
+    def add(self, key, now, count=1):
+        self._expire(now)
+        start = now - now % self.bucket_span
+        if not self.buckets or self.buckets[-1].start < start:
+            self.buckets.append(Bucket(start, self.width, self.depth, self.k))
+        self.buckets[-1].add(key, count)
+
+    def top(self, now, n):
+        """[(key, estimated count)] of the `n` top keys, highest first."""
+
+        self._expire(now)
+        candidates = set()
+        for bucket in self.buckets:
+            candidates.update(bucket.top)
+
+        totals = [(sum(bucket.sketch.estimate(key) for bucket in self.buckets), key)
+                  for key in candidates]
+        best = heapq.nlargest(n, totals, key=lambda item: (item[0], -item[1]))
+        return [(key, total) for total, key in best]
+
+
+class Trending:
+    """Sliding top lists for each kind of event and window."""
+
+    def __init__(self, k=50, width=1024, depth=4, clock=time):
+        self.clock = clock
+        self._lock = Lock()
+        self._k, self._width, self._depth = k, width, depth
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.counters = {
+                (kind, window): SlidingTopK(span, buckets, self._k, self._width, self._depth)
+                for kind in (LIKES, FOLLOWS, POSTS)
+                for window, (span, buckets) in WINDOWS.items()
+            }
+
+    def record(self, kind, key, count=1):
+        now = self.clock()
+        with self._lock:
+            for window in WINDOWS:
+                self.counters[(kind, window)].add(key, now, count)
+
+    def record_like(self, message_id):
+        self.record(LIKES, message_id)
+
+    def record_follow(self, followed_id):
+        self.record(FOLLOWS, followed_id)
+
+    def record_post(self, author_id):
+        self.record(POSTS, author_id)
+
+    def top(self, kind, window=DEFAULT_WINDOW, n=10):
+        """[(id, estimated count)] of the top `n` ids for `kind` in `window`."""
+
+        with self._lock:
+            return self.counters[(kind, window)].top(self.clock(), n)
@@ -0,0 +1,136 @@
+"""In-process cache of the logged-in user's profile fields.
+
+Every request needs the current user for the nav bar and the home page
+sidebar, which made `User.query.get` the most frequent query we run. This
+keeps a small LRU of the few columns templates read, each entry expiring
+after a TTL. Routes that change a user invalidate their entry; counters
+changed by *other* users' actions (e.g. a new follower) may lag by up to
+the TTL, and so may changes made in another worker process.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from models import db, User, FollowChecks
+from replicas import primary_bind
+
+CACHED_COLUMNS = (
+    'id',
+    'username',
+    'image_url',
+    'header_image_url',
+    'messages_count',
+    'following_count',
+    'followers_count',
+    'likes_count',
+    'updated_at',
+)
+
+
+def select_cached_columns(user_id):
+    # a deleted account is logged out everywhere
+    return (db.select(*(getattr(User, col) for col in CACHED_COLUMNS))
+            .where(User.id == user_id, User.deleted.is_(False)))
+
+
+class UserCache:
+    """LRU of user-id -> column values, with entries expiring after `ttl` seconds."""
+
+    def __init__(self, max_size=1024, ttl=30, graph=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.graph = graph
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id):
+        """Return a CurrentUser for `user_id`, or None if there is no such user."""
+
+        current = self.peek(user_id)
+        if current is not None:
+            return current
+
+        row = (db.session.execute(select_cached_columns(user_id), bind_arguments=primary_bind())
+               .mappings()
+               .first())
+
+        if row is None:
+            return None
+
+        return self.put(user_id, dict(row))
+
+    def peek(self, user_id):
+        """The cached CurrentUser for `user_id`, without touching the database."""
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > monotonic():
+                self._entries.move_to_end(user_id)
+                return CurrentUser(entry[1], self.graph)
+
+        return None
+
+    def put(self, user_id, values):
+        """Cache `values` (CACHED_COLUMNS of a user row); returns a CurrentUser."""
+
+        with self._lock:
+            self._entries[user_id] = (monotonic() + self.ttl, values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return CurrentUser(values, self.graph)
+
+    def invalidate(self, *user_ids):
+        """Forget the cached values for `user_ids`."""
+
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CurrentUser(FollowChecks):
+    """Read-only snapshot of a user, built from cached column values.
+
+    Offers the attributes templates use plus the follow checks, which are
+    answered from the social graph when one is given. Routes that change
+    the user work on `model`, which loads the full User row the first time
+    it's needed.
+    """
+
+    def __init__(self, values, graph=None):
+        self.__dict__.update(values)
+        self._model = None
+        self._graph = graph
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    def following_ids(self):
+        if self._graph is None:
+            return super().following_ids()
+        return self._graph.following(self.id)
+
+    def follower_ids(self):
+        if self._graph is None:
+            return super().follower_ids()
+        return self._graph.followers(self.id)
+
+    def following_status(self, user_ids):
+        if self._graph is None:
+            return super().following_status(user_ids)
+        return set(self._graph.following(self.id).intersection(user_ids))
+
+    @property
+    def model(self):
+        """The User row behind this snapshot, loaded on first use."""
+
+        if self._model is None:
+            self._model = User.query.get(self.id)
+
+        return self._model